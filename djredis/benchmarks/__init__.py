@@ -0,0 +1,87 @@
+# coding: utf-8
+
+import time
+
+
+def measure(func, iterations, setup=None):
+  """
+  Calls `func(i)` for i in [0, iterations) and returns the latency of each
+  call in seconds. If given, `setup(i)` is called before each call and
+  isn't measured.
+  """
+  latencies = []
+  for i in xrange(iterations):
+    if setup is not None:
+      setup(i)
+    start = time.time()
+    func(i)
+    latencies.append(time.time() - start)
+  return latencies
+
+
+def calibrate(iterations=20):
+  """
+  Returns the fastest time (ms) of a fixed pure-Python workload. Timings
+  divided by this are roughly comparable across machines and loads.
+  """
+  def workload(i):
+    total = 0
+    for x in xrange(100000):
+      total += x % 7
+    return total
+  return min(measure(workload, iterations)) * 1000
+
+
+def summarize(latencies):
+  """
+  Returns throughput (ops/s) and min/mean/p50/p99 latency (ms) for a list
+  of latencies in seconds.
+  """
+  latencies = sorted(latencies)
+  total = sum(latencies)
+
+  def percentile(p):
+    return latencies[min(int(len(latencies) * p / 100.0),
+                         len(latencies) - 1)] * 1000
+
+  return {
+    'iterations': len(latencies),
+    'ops_per_sec': len(latencies) / total if total else None,
+    'min_ms': latencies[0] * 1000,
+    'mean_ms': total / len(latencies) * 1000,
+    'p50_ms': percentile(50),
+    'p99_ms': percentile(99)
+    }
+
+
+def compare(baseline, results, metric):
+  """
+  Matches `results` against `baseline` (both lists of result dicts as
+  produced by the benchmarks) and returns a list of
+  (name, baseline value, new value, relative change) tuples for `metric`.
+  Results are matched on their `name`.
+  """
+  baseline = {result['name']: result for result in baseline}
+  changes = []
+  for result in results:
+    old = baseline.get(result['name'], {}).get(metric)
+    new = result.get(metric)
+    if old is None or new is None:
+      continue
+    changes.append((result['name'], old, new,
+                    (new - old) / float(old) if old else 0.0))
+  return changes
+
+
+def check(baseline, results, threshold):
+  """
+  Returns the (name, baseline value, new value, relative change) tuples for
+  results whose gated metric (named by their `gate` key, lower is better)
+  regressed by more than `threshold` (e.g. 0.25 for 25%) from `baseline`.
+  """
+  regressions = []
+  for result in results:
+    for change in compare(baseline, [result], result['gate']):
+      if change[3] > threshold:
+        regressions.append(change)
+  return regressions
@@ -0,0 +1,108 @@
+# coding: utf-8
+"""
+Benchmarks for `RedisCache` against clusters of local redis-server
+processes, started with `RedisRingRunner`.
+"""
+
+import itertools
+import random
+import string
+
+from django.test.utils import override_settings
+
+from djredis.benchmarks import measure
+from djredis.benchmarks import summarize
+from djredis.cache import RedisCache
+from djredis.tests.runner import RedisRingRunner
+
+OPERATIONS = ('get', 'set', 'get_many', 'set_many', 'incr', 'delete_tag')
+BATCH_SIZE = 10
+NUM_TAGS = 10
+
+
+def _make_value(size):
+  # Letters compress about as well as typical pickled data.
+  return ''.join(random.choice(string.ascii_letters) for _ in xrange(size))
+
+
+def _make_key(i, tagging):
+  if tagging:
+    return '{tag%s}-key%s' % (i % NUM_TAGS, i)
+  return 'key%s' % i
+
+
+def _get_cache(num_nodes, compress):
+  return RedisCache(
+    ';'.join('localhost:%s' % (RedisRingRunner.MASTER_PORT + i)
+             for i in xrange(num_nodes)),
+    {'OPTIONS': {'CLIENT_CLASS': 'djredis.client.RingClient',
+                 'COMPRESS': compress}})
+
+
+def _run_operation(cache, operation, value, tagging, iterations):
+  keys = [_make_key(i, tagging) for i in xrange(iterations * BATCH_SIZE)]
+  batches = [keys[i * BATCH_SIZE:(i + 1) * BATCH_SIZE]
+             for i in xrange(iterations)]
+  setup = None
+  if operation == 'get':
+    cache.set_many({key: value for key in keys[:iterations]})
+    func = lambda i: cache.get(keys[i])
+  elif operation == 'set':
+    func = lambda i: cache.set(keys[i], value)
+  elif operation == 'get_many':
+    cache.set_many({key: value for key in keys})
+    func = lambda i: cache.get_many(batches[i])
+  elif operation == 'set_many':
+    func = lambda i: cache.set_many({key: value for key in batches[i]})
+  elif operation == 'incr':
+    cache.set_many({key: 0 for key in keys[:iterations]})
+    func = lambda i: cache.incr(keys[i])
+  elif operation == 'delete_tag':
+    # Refill the tag before every delete.
+    setup = lambda i: cache.set_many({'{deltag}-key%s' % j: value
+                                      for j in xrange(BATCH_SIZE)})
+    func = lambda i: cache.client.delete_tag('deltag')
+  latencies = measure(func, iterations, setup=setup)
+  cache.clear()
+  return summarize(latencies)
+
+
+def run(num_nodes=(1, 3), value_sizes=(100, 10000), tagging=(False, True),
+        compress=(False, True), operations=OPERATIONS, iterations=1000,
+        redis_server_path='redis-server'):
+  """
+  Runs every operation for every combination of parameters and returns a
+  list of result dicts.
+  """
+  results = []
+  for _num_nodes in num_nodes:
+    runner = RedisRingRunner(redis_server_path=redis_server_path,
+                             num_nodes=_num_nodes)
+    runner.start()
+    try:
+      for size, _tagging, _compress in itertools.product(value_sizes, tagging,
+                                                         compress):
+        cache = _get_cache(_num_nodes, _compress)
+        value = _make_value(size)
+        with override_settings(DJREDIS_ENABLE_TAGGING=_tagging):
+          for operation in operations:
+            if operation == 'delete_tag' and not _tagging:
+              continue
+            result = _run_operation(cache, operation, value, _tagging,
+                                    iterations)
+            result.update({
+              'name': ('cache.%s[nodes=%s,size=%s,tagging=%s,compress=%s]' %
+                       (operation, _num_nodes, size, int(_tagging),
+                        int(_compress))),
+              'gate': 'p99_ms',
+              'operation': operation,
+              'nodes': _num_nodes,
+              'value_size': size,
+              'tagging': _tagging,
+              'compress': _compress
+              })
+            results.append(result)
+        cache.close()
+    finally:
+      runner.stop()
+  return results
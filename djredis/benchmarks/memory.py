@@ -0,0 +1,74 @@
+# coding: utf-8
+"""
+Compares the Redis memory used by `RedisCache` with and without packing
+untagged keys into hash buckets (the `PACK_BUCKETS` option), against a local
+redis-server started with `RedisRingRunner`.
+"""
+
+from djredis.benchmarks.cache import _make_value
+from djredis.cache import RedisCache
+from djredis.tests.runner import RedisRingRunner
+
+BATCH_SIZE = 1000
+
+
+def _get_cache(pack_buckets):
+  return RedisCache(
+    'localhost:%s' % RedisRingRunner.MASTER_PORT,
+    {'OPTIONS': {'CLIENT_CLASS': 'djredis.client.RingClient',
+                 'PACK_BUCKETS': pack_buckets}})
+
+
+def _get_used_memory(cache):
+  return sum(info['used_memory']
+             for info in cache.client.info('memory').itervalues())
+
+
+def _measure(cache, num_keys, value):
+  # returns the number of bytes of memory used per key
+  cache.clear()
+  before = _get_used_memory(cache)
+  for i in xrange(0, num_keys, BATCH_SIZE):
+    cache.set_many({'key%s' % j: value
+                    for j in xrange(i, min(i + BATCH_SIZE, num_keys))})
+  used = _get_used_memory(cache) - before
+  cache.clear()
+  return float(used) / num_keys
+
+
+def run(num_keys=(10000, 100000), value_sizes=(10, 50), keys_per_bucket=100,
+        redis_server_path='redis-server'):
+  """
+  Stores `num_keys` values of each size, unpacked and packed with about
+  `keys_per_bucket` keys per bucket, and returns a list of result dicts with
+  the memory used per key. Packed results also hold their saving over the
+  unpacked ones.
+  """
+  results = []
+  runner = RedisRingRunner(redis_server_path=redis_server_path, num_nodes=1)
+  runner.start()
+  try:
+    for _num_keys in num_keys:
+      for size in value_sizes:
+        value = _make_value(size)
+        unpacked = None
+        for pack_buckets in (0, max(1, _num_keys // keys_per_bucket)):
+          cache = _get_cache(pack_buckets)
+          bytes_per_key = _measure(cache, _num_keys, value)
+          cache.close()
+          if not pack_buckets:
+            unpacked = bytes_per_key
+          results.append({
+            'name': ('memory[keys=%s,size=%s,pack_buckets=%s]' %
+                     (_num_keys, size, pack_buckets)),
+            'gate': 'bytes_per_key',
+            'keys': _num_keys,
+            'value_size': size,
+            'pack_buckets': pack_buckets,
+            'bytes_per_key': bytes_per_key,
+            'saving': (1 - bytes_per_key / unpacked
+                       if pack_buckets and unpacked else None)
+            })
+  finally:
+    runner.stop()
+  return results
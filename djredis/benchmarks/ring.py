@@ -0,0 +1,146 @@
+# coding: utf-8
+"""
+Offline micro-benchmarks for `HashRing` and `djredis.utils.pickle`. These
+don't need Redis.
+"""
+
+import math
+import os
+import tempfile
+
+from collections import defaultdict
+
+from djredis.benchmarks import calibrate
+from djredis.benchmarks import measure
+from djredis.benchmarks import summarize
+from djredis.utils import pickle
+from djredis.utils.hashring import HashRing
+
+NODE_COUNTS = (1, 4, 16, 64, 256)
+KEYS_PER_BATCH = 1000
+# Values are (de)serialized in batches to keep timer noise down.
+VALUES_PER_BATCH = 100
+VALUE_SHAPES = {
+  'int': 42,
+  'short_str': 'lolcat',
+  'long_str': 'lolcat' * 200,
+  'dict': {'key%s' % i: 'value%s' % i for i in xrange(20)},
+  'list': range(100),
+  'nested': [{'id': i, 'name': 'lolcat%s' % i, 'tags': ['a', 'b']}
+             for i in xrange(20)]
+  }
+
+
+def _get_nodes(num_nodes):
+  return ['10.0.0.%s:6379' % i for i in xrange(num_nodes)]
+
+
+def _result(name, gate, **stats):
+  # `gate` is the metric regressions are checked on; lower is better. Timings
+  # are gated on the fastest run (the least affected by noise from other
+  # processes) relative to the calibration workload.
+  stats.update({'name': name, 'gate': gate})
+  return stats
+
+
+def bench_build(iterations):
+  results = []
+  for num_nodes in NODE_COUNTS:
+    nodes = _get_nodes(num_nodes)
+    stats = summarize(measure(lambda i: HashRing(nodes),
+                              max(iterations / num_nodes, 3)))
+    results.append(_result('ring.build[nodes=%s]' % num_nodes, 'min_relative',
+                           **stats))
+  return results
+
+
+def bench_load(iterations):
+  results = []
+  fd, path = tempfile.mkstemp()
+  os.close(fd)
+  try:
+    for num_nodes in NODE_COUNTS:
+      HashRing(_get_nodes(num_nodes)).dump(path)
+      stats = summarize(measure(lambda i: HashRing.load(path),
+                                max(iterations / num_nodes, 3)))
+      results.append(_result('ring.load[nodes=%s]' % num_nodes,
+                             'min_relative', **stats))
+  finally:
+    os.remove(path)
+  return results
+
+
+def bench_get_node(iterations):
+  results = []
+  keys = [':1:lolcat-%s' % i for i in xrange(KEYS_PER_BATCH)]
+  for num_nodes in NODE_COUNTS:
+    ring = HashRing(_get_nodes(num_nodes))
+
+    def get_nodes(i):
+      for key in keys:
+        ring.get_node(key)
+
+    stats = summarize(measure(get_nodes, iterations))
+    stats['per_key_us'] = stats['mean_ms'] * 1000 / KEYS_PER_BATCH
+    results.append(_result('ring.get_node[nodes=%s]' % num_nodes,
+                           'min_relative', **stats))
+  return results
+
+
+def bench_distribution(num_keys=100000):
+  # Standard deviation of the number of keys per node, as a percentage of the
+  # mean. Deterministic, so any change means the hashing changed.
+  results = []
+  keys = [':1:lolcat-%s' % i for i in xrange(num_keys)]
+  for num_nodes in NODE_COUNTS[1:]:
+    ring = HashRing(_get_nodes(num_nodes))
+    counts = defaultdict(int)
+    for key in keys:
+      counts[ring.get_node(key)] += 1
+    mean = float(num_keys) / num_nodes
+    stddev = math.sqrt(sum((counts[node] - mean) ** 2
+                           for node in ring.nodes) / num_nodes)
+    results.append(_result('ring.distribution[nodes=%s]' % num_nodes,
+                           'stddev_pct', stddev_pct=stddev / mean * 100,
+                           max_pct=max(counts.itervalues()) / mean * 100))
+  return results
+
+
+def bench_pickle(iterations):
+  results = []
+  for shape, value in sorted(VALUE_SHAPES.iteritems()):
+    for compress in (False, True):
+      data = pickle.dumps(value, compress=compress)
+      for operation, func, arg in (('dumps', pickle.dumps, value),
+                                   ('loads', pickle.loads, data)):
+
+        def run_batch(i):
+          for _ in xrange(VALUES_PER_BATCH):
+            func(arg, compress=compress)
+
+        stats = summarize(measure(run_batch, iterations))
+        stats['bytes'] = len(str(data))
+        stats['per_value_us'] = stats['mean_ms'] * 1000 / VALUES_PER_BATCH
+        stats['mb_per_sec'] = (stats['bytes'] * VALUES_PER_BATCH *
+                               stats['ops_per_sec'] / 1e6
+                               if stats['ops_per_sec'] else None)
+        results.append(_result('pickle.%s[shape=%s,compress=%s]' %
+                               (operation, shape, int(compress)),
+                               'min_relative', **stats))
+  return results
+
+
+def run(iterations=1000):
+  """
+  Runs all micro-benchmarks and returns a list of result dicts.
+  """
+  calibration_ms = calibrate()
+  results = (bench_build(iterations) +
+             bench_load(iterations) +
+             bench_get_node(max(iterations / 10, 10)) +
+             bench_distribution() +
+             bench_pickle(max(iterations / 10, 10)))
+  for result in results:
+    if 'min_ms' in result:
+      result['min_relative'] = result['min_ms'] / calibration_ms
+  return results
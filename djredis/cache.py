@@ -1,22 +1,41 @@
 # coding: utf-8
 
+import fnmatch
 import functools
+import hashlib
 import logging
-import types
+import time
 
 from django.core.cache.backends.base import BaseCache
 from django.core.exceptions import ImproperlyConfigured
+from django.db import DEFAULT_DB_ALIAS
+from django.db import transaction
 from django.utils.encoding import smart_str
 
 from redis.exceptions import RedisError
 
+from djredis import signals
+from djredis.conf import settings
+from djredis.deferred import DeferredWrites
 from djredis.errors import DJRedisError
+from djredis.utils import parse_hosts
 from djredis.utils import pickle
 from djredis.utils.imports import import_by_path
+from djredis.writebehind import OVERFLOW_POLICIES
+from djredis.writebehind import WriteBehindQueue
+from djredis.writebehind import write_operations
 
 # Stub object to ensure not passing in a `timeout` argument results in
 # the default timeout
 DEFAULT_TIMEOUT = object()
+CLEAR_MODES = ('flushdb', 'scan', 'generation')
+# Methods which call Redis, wrapped by `DEADLINE` and `FAIL_SILENTLY`.
+# `get_or_set` only exists on Django 1.9+. `iter_many` is a generator, so
+# it's wrapped separately.
+REDIS_METHODS = ('add', 'get', 'set', 'delete', 'get_many', 'has_key', 'incr',
+                 'decr', 'set_many', 'delete_many', 'clear', 'incr_version',
+                 'decr_version', 'delete_pattern', 'get_many_with_ttl',
+                 'get_or_set')
 log = logging.getLogger('djredis')
 
 
@@ -32,33 +51,195 @@ def _nop_if_error(func):
   return wrapper
 
 
+def _with_deadline(func, client, timeout):
+  @functools.wraps(func)
+  def wrapper(*args, **kwargs):
+    with client.deadline(timeout):
+      return func(*args, **kwargs)
+  return wrapper
+
+
+def _iter_with_deadline(func, client, timeout):
+  # Like `_with_deadline`, for generators: the deadline covers the whole
+  # iteration, but only applies while the generator runs.
+  @functools.wraps(func)
+  def wrapper(*args, **kwargs):
+    expires_at = time.time() + timeout
+    items = func(*args, **kwargs)
+    while True:
+      with client.deadline(expires_at - time.time()):
+        try:
+          item = next(items)
+        except StopIteration:
+          return
+      yield item
+  return wrapper
+
+
+def _stop_if_error(func):
+  # Like `_nop_if_error`, for generators: errors end the iteration.
+  @functools.wraps(func)
+  def wrapper(*args, **kwargs):
+    try:
+      for item in func(*args, **kwargs):
+        yield item
+    except (DJRedisError, RedisError):
+      log.error('Uncaught exception in RedisCache.%s' % func.__name__,
+                exc_info=True)
+  return wrapper
+
+
 class RedisCache(BaseCache):
   def __init__(self, locations, params):
     super(RedisCache, self).__init__(params)
-    if isinstance(locations, types.StringTypes):
-      locations = locations.split(';')
-    hosts = []
-    for host in locations:
-      if isinstance(host, types.StringTypes):
-        host = host.strip().split(':')
-      hosts.append(tuple(host))
-    if not hosts:
-      raise ImproperlyConfigured('`LOCATION` must provide at least one host.')
+    hosts = parse_hosts(locations)
     options = params.get('OPTIONS', {})
     client_cls = import_by_path(options.get('CLIENT_CLASS',
                                             'djredis.client.RingClient'))
-    self.client = client_cls(tuple(hosts), options)
+    self.client = client_cls(hosts, options)
     self.compress = options.get('COMPRESS')
+    self.close_connections = options.get('CLOSE_CONNECTIONS', False)
+    try:
+      self.max_key_length = int(options.get('MAX_KEY_LENGTH', 0))
+      self.key_cache_size = int(options.get('KEY_CACHE_SIZE', 1000))
+    except ValueError:
+      raise ImproperlyConfigured('`MAX_KEY_LENGTH` and `KEY_CACHE_SIZE` must '
+                                 'be valid integers.')
+    # Maps (key, version, generation) to the key made for it, see `make_key`.
+    self._made_keys = {}
+    self.clear_mode = options.get('CLEAR', 'flushdb')
+    if self.clear_mode not in CLEAR_MODES:
+      raise ImproperlyConfigured('`CLEAR` must be one of: %s.' %
+                                 ', '.join(CLEAR_MODES))
+    # Version counter of the namespace used by the `generation` clear mode.
+    self._namespace = '{djredis:namespace:%s}' % self.key_prefix
+    self._generation = 0
+    self.write_behind = None
+    if options.get('WRITE_BEHIND'):
+      overflow = options.get('WRITE_BEHIND_OVERFLOW', 'sync')
+      if overflow not in OVERFLOW_POLICIES:
+        raise ImproperlyConfigured('`WRITE_BEHIND_OVERFLOW` must be one of: '
+                                   '%s.' % ', '.join(OVERFLOW_POLICIES))
+      try:
+        self.write_behind = WriteBehindQueue(
+          self.client,
+          max_size=int(options.get('WRITE_BEHIND_MAX_SIZE', 10000)),
+          flush_size=int(options.get('WRITE_BEHIND_FLUSH_SIZE', 100)),
+          flush_interval=float(options.get('WRITE_BEHIND_FLUSH_INTERVAL',
+                                           0.05)),
+          overflow=overflow)
+      except ValueError:
+        raise ImproperlyConfigured('`WRITE_BEHIND_*` options must be valid '
+                                   'numbers.')
+    # Writes made inside database transactions are held back until they
+    # commit, see `DeferredWrites`.
+    self.deferred = None
+    if options.get('DEFER_WRITES'):
+      using = options.get('DEFER_WRITES_DATABASE', DEFAULT_DB_ALIAS)
+      if DeferredWrites.is_supported(using):
+        self.deferred = DeferredWrites(self._write_deferred, using=using)
+      else:
+        log.warning('`DEFER_WRITES` needs `transaction.on_commit` (Django '
+                    '1.9+), writing through instead.')
+    self._hot_keys = options.get('HOT_KEYS', ())
+    self._replicated_hot_keys = []
+    self._replicate_hot_keys()
+    if options.get('DEADLINE'):
+      try:
+        deadline = float(options['DEADLINE'])
+      except ValueError:
+        raise ImproperlyConfigured('`DEADLINE` must be a valid number.')
+      # Bounds the total time each call spends talking to Redis, see
+      # `RingClient.deadline`.
+      for attr in REDIS_METHODS:
+        if hasattr(self, attr):
+          setattr(self, attr, _with_deadline(getattr(self, attr), self.client,
+                                             deadline))
+      self.iter_many = _iter_with_deadline(self.iter_many, self.client,
+                                           deadline)
     if options.get('FAIL_SILENTLY'):
       # Wrap methods that call Redis with _nop_if_exception.
-      for attr in ('add', 'get', 'set', 'delete', 'get_many', 'has_key',
-                   'incr', 'decr', 'set_many', 'delete_many', 'clear',
-                   'incr_version', 'decr_version'):
-        method = getattr(self, attr)
-        setattr(self, attr, _nop_if_error(method))
+      for attr in REDIS_METHODS:
+        if hasattr(self, attr):
+          setattr(self, attr, _nop_if_error(getattr(self, attr)))
+      self.iter_many = _stop_if_error(self.iter_many)
+
+  def _make_key(self, key, version=None, digest=True):
+    if digest:
+      made_key = self._made_keys.get((key, version, self._generation))
+      if made_key is not None:
+        return made_key
+    made_key = smart_str(super(RedisCache, self).make_key(key,
+                                                          version=version))
+    if self._generation:
+      made_key = '%s:%s' % (self._generation, made_key)
+    if not digest:
+      return made_key
+    if self.max_key_length and len(made_key) > self.max_key_length:
+      made_key = self._digest_key(made_key)
+    if self.key_cache_size:
+      if len(self._made_keys) >= self.key_cache_size:
+        self._made_keys.clear()
+      self._made_keys[(key, version, self._generation)] = made_key
+    return made_key
+
+  def _digest_key(self, key):
+    # Replaces `key` with a readable prefix of it, its tag (so it's still
+    # routed to its tag bucket) and its MD5 digest, in at most
+    # `MAX_KEY_LENGTH` bytes unless the tag itself is longer.
+    tag = ''
+    if settings.DJREDIS_ENABLE_TAGGING:
+      match = settings.DJREDIS_TAG_REGEX.match(key)
+      if match:
+        tag = '{%s}' % match.group(1)
+    digest = hashlib.md5(key).hexdigest()
+    readable = key[:max(0, self.max_key_length - len(tag) - len(digest) - 1)]
+    if tag:
+      readable = readable.split('{')[0]
+    return '%s%s:%s' % (readable, tag, digest)
+
+  def _replicate_hot_keys(self):
+    # Names made for an older generation are no longer used.
+    for key in self._replicated_hot_keys:
+      self.client.unreplicate_key(key)
+    self._replicated_hot_keys = [self._make_key(key) for key in self._hot_keys]
+    for key in self._replicated_hot_keys:
+      self.client.replicate_key(key)
 
   def make_key(self, key, version=None):
-    return smart_str(super(RedisCache, self).make_key(key, version=version))
+    """
+    Returns the Redis key for `key`. Keys longer than the `MAX_KEY_LENGTH`
+    option are replaced by a fixed-size digest, which saves memory and
+    bandwidth for long (e.g. URL-derived) keys. The last `KEY_CACHE_SIZE`
+    keys made are memoized.
+
+    NOTE: `delete_pattern` can only match digested keys on the readable
+    prefix they keep.
+    """
+    self._update_generation()
+    return self._make_key(key, version=version)
+
+  def _update_generation(self):
+    if self.clear_mode == 'generation':
+      generation = self.client._get_tag_versions([self._namespace])
+      if generation[self._namespace] != self._generation:
+        self._generation = generation[self._namespace]
+        # Hot keys have new names now.
+        self._replicate_hot_keys()
+
+  def _serialize(self, command, value):
+    func = getattr(pickle, command)
+    if not signals.command_executed.receivers:
+      return func(value, compress=self.compress)
+    start = time.time()
+    result = func(value, compress=self.compress)
+    size = len(str(result if command == 'dumps' else value))
+    signals.command_executed.send(
+      sender=self, command=command, node=None, keys=(),
+      bytes_in=size if command == 'loads' else 0,
+      bytes_out=size if command == 'dumps' else 0,
+      duration=time.time() - start, hits=0, misses=0, error=None)
+    return result
 
   def get_backend_timeout(self, timeout=DEFAULT_TIMEOUT):
     """
@@ -75,9 +256,57 @@ class RedisCache(BaseCache):
     timeout = self.get_backend_timeout(timeout)
     if timeout != None and timeout <= 0:
       return False
-    value = pickle.dumps(value, compress=self.compress)
-    return bool(self.client._set(self.make_key(key, version=version), value,
-                                 nx=add_only, ex=timeout))
+    value = self._serialize('dumps', value)
+    key = self.make_key(key, version=version)
+    if self._is_deferring():
+      if not add_only:
+        return self.deferred.put(key, value, timeout)
+      pending, pending_value = self._get_pending(key)
+      if pending:
+        # Decided against the transaction's own writes, which the cache
+        # will hold once it commits.
+        return (pending_value is None and
+                self.deferred.put(key, value, timeout))
+    if self.write_behind is not None:
+      if not add_only:
+        return self.write_behind.put(key, value, timeout)
+      self.write_behind.pop([key])
+    return bool(self.client._set(key, value, nx=add_only, ex=timeout))
+
+  def _is_deferring(self):
+    return self.deferred is not None and self.deferred.is_deferring()
+
+  def _write_deferred(self, operations):
+    # writes the deferred writes of a committed transaction
+    if self.write_behind is None:
+      write_operations(self.client, operations)
+      return
+    for key, (operation, value, timeout) in operations.iteritems():
+      if operation == DeferredWrites.SET:
+        self.write_behind.put(key, value, timeout)
+      else:
+        self.write_behind.delete(key)
+
+  def _has_pending(self):
+    # returns whether writes may be deferred or queued, see `_get_pending`
+    return self.write_behind is not None or self._is_deferring()
+
+  def _get_pending_write(self, key):
+    # returns the (operation, value, timeout) write to `key` which is
+    # deferred or queued, or None
+    for writes in (self.deferred, self.write_behind):
+      operation = writes.get(key) if writes is not None else None
+      if operation is not None:
+        return operation
+    return None
+
+  def _get_pending(self, key):
+    # returns whether a write to `key` is deferred or queued and the value
+    # it writes
+    operation = self._get_pending_write(key)
+    if operation is None:
+      return False, None
+    return True, operation[1]
 
   def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
     """
@@ -86,6 +315,10 @@ class RedisCache(BaseCache):
     the default cache timeout will be used.
     
     Returns True if the value was stored, False otherwise.
+
+    NOTE: With `DEFER_WRITES`, an add inside a transaction is only deferred
+    if the transaction already wrote the key. Otherwise it depends on what
+    Redis holds, so it's written right away.
     """
     return self._set(key, value, timeout, version, add_only=True)
 
@@ -94,10 +327,15 @@ class RedisCache(BaseCache):
     Fetch a given key from the cache. If the key does not exist, return
     default, which itself defaults to None.
     """
-    value = self.client.get(self.make_key(key, version=version))
+    key = self.make_key(key, version=version)
+    pending = False
+    if self._has_pending():
+      pending, value = self._get_pending(key)
+    if not pending:
+      value = self.client.get(key)
     if value is None: # Key missing?
       return default
-    return pickle.loads(value, compress=self.compress)
+    return self._serialize('loads', value)
 
   def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
     """
@@ -110,7 +348,12 @@ class RedisCache(BaseCache):
     """
     Delete a key from the cache, failing silently.
     """
-    return self.client.delete(self.make_key(key, version=version))
+    key = self.make_key(key, version=version)
+    if self._is_deferring():
+      return self.deferred.delete(key)
+    if self.write_behind is not None:
+      return self.write_behind.delete(key)
+    return self.client.delete(key)
 
   def get_many(self, keys, version=None):
     """
@@ -121,23 +364,112 @@ class RedisCache(BaseCache):
     """
     if not keys:
       return {}
-    values = self.client.mget(self.make_key(key, version=version)
-                              for key in keys)
-    return {keys[i]: pickle.loads(values[i], compress=self.compress)
+    made_keys = [self.make_key(key, version=version) for key in keys]
+    if not self._has_pending():
+      values = self.client.mget(made_keys)
+    else:
+      values = [None] * len(keys)
+      missing = []
+      for i, key in enumerate(made_keys):
+        pending, values[i] = self._get_pending(key)
+        if not pending:
+          missing.append(i)
+      if missing:
+        for i, value in zip(missing,
+                            self.client.mget([made_keys[i] for i in missing])):
+          values[i] = value
+    return {keys[i]: self._serialize('loads', values[i])
             for i in xrange(len(keys)) if values[i] is not None}
 
+  def iter_many(self, keys, version=None, chunk_size=1000):
+    """
+    Like `get_many`, but yields (key, value) pairs for the keys found as
+    each node responds, so callers can start using values before the
+    slowest node answers. Each node is asked for at most `chunk_size` keys
+    at a time and values are deserialized as they're yielded.
+    """
+    made_key_to_key = {self.make_key(key, version=version): key
+                       for key in keys}
+    made_keys = made_key_to_key.keys()
+    if self._has_pending():
+      missing = []
+      for made_key in made_keys:
+        pending, value = self._get_pending(made_key)
+        if not pending:
+          missing.append(made_key)
+        elif value is not None:
+          yield made_key_to_key[made_key], self._serialize('loads', value)
+      made_keys = missing
+    if not made_keys:
+      return
+    for made_key, value in self.client.iter_mget(made_keys,
+                                                 chunk_size=chunk_size):
+      if value is not None:
+        yield made_key_to_key[made_key], self._serialize('loads', value)
+
+  def get_many_with_ttl(self, keys, version=None):
+    """
+    Like `get_many`, but maps each key found to a (value, ttl) pair, where
+    ttl is the number of seconds the key has left to live, or None if it
+    never expires. Tagged keys share the TTL of their bucket.
+    """
+    if not keys:
+      return {}
+    made_key_to_key = {self.make_key(key, version=version): key
+                       for key in keys}
+    made_keys = made_key_to_key.keys()
+    result = {}
+    if self._has_pending():
+      # Pending writes are served from their buffer, with their timeout as
+      # their TTL, since it only starts once they're written.
+      missing = []
+      for made_key in made_keys:
+        operation = self._get_pending_write(made_key)
+        if operation is None:
+          missing.append(made_key)
+        elif operation[1] is not None:
+          result[made_key_to_key[made_key]] = (
+            self._serialize('loads', operation[1]), operation[2])
+      made_keys = missing
+    if not made_keys:
+      return result
+    values = self.client.mget_with_ttl(made_keys)
+    result.update((made_key_to_key[made_key],
+                   (self._serialize('loads', value),
+                    ttl / 1000.0 if ttl is not None else None))
+                  for made_key, (value, ttl) in zip(made_keys, values)
+                  if value is not None)
+    return result
+
   def has_key(self, key, version=None):
     """
     Returns True if the key is in the cache and has not expired.
     """
-    return self.client.exists(self.make_key(key, version=version))
+    key = self.make_key(key, version=version)
+    if self._has_pending():
+      pending, value = self._get_pending(key)
+      if pending:
+        return value is not None
+    return self.client.exists(key)
 
   def incr(self, key, delta=1, version=None):
     """
     Add delta to value in the cache. If the key does not exist, raise a
     ValueError exception.
+
+    NOTE: With `DEFER_WRITES`, an incr inside a transaction is only deferred
+    if the transaction already wrote the key, like an add.
     """
     key = self.make_key(key, version=version)
+    operation = self.deferred.get(key) if self._is_deferring() else None
+    if operation is not None:
+      if operation[1] is None:
+        raise ValueError
+      value = self._serialize('loads', operation[1]) + delta
+      self.deferred.put(key, self._serialize('dumps', value), operation[2])
+      return value
+    if self.write_behind is not None:
+      self.write_behind.pop([key])
     exists = self.client.exists(key)
     if not exists:
       raise ValueError
@@ -158,25 +490,112 @@ class RedisCache(BaseCache):
     If timeout is given, that timeout will be used for the key; otherwise
     the default cache timeout will be used.
     """
-    # TODO(usmanm): Make this faster using per-node *pipelines*.
-    for key, value in data.iteritems():
-      self.set(key, value, timeout=timeout, version=version)
-      
+    timeout = self.get_backend_timeout(timeout)
+    if timeout != None and timeout <= 0:
+      return
+    mapping = {self.make_key(key, version=version):
+               self._serialize('dumps', value)
+               for key, value in data.iteritems()}
+    if self._is_deferring():
+      for key, value in mapping.iteritems():
+        self.deferred.put(key, value, timeout)
+      return
+    if self.write_behind is not None:
+      for key, value in mapping.iteritems():
+        self.write_behind.put(key, value, timeout)
+      return
+    # Uses a single pipeline per node.
+    self.client.set_many(mapping, ex=timeout)
+
   def delete_many(self, keys, version=None):
     """
     Set a bunch of values in the cache at once.  For certain backends
     (memcached), this is much more efficient than calling delete() multiple
     times.
     """
-    return self.client.delete(*(self.make_key(key, version=version)
-                                for key in keys))
+    keys = [self.make_key(key, version=version) for key in keys]
+    if self._is_deferring():
+      for key in keys:
+        self.deferred.delete(key)
+      return
+    if self.write_behind is not None:
+      for key in keys:
+        self.write_behind.delete(key)
+      return
+    return self.client.delete(*keys)
+
+  def delete_pattern(self, pattern, version=None):
+    """
+    Delete all keys matching a glob-style pattern. Keys are found with SCAN
+    rather than KEYS so this doesn't block Redis.
+
+    Returns the number of keys deleted.
+
+    NOTE: With `DEFER_WRITES`, the keys are deleted right away, even inside
+    a transaction. Its deferred writes to matching keys become deletes.
+    """
+    if self.write_behind is not None:
+      self.write_behind.flush()
+    self._update_generation()
+    pattern = self._make_key(pattern, version=version, digest=False)
+    if self._is_deferring():
+      for key in self.deferred.keys():
+        if fnmatch.fnmatchcase(key, pattern):
+          self.deferred.delete(key)
+    return self.client.delete_pattern(pattern)
 
   def clear(self):
-    """Remove *all* values from the cache at once."""
-    self.client.flushdb()
+    """
+    Remove *all* values from the cache at once.
+
+    The `CLEAR` option controls how this is done:
+    - `flushdb` (default) flushes the DB on every node, including any
+      keys which don't belong to this cache.
+    - `scan` only deletes keys under this cache's `KEY_PREFIX`, scanning and
+      deleting from each node in parallel.
+    - `generation` bumps a namespace counter which is embedded in every key,
+      which makes clearing O(1). Old keys are left to expire or be evicted.
+    """
+    if self._is_deferring():
+      self.deferred.discard()
+    if self.write_behind is not None:
+      self.write_behind.discard()
+    if self.clear_mode == 'scan':
+      self.client.delete_pattern(self.key_func('*', self.key_prefix, '*'))
+    elif self.clear_mode == 'generation':
+      self.client._incr_tag_versions([self._namespace])
+    else:
+      self.client.flushdb()
+
+  def deadline(self, timeout):
+    """
+    Returns a context manager which bounds the time spent talking to Redis
+    by the cache calls in its block to `timeout` seconds. See
+    `RingClient.deadline`.
+    """
+    return self.client.deadline(timeout)
+
+  def priority(self, priority):
+    """
+    Returns a context manager which runs the cache calls in its block with
+    `priority`. See `RingClient.priority`.
+    """
+    return self.client.priority(priority)
+
+  def warmup(self, connections=None):
+    """
+    Opens connections to every node and loads registered scripts on them.
+    Call this after forking. See `RingClient.warmup`.
+    """
+    return self.client.warmup(connections=connections)
 
   def close(self, **kwargs):
-    """Close the cache connection"""
-    # TODO(usmanm): StrictRedis does connection pooling internally so I believe
-    # this should be a no-op.
-    pass
+    """
+    Close the cache connection. Django calls this at the end of every request.
+
+    StrictRedis pools connections, so this is a no-op unless the
+    `CLOSE_CONNECTIONS` option is set, in which case idle connections are
+    released.
+    """
+    if self.close_connections:
+      self.client.release_idle_connections()
@@ -3,19 +3,55 @@
 import functools
 import hashlib
 import itertools
+import logging
+import os
+import socket
+import threading
+import time
+import zlib
 
 from collections import defaultdict
+from contextlib import contextmanager
+from random import choice
+from random import uniform
 from random import shuffle
+from redis import ConnectionPool
 from redis import StrictRedis
+from redis.client import BasePipeline
+from redis.exceptions import ConnectionError
 from redis.exceptions import RedisError
+from redis.exceptions import ResponseError
+from redis.exceptions import TimeoutError
 from redis.sentinel import Sentinel
 
 from django.core.exceptions import ImproperlyConfigured
 
 from djredis import errors
+from djredis import signals
 from djredis.conf import settings
+from djredis.instrumentation import HotKeyProfiler
 from djredis.utils import get_node_name
+from djredis.utils import parse_hosts
+from djredis.utils.cluster import ClusterNode
+from djredis.utils.cluster import NUM_SLOTS
+from djredis.utils.cluster import SlotMap
+from djredis.utils.cluster import get_slot
+from djredis.utils.cluster import parse_redirect
+from djredis.utils.connection import AdaptiveTimeout
+from djredis.utils.connection import ConcurrencyLimiter
+from djredis.utils.connection import Connection
+from djredis.utils.connection import Node
+from djredis.utils.connection import PRIORITIES
+from djredis.utils.connection import PRIORITY_SHARES
+from djredis.utils.connection import SentinelManagedConnection
+from djredis.utils.connection import command_timeout
+from djredis.utils.filters import BloomFilter
+from djredis.utils.filters import NegativeCache
+from djredis.utils.hashring import DEFAULT_NUM_VIRTUAL_NODES
 from djredis.utils.hashring import HashRing
+from djredis.utils.parallel import imerge
+
+log = logging.getLogger('djredis')
 
 
 def _combine_into_list(keys, args):
@@ -33,6 +69,30 @@ def _combine_into_list(keys, args):
     keys.extend(args)
   return keys
 
+def _get_size(value):
+  # returns the approximate number of bytes sent/received for a value
+  if value is None or isinstance(value, bool):
+    return 0
+  if isinstance(value, (basestring, bytes)):
+    return len(value)
+  if isinstance(value, (int, long, float)):
+    return len(str(value))
+  if isinstance(value, dict):
+    return sum(_get_size(k) + _get_size(v) for k, v in value.iteritems())
+  if isinstance(value, (list, tuple)):
+    return sum(_get_size(v) for v in value)
+  return 0
+
+def _chunks(items, size):
+  # splits a list into lists of at most `size` items
+  for i in xrange(0, len(items), size):
+    yield items[i:i + size]
+
+def _call_on_connection(connection, *args):
+  # sends a command on `connection` and returns its response
+  connection.send_command(*args)
+  return connection.read_response()
+
 
 class RingClient(object):
   # TODO(usmanm): Add support for other redis commands.
@@ -41,30 +101,545 @@ class RingClient(object):
   BROADCAST_METHODS = {'dbsize', 'flushdb', 'info', 'ping'}
   ROUTE_METHODS = {'getset', 'lock'}
   TAG_ROUTE_METHODS = {'exists', 'get', 'incrby', 'set', 'setnx'}
+  # Commands whose responses are counted as cache hits/misses.
+  READ_COMMANDS = {'get', 'hget', 'mget', 'hmget'}
+  # Tag routed commands which are served by a single replica of a hot key.
+  REPLICA_READ_METHODS = {'exists', 'get'}
+  # Single key commands, whose latencies `ADAPTIVE_TIMEOUT` tracks and which
+  # use the timeouts derived from them. Bulk commands (MGET, HMGET, ...) keep
+  # `SOCKET_TIMEOUT`.
+  ADAPTIVE_TIMEOUT_COMMANDS = {'get', 'hget', 'exists', 'hexists', 'set',
+                               'hset', 'setnx', 'hsetnx'}
+  # Reads, which are shed when a node is overloaded (see `MAX_IN_FLIGHT`).
+  # Other commands wait for a slot: dropping writes and deletes would leave
+  # stale values behind.
+  SHED_COMMANDS = READ_COMMANDS | {'exists', 'hexists', 'mget_with_ttl'}
+  # Idempotent commands, which `RETRIES` applies to. Retrying others, like
+  # INCRBY or SETNX, could apply them twice.
+  RETRY_COMMANDS = READ_COMMANDS | {
+    'exists', 'hexists', 'set', 'hset', 'set_many', 'delete',
+    'mget_with_ttl', 'migrate_get', 'bloom_filter', 'dbsize', 'info', 'ping'}
+  # Bitmap holding the Bloom filter of the keys stored on each node.
+  BLOOM_FILTER_KEY = 'djredis:bloom'
+  # Where `rebuild_bloom_filters` writes a rebuilt filter, before merging it.
+  BLOOM_FILTER_REBUILD_KEY = 'djredis:bloom:rebuild'
+  # Prefix of the hash buckets untagged keys are packed into, see
+  # `get_cache_key`.
+  PACK_BUCKET_PREFIX = '{djredis-pack:'
 
   def __init__(self, hosts, options):
+    self.name_to_node = {get_node_name(node): node for node in
+                         self._get_nodes(hosts, options)}
+    self.node_to_name = {node: name for name, node in
+                         self.name_to_node.iteritems()}
+    self.ring = self._get_ring(self.name_to_node.keys(),
+                               self._get_weights(hosts, options),
+                               options.get('RING_SNAPSHOT'))
+    # While resharding, `PREVIOUS_LOCATION` holds the hosts of the ring before
+    # nodes were added/removed. Keys which moved are looked up on their
+    # previous owner when missing (see `_migrate`).
+    self.previous_ring = None
+    if options.get('PREVIOUS_LOCATION'):
+      previous_hosts = parse_hosts(options['PREVIOUS_LOCATION'],
+                                   'PREVIOUS_LOCATION')
+      previous_nodes = self._get_nodes(previous_hosts, options)
+      self.previous_name_to_node = {}
+      for node in previous_nodes:
+        name = get_node_name(node)
+        node = self.name_to_node.get(name, node)
+        self.previous_name_to_node[name] = node
+        self.node_to_name[node] = name
+      self.previous_ring = HashRing(
+        self.previous_name_to_node.keys(),
+        weights=self._get_weights(previous_hosts, options))
+    self._pid = os.getpid()
+    self._fork_lock = threading.Lock()
+    self._local = threading.local()
+    self._script_cache = {}
+    self._tag_versions = {}
+    self._redis_versions = {}
+    try:
+      self.delete_chunk_size = int(options.get('DELETE_CHUNK_SIZE', 1000))
+    except ValueError:
+      raise ImproperlyConfigured('`DELETE_CHUNK_SIZE` must be a valid integer.')
+    try:
+      self.pack_buckets = int(options.get('PACK_BUCKETS', 0))
+    except ValueError:
+      raise ImproperlyConfigured('`PACK_BUCKETS` must be a valid integer.')
+    try:
+      self.warmup_connections = int(options.get('WARMUP_CONNECTIONS', 1))
+    except ValueError:
+      raise ImproperlyConfigured('`WARMUP_CONNECTIONS` must be a valid '
+                                 'integer.')
+    self.profiler = None
+    self.replicated_keys = {}
+    try:
+      self.hot_key_replicas = int(options.get('HOT_KEY_REPLICAS', 3))
+      self.hot_key_replica_timeout = int(
+        options.get('HOT_KEY_REPLICA_TIMEOUT', 60))
+      self.hot_key_auto_share = float(options.get('HOT_KEY_AUTO_SHARE', 0))
+      sample_rate = float(options.get('HOT_KEY_SAMPLE_RATE', 0))
+      if sample_rate:
+        self.profiler = HotKeyProfiler(
+          self, sample_rate=sample_rate,
+          capacity=int(options.get('HOT_KEY_CAPACITY', 100)),
+          publish_interval=float(options.get('HOT_KEY_PUBLISH_INTERVAL', 60)),
+          on_publish=self._replicate_published_hot_keys)
+        self.profiler.connect(sender=self)
+    except ValueError:
+      raise ImproperlyConfigured('`HOT_KEY_*` options must be valid numbers.')
+    self.negative_cache = None
+    self.bloom_filter = None
+    self._bloom_bitmaps = {}
+    self._bloom_pulls = {}
+    self._bloom_lock = threading.Lock()
+    try:
+      negative_cache_timeout = float(options.get('NEGATIVE_CACHE_TIMEOUT', 0))
+      if negative_cache_timeout:
+        self.negative_cache = NegativeCache(
+          negative_cache_timeout,
+          max_size=int(options.get('NEGATIVE_CACHE_SIZE', 10000)))
+      if options.get('BLOOM_FILTER'):
+        self.bloom_filter = BloomFilter(
+          int(options.get('BLOOM_FILTER_BITS', 2 ** 23)),
+          int(options.get('BLOOM_FILTER_HASHES', 4)))
+        self.bloom_filter_refresh_interval = float(
+          options.get('BLOOM_FILTER_REFRESH_INTERVAL', 10))
+    except ValueError:
+      raise ImproperlyConfigured('`NEGATIVE_CACHE_*` and `BLOOM_FILTER_*` '
+                                 'options must be valid numbers.')
+    try:
+      self.retries = int(options.get('RETRIES', 0))
+      self.retry_backoff = float(options.get('RETRY_BACKOFF', 0.005))
+      self.retry_backoff_max = float(options.get('RETRY_BACKOFF_MAX', 0.05))
+    except ValueError:
+      raise ImproperlyConfigured('`RETRIES` and `RETRY_BACKOFF*` options must '
+                                 'be valid numbers.')
+    self.limiters = None
+    try:
+      self.max_in_flight = int(options.get('MAX_IN_FLIGHT', 0))
+      self.max_queue_time = float(options.get('MAX_QUEUE_TIME', 0))
+      self.priority_shares = dict(PRIORITY_SHARES)
+      self.priority_shares.update(
+        (priority, float(share)) for priority, share in
+        options.get('PRIORITY_SHARES', {}).iteritems())
+    except ValueError:
+      raise ImproperlyConfigured('`MAX_IN_FLIGHT`, `MAX_QUEUE_TIME` and '
+                                 '`PRIORITY_SHARES` must be valid numbers.')
+    if set(self.priority_shares) != set(PRIORITIES):
+      raise ImproperlyConfigured('`PRIORITY_SHARES` keys must be one of: %s.'
+                                 % ', '.join(PRIORITIES))
+    if self.max_in_flight:
+      self.limiters = self._get_limiters()
+    self.adaptive_timeouts = None
+    if options.get('ADAPTIVE_TIMEOUT'):
+      try:
+        kwargs = {
+          'window': int(options.get('ADAPTIVE_TIMEOUT_WINDOW', 1000)),
+          'percentile': float(options.get('ADAPTIVE_TIMEOUT_PERCENTILE', 99)),
+          'multiplier': float(options.get('ADAPTIVE_TIMEOUT_MULTIPLIER', 3)),
+          'min_timeout': float(options.get('ADAPTIVE_TIMEOUT_MIN', 0.01))
+          }
+      except ValueError:
+        raise ImproperlyConfigured('`ADAPTIVE_TIMEOUT_*` options must be '
+                                   'valid numbers.')
+      self._adaptive_timeout_kwargs = kwargs
+      self.adaptive_timeouts = {node: AdaptiveTimeout(**kwargs)
+                                for node in self.node_to_name}
+    if options.get('WARMUP'):
+      self.warmup()
+
+  def _get_nodes(self, hosts, options):
     if all(isinstance(host, StrictRedis) for host in hosts):
-      nodes = list(hosts)
+      return list(hosts)
+    assert all(isinstance(host, tuple) and len(host) in (2, 3)
+               for host in hosts)
+    kwargs = self._get_node_kwargs(options)
+    nodes = []
+    for host in hosts:
+      host, port = host[:2]
+      kwargs['host'] = host
+      kwargs['port'] = port
+      # Our connections apply the timeouts set by `_execute`.
+      nodes.append(Node(connection_pool=ConnectionPool(
+        connection_class=Connection, **kwargs)))
+    return nodes
+
+  def _get_weights(self, hosts, options):
+    # Weights come from the `WEIGHTS` option, which maps node names to
+    # weights, and `host:port:weight` hosts in `LOCATION`.
+    weights = dict(options.get('WEIGHTS', {}))
+    for host in hosts:
+      if isinstance(host, tuple) and len(host) == 3:
+        weights['%s:%s' % host[:2]] = host[2]
+    try:
+      weights = {name: float(weight) for name, weight in weights.iteritems()}
+    except ValueError:
+      weights = None
+    if weights is None or any(weight <= 0 for weight in weights.itervalues()):
+      raise ImproperlyConfigured('Node weights must be positive numbers.')
+    return weights
+
+  def _load_ring_snapshot(self, path):
+    # returns the ring saved at `path`, or None if there's no valid snapshot
+    if not hasattr(self, '_ring_snapshot'):
+      self._ring_snapshot = None
+      try:
+        self._ring_snapshot = HashRing.load(path)
+      except IOError:
+        pass
+      except errors.InvalidRingSnapshot:
+        log.warning('Ignoring invalid ring snapshot %s' % path)
+    return self._ring_snapshot
+
+  def _get_ring(self, names, weights, snapshot_path=None):
+    """
+    Returns the ring for the nodes `names`. If `snapshot_path` is given, the
+    ring is loaded from the snapshot there when it matches the nodes and their
+    weights. Otherwise it's built and saved to `snapshot_path`.
+    """
+    if snapshot_path:
+      ring = self._load_ring_snapshot(snapshot_path)
+      if (ring is not None and
+          ring.num_virtual_nodes == DEFAULT_NUM_VIRTUAL_NODES and
+          ring.weights == {name: weights.get(name, 1) for name in names}):
+        return ring
+    ring = HashRing(names, weights=weights)
+    if snapshot_path:
+      try:
+        ring.dump(snapshot_path)
+      except (IOError, OSError):
+        log.warning('Failed to save ring snapshot %s' % snapshot_path,
+                    exc_info=True)
+    return ring
+
+  def _get_connection_pools(self):
+    return [node.connection_pool for node in self.node_to_name]
+
+  def _check_pid(self):
+    # Connections inherited from a parent process share their sockets with
+    # it. redis-py resets its pools after a fork too, but shuts those sockets
+    # down while doing so, which breaks them for the parent, so we drop them
+    # ourselves first.
+    if self._pid == os.getpid():
+      return
+    with self._fork_lock:
+      if self._pid == os.getpid():
+        return # Another thread already did the work.
+      for pool in self._get_connection_pools():
+        for connection in itertools.chain(pool._available_connections,
+                                          pool._in_use_connections):
+          if connection._sock is not None:
+            try:
+              connection._sock.close()
+            except socket.error:
+              pass
+            connection._sock = None
+        pool.reset()
+      if self.limiters is not None:
+        # Commands in flight in our parent don't count against us.
+        self.limiters = self._get_limiters()
+      # Our parent's Bloom filter pulls didn't survive the fork.
+      self._bloom_pulls = {}
+      self._bloom_lock = threading.Lock()
+      self._pid = os.getpid()
+
+  def _warmup_node(self, node, connections):
+    # yields a single (node name, report) pair, see `warmup`
+    pool = node.connection_pool
+    report = {'connect_times': [], 'scripts': 0, 'error': None}
+    opened = []
+    try:
+      for _ in xrange(connections):
+        opened.append(pool.get_connection('PING'))
+        start = time.time()
+        # Connecting also sends AUTH and SELECT.
+        self._execute(node, 'connect', (), opened[-1].connect)
+        report['connect_times'].append(time.time() - start)
+      for script, (sha1, nodes) in self._script_cache.items():
+        if not opened:
+          self._get_script_sha1(node, script)
+        elif node not in nodes:
+          # Load it on a connection we hold, the pool would open another one.
+          assert self._execute(node, 'script_load', (), functools.partial(
+            _call_on_connection, opened[0], 'SCRIPT', 'LOAD', script)) == sha1
+          nodes.add(node)
+        report['scripts'] += 1
+    except RedisError as e:
+      log.warning('Failed to warm up %s' % self.node_to_name[node],
+                  exc_info=True)
+      report['error'] = e
+    finally:
+      for connection in opened:
+        pool.release(connection)
+    yield self.node_to_name[node], report
+
+  def warmup(self, connections=None):
+    """
+    Opens `connections` (by default, the `WARMUP_CONNECTIONS` option)
+    connections to every node and loads all registered scripts on them, so
+    that the first requests served by this process don't pay for it. Nodes
+    are warmed up in parallel. Call this after forking, e.g. from gunicorn's
+    `post_fork` hook, or set the `WARMUP` option to do it on startup.
+
+    Returns a dict mapping each node to a dict with its `connect_times` (in
+    seconds), the number of `scripts` loaded and the `error` which stopped
+    its warm up, if any.
+    """
+    self._check_pid()
+    if connections is None:
+      connections = self.warmup_connections
+    return dict(self._imerge(self._warmup_node(node, connections)
+                             for node in self.node_to_name))
+
+  def register_script(self, script):
+    """
+    Registers a Lua script, which is loaded on every node by `warmup`.
+    Returns its SHA1.
+    """
+    return self._script_cache.setdefault(
+      script, (hashlib.sha1(script).hexdigest(), set()))[0]
+
+  def release_idle_connections(self):
+    """
+    Disconnects all connections which aren't currently in use.
+    """
+    self._check_pid()
+    for pool in self._get_connection_pools():
+      while True:
+        try:
+          connection = pool._available_connections.pop()
+        except IndexError:
+          break
+        pool._created_connections -= 1
+        connection.disconnect()
+
+  @contextmanager
+  def deadline(self, timeout):
+    """
+    Bounds the time spent by the commands this thread runs in the block,
+    including their fan-out to several nodes, pipelines and retries, to
+    `timeout` seconds in total. Socket timeouts are lowered to the time
+    left and commands which would start after the deadline raise
+    `DeadlineExceeded` instead. Nested deadlines can only shorten it.
+    """
+    previous = getattr(self._local, 'deadline', None)
+    deadline = time.time() + timeout
+    if previous is not None:
+      deadline = min(deadline, previous)
+    self._local.deadline = deadline
+    try:
+      yield
+    finally:
+      self._local.deadline = previous
+
+  @contextmanager
+  def priority(self, priority):
+    """
+    Runs the commands this thread sends in the block with `priority`, one of
+    `low`, `normal` (the default) or `critical`. With `MAX_IN_FLIGHT` set,
+    reads of lower priorities are shed first when a node is overloaded.
+    Writes and deletes aren't shed.
+    """
+    if priority not in PRIORITIES:
+      raise ValueError('Priority must be one of: %s.' % ', '.join(PRIORITIES))
+    previous = getattr(self._local, 'priority', None)
+    self._local.priority = priority
+    try:
+      yield
+    finally:
+      self._local.priority = previous
+
+  def _with_local(self, iterable, state):
+    # consumes `iterable` with this thread's deadline and priority set to
+    # `state`, e.g. from another thread
+    previous = self._local.__dict__.copy()
+    self._local.__dict__.update(state)
+    try:
+      for item in iterable:
+        yield item
+    finally:
+      self._local.__dict__.clear()
+      self._local.__dict__.update(previous)
+
+  def _imerge(self, iterables):
+    # `imerge`, with the current deadline and priority applied to its threads
+    state = self._local.__dict__.copy()
+    if not any(state.itervalues()):
+      return imerge(iterables)
+    return imerge(self._with_local(iterable, state) for iterable in iterables)
+
+  def _get_limiters(self):
+    return {node: ConcurrencyLimiter(self.max_in_flight, self.priority_shares)
+            for node in self.node_to_name}
+
+  def _acquire(self, node, command):
+    # takes a slot on `node`'s limiter, or raises `NodeOverloaded`. Commands
+    # other than `SHED_COMMANDS` run at critical priority and wait for as
+    # long as the deadline allows.
+    if command in RingClient.SHED_COMMANDS:
+      priority = getattr(self._local, 'priority', None) or 'normal'
+      timeout = self.max_queue_time
     else:
-      assert all(isinstance(host, tuple) and len(host) == 2 for host in hosts)
-      kwargs = self._get_node_kwargs(options)
-      nodes = []
-      for host, port in hosts:
-        kwargs['host'] = host
-        kwargs['port'] = port
-        nodes.append(StrictRedis(**kwargs))
-    self.name_to_node = {get_node_name(node): node for node in nodes}
-    self.ring = HashRing(self.name_to_node.keys())
-    self._script_cache = {}
+      priority, timeout = 'critical', None
+    deadline = getattr(self._local, 'deadline', None)
+    if deadline is not None:
+      left = deadline - time.time()
+      timeout = left if timeout is None else min(timeout, left)
+    if not self.limiters[node].acquire(priority, timeout):
+      raise errors.NodeOverloaded(
+        '%s has %d commands in flight, shedding a %s priority command.' %
+        (self.node_to_name.get(node), self.limiters[node].in_flight,
+         priority))
+
+  def _get_timeout(self, node, command):
+    # returns the socket timeout for `command`, or None to use the default
+    timeout = None
+    if (self.adaptive_timeouts is not None and
+        command in RingClient.ADAPTIVE_TIMEOUT_COMMANDS):
+      timeout = self.adaptive_timeouts[node].timeout
+    deadline = getattr(self._local, 'deadline', None)
+    if deadline is not None:
+      left = deadline - time.time()
+      if left <= 0:
+        raise errors.DeadlineExceeded('Deadline exceeded before %s on %s.' %
+                                      (command, self.node_to_name.get(node)))
+      timeout = left if timeout is None else min(timeout, left)
+    return timeout
+
+  def _execute(self, node, command, keys, func, values=()):
+    """
+    Runs `func`, which executes `command` for `keys` against `node`, and
+    returns its response. Every command djredis sends to Redis goes through
+    here. `values` are the values being written, if any.
+
+    Idempotent commands are retried up to `RETRIES` times on connection
+    errors and timeouts (by default, once on connection errors), see
+    `_execute_with_retries`. Others are never sent twice.
+    """
+    if command in RingClient.RETRY_COMMANDS:
+      return self._execute_with_retries(node, command, keys, func, values)
+    return self._execute_once(node, command, keys, func, values)
+
+  def _execute_with_retries(self, node, command, keys, func, values):
+    # Retries wait for a random time of up to `RETRY_BACKOFF` seconds,
+    # doubled for every attempt and capped at `RETRY_BACKOFF_MAX`, and are
+    # given up on if that would take us past the current deadline.
+    pipeline = getattr(getattr(func, 'func', func), '__self__', None)
+    if isinstance(pipeline, BasePipeline):
+      # Pipelines forget their commands once executed, even if they failed.
+      commands = list(pipeline.command_stack)
+    else:
+      pipeline = None
+    attempt = 0
+    while True:
+      try:
+        return self._execute_once(node, command, keys, func, values)
+      except (ConnectionError, TimeoutError) as e:
+        # Without `RETRIES`, connection errors are still retried once, like
+        # StrictRedis does: our idle connections die with their node.
+        retries = self.retries or int(isinstance(e, ConnectionError))
+        if attempt >= retries:
+          raise
+        delay = uniform(0, min(self.retry_backoff * 2 ** attempt,
+                               self.retry_backoff_max))
+        deadline = getattr(self._local, 'deadline', None)
+        if deadline is not None and time.time() + delay >= deadline:
+          raise
+        attempt += 1
+        signals.command_retried.send(
+          sender=self, command=command, node=self.node_to_name.get(node),
+          attempt=attempt, delay=delay, error=e)
+        # Only the failed connection is disconnected, other threads may be
+        # using the pool's. It reconnects when it's next used.
+        time.sleep(delay)
+        if pipeline is not None:
+          pipeline.command_stack = list(commands)
+
+  def _execute_once(self, node, command, keys, func, values):
+    self._check_pid()
+    if self.limiters is None:
+      return self._run(node, command, keys, func, values)
+    self._acquire(node, command)
+    try:
+      return self._run(node, command, keys, func, values)
+    finally:
+      self.limiters[node].release()
+
+  def _run(self, node, command, keys, func, values):
+    timeout = self._get_timeout(node, command)
+    tracked = (self.adaptive_timeouts is not None and
+               command in RingClient.ADAPTIVE_TIMEOUT_COMMANDS)
+    # Checking `receivers` directly avoids the locking in
+    # `Signal.has_listeners`, keeping this free when nobody is listening.
+    if (timeout is None and not tracked and
+        not signals.command_executed.receivers):
+      return func()
+    start = time.time()
+    try:
+      with command_timeout(timeout):
+        response = func()
+    except Exception as e:
+      duration = time.time() - start
+      if tracked:
+        # Timeouts count too, so a slower node gets a longer timeout.
+        self.adaptive_timeouts[node].add(duration)
+      if signals.command_executed.receivers:
+        self._send_command_executed(node, command, keys, values, None,
+                                    duration, e)
+      raise
+    duration = time.time() - start
+    if tracked:
+      self.adaptive_timeouts[node].add(duration)
+    if signals.command_executed.receivers:
+      self._send_command_executed(node, command, keys, values, response,
+                                  duration, None)
+    return response
+
+  def _send_command_executed(self, node, command, keys, values, response,
+                             duration, error):
+    hits = misses = 0
+    if command in RingClient.READ_COMMANDS and error is None:
+      responses = (response if isinstance(response, (list, tuple))
+                   else [response])
+      misses = sum(1 for value in responses if value is None)
+      hits = len(responses) - misses
+    signals.command_executed.send(
+      sender=self, command=command, node=self.node_to_name.get(node),
+      keys=keys, bytes_in=_get_size(response),
+      bytes_out=_get_size(keys) + _get_size(values), duration=duration,
+      hits=hits, misses=misses, error=error)
 
   def _get_script_sha1(self, node, script):
-    sha1, nodes = self._script_cache.setdefault(
-      script, (hashlib.sha1(script).hexdigest(), set()))
+    sha1 = self.register_script(script)
+    nodes = self._script_cache[script][1]
     if node not in nodes:
-      assert node.script_load(script) == sha1
+      assert self._execute(node, 'script_load', (),
+                           lambda: node.script_load(script)) == sha1
       nodes.add(node)
     return sha1
 
+  def _get_redis_version(self, node):
+    # Detected once per node, the first time a command needs it.
+    try:
+      return self._redis_versions[node]
+    except KeyError:
+      info = self._execute(node, 'info', (), lambda: node.info('server'))
+      version = str(info.get('redis_version', '0'))
+      version = tuple(int(x) for x in version.split('.')[:2])
+      self._redis_versions[node] = version
+      return version
+
+  def _supports_unlink(self, node):
+    # UNLINK frees memory in a background thread and is available since
+    # Redis 4.0.
+    return self._get_redis_version(node) >= (4, 0)
+
+  def _supports_field_expiry(self, node):
+    # HEXPIRE and HPTTL expire the fields of hashes and are available since
+    # Redis 7.4.
+    return self._get_redis_version(node) >= (7, 4)
+
   def _get_node_kwargs(self, options):
     try:
       db = int(options.get('DB', 0))
@@ -84,32 +659,530 @@ class RingClient(object):
   def get_node(self, key):
     return self.name_to_node[self.ring(key)]
 
+  def _get_previous_node(self, cache_key):
+    # returns the node which owned `cache_key` before resharding, or None if
+    # its owner didn't change
+    if self.previous_ring is None:
+      return None
+    name = self.previous_ring(cache_key)
+    if name == self.ring(cache_key):
+      return None
+    return self.previous_name_to_node[name]
+
+  def _get_moved_keys(self, items):
+    # groups (cache key, bucket, key) tuples by the previous owner of keys
+    # which moved
+    node_to_items = defaultdict(list)
+    for item in items:
+      node = self._get_previous_node(item[0])
+      if node is not None:
+        node_to_items[node].append(item)
+    return node_to_items
+
+  def _migrate(self, items, with_ttl=False):
+    """
+    Lazily migrates keys which moved since `PREVIOUS_LOCATION`. `items` is a
+    list of (cache key, bucket, key) tuples, where bucket is None for
+    top-level keys. Keys found on their previous owner are copied to their
+    new one along with their TTL (for tagged keys, their bucket's), unless
+    the new owner already has them. Returns a dict mapping the keys found to
+    their values, or (value, PTTL) pairs if `with_ttl` is set.
+    """
+    key_to_value = {}
+    node_to_copies = defaultdict(list)
+    for node, _items in self._get_moved_keys(items).iteritems():
+      pipeline = node.pipeline(transaction=False)
+      for _, bucket, key in _items:
+        if bucket is None:
+          pipeline.get(key)
+          pipeline.pttl(key)
+        else:
+          pipeline.hget(bucket, key)
+          pipeline.pttl(bucket)
+      responses = self._execute(node, 'migrate_get',
+                                [key for _, _, key in _items],
+                                pipeline.execute)
+      for item, value, ttl in zip(_items, responses[::2], responses[1::2]):
+        if value is not None:
+          key_to_value[item[2]] = (value, ttl) if with_ttl else value
+          node_to_copies[self.get_node(item[0])].append((item, value, ttl))
+    for node, copies in node_to_copies.iteritems():
+      pipeline = node.pipeline(transaction=False)
+      for (_, bucket, key), value, ttl in copies:
+        ttl = ttl if ttl > 0 else None
+        # NX so we never clobber a value written since the resharding.
+        if bucket is None:
+          pipeline.set(key, value, px=ttl, nx=True)
+        else:
+          pipeline.hsetnx(bucket, key, value)
+          if ttl:
+            pipeline.pexpire(bucket, ttl)
+      if self.bloom_filter is not None:
+        self._add_to_bloom_filter(pipeline, node,
+                                  [key for (_, _, key), _, _ in copies])
+      self._execute(node, 'migrate_set', [item[2] for item, _, _ in copies],
+                    pipeline.execute,
+                    values=[value for _, value, _ in copies])
+    return key_to_value
+
+  def _get_items(self, keys):
+    # returns (cache key, bucket, key) tuples for `keys`
+    cache_keys = [(self.get_cache_key(key), key) for key in keys]
+    buckets = self._get_buckets({cache_key for cache_key, key in cache_keys
+                                 if cache_key != key})
+    return [(cache_key, buckets.get(cache_key), key)
+            for cache_key, key in cache_keys]
+
+  def _forget_moved_keys(self, items):
+    # deletes keys which moved from their previous owner, so that stale
+    # values can't be migrated over newer writes/deletes
+    for node, _items in self._get_moved_keys(items).iteritems():
+      key_map = defaultdict(list)
+      for _, bucket, key in _items:
+        key_map[bucket].append(key)
+      self._delete_from_node(node, key_map)
+
+  def _get_bloom_bitmap(self, node):
+    # returns our copy of the Bloom filter of `node`, or None if it's
+    # unavailable. It's pulled the first time it's needed, then again in the
+    # background every `BLOOM_FILTER_REFRESH_INTERVAL` seconds.
+    bitmap, pulled_at = self._bloom_bitmaps.get(node, (None, None))
+    if pulled_at is None:
+      self._pull_bloom_bitmap(node)
+      return self._bloom_bitmaps[node][0]
+    if time.time() - pulled_at >= self.bloom_filter_refresh_interval:
+      with self._bloom_lock:
+        pulling = node in self._bloom_pulls
+        if not pulling:
+          self._bloom_pulls[node] = []
+      if not pulling:
+        thread = threading.Thread(target=self._pull_bloom_bitmap,
+                                  args=(node,), name='djredis-bloom-filter')
+        thread.daemon = True
+        thread.start()
+    return bitmap
+
+  def _pull_bloom_bitmap(self, node):
+    # pulls the Bloom filter of `node` into `_bloom_bitmaps`. The bits we set
+    # meanwhile are recorded in `_bloom_pulls` and set on the copy we pulled.
+    with self._bloom_lock:
+      self._bloom_pulls.setdefault(node, [])
+    try:
+      bitmap = self._execute(
+        node, 'bloom_filter', [RingClient.BLOOM_FILTER_KEY],
+        functools.partial(node.get, RingClient.BLOOM_FILTER_KEY))
+      if bitmap is None:
+        bitmap = self._create_bloom_filter(node)
+      else:
+        bitmap = bytearray(bitmap)
+      if bitmap is not None and not self.bloom_filter.is_marked(bitmap):
+        # It was evicted or deleted and recreated by SETBIT since, so it
+        # doesn't have older keys.
+        log.warning('The Bloom filter of %s is incomplete, it must be '
+                    'rebuilt with `rebuild_bloom_filters`.' %
+                    self.node_to_name[node])
+        bitmap = None
+    except (errors.DJRedisError, RedisError):
+      log.warning('Failed to pull the Bloom filter of %s' %
+                  self.node_to_name[node], exc_info=True)
+      bitmap = None
+    with self._bloom_lock:
+      positions = self._bloom_pulls.pop(node, [])
+      if bitmap is not None:
+        BloomFilter.set_bits(bitmap, positions)
+      self._bloom_bitmaps[node] = (bitmap, time.time())
+
+  def _create_bloom_filter(self, node):
+    # creates the missing Bloom filter of `node` and returns it, if the node
+    # holds none of our keys yet so the filter is complete. Otherwise returns
+    # None: the filter must be rebuilt.
+    if any(not name.startswith('djredis:') for name in
+           node.scan_iter(count=100)):
+      return None
+    bitmap = bytearray()
+    self.bloom_filter.mark(bitmap)
+    self._execute(node, 'setbit', [RingClient.BLOOM_FILTER_KEY],
+                  functools.partial(node.setbit, RingClient.BLOOM_FILTER_KEY,
+                                    self.bloom_filter.num_bits, 1))
+    return bitmap
+
+  def _rebuild_bloom_filter(self, node, count):
+    # yields the number of keys in the rebuilt Bloom filter of `node`
+    bitmap = bytearray()
+    num_keys = 0
+    for _, key in self._scan_node(node, '*', count):
+      if not key.startswith('djredis:'):
+        BloomFilter.set_bits(bitmap, self.bloom_filter.get_positions(key))
+        num_keys += 1
+    self.bloom_filter.mark(bitmap)
+    # OR it into the filter, which keeps the keys written since we scanned.
+    pipeline = node.pipeline(transaction=False)
+    pipeline.set(RingClient.BLOOM_FILTER_REBUILD_KEY, bytes(bitmap))
+    pipeline.bitop('OR', RingClient.BLOOM_FILTER_KEY,
+                   RingClient.BLOOM_FILTER_KEY,
+                   RingClient.BLOOM_FILTER_REBUILD_KEY)
+    pipeline.delete(RingClient.BLOOM_FILTER_REBUILD_KEY)
+    self._execute(node, 'bloom_filter', [RingClient.BLOOM_FILTER_KEY],
+                  pipeline.execute)
+    with self._bloom_lock:
+      self._bloom_bitmaps.pop(node, None) # Pulled again when next needed.
+    yield num_keys
+
+  def rebuild_bloom_filters(self, count=None):
+    """
+    Rebuilds the Bloom filter of every node from the keys it holds, found
+    with SCAN/HSCAN. A filter which was evicted or deleted is recreated
+    without the keys written before, so it's ignored until it's rebuilt, and
+    so is one built with other `BLOOM_FILTER_BITS`. Nodes are rebuilt in
+    parallel and `count` is passed to SCAN as a hint of the batch size.
+    Returns the number of keys added.
+    """
+    if self.bloom_filter is None:
+      raise ImproperlyConfigured('`BLOOM_FILTER` must be set to rebuild Bloom '
+                                 'filters.')
+    return sum(self._imerge(self._rebuild_bloom_filter(node, count)
+                            for node in self.name_to_node.itervalues()))
+
+  def _may_exist(self, cache_key, key):
+    """
+    Returns False if `key` is known to be missing, so there's no need to ask
+    Redis for it: either it missed less than `NEGATIVE_CACHE_TIMEOUT` seconds
+    ago, or it isn't in its node's Bloom filter.
+
+    NOTE: Keys written by other processes are only seen once the negative
+    cache entry expires or the Bloom filter is pulled again. The Bloom filter
+    must also be enabled before any keys are written, since keys written
+    without it aren't in the filter.
+    """
+    if self.negative_cache is not None and key in self.negative_cache:
+      return False
+    if self.bloom_filter is None:
+      return True
+    if (self.previous_ring is not None and
+        self._get_previous_node(cache_key) is not None):
+      return True # Not in its new node's filter until it's migrated.
+    bitmap = self._get_bloom_bitmap(self.get_node(cache_key))
+    return bitmap is None or self.bloom_filter.contains(bitmap, key)
+
+  def _add_to_bloom_filter(self, pipeline, node, keys):
+    # adds `keys` to `node`'s Bloom filter as part of `pipeline`, and to our
+    # copy of it so we see our own writes straight away
+    if node not in self._bloom_bitmaps:
+      self._get_bloom_bitmap(node) # Creates the filter of an empty node.
+    with self._bloom_lock:
+      bitmap = self._bloom_bitmaps.get(node, (None, 0))[0]
+      pulling = self._bloom_pulls.get(node)
+      for key in keys:
+        positions = self.bloom_filter.get_positions(key)
+        for position in positions:
+          pipeline.setbit(RingClient.BLOOM_FILTER_KEY, position, 1)
+        if bitmap is not None:
+          BloomFilter.set_bits(bitmap, positions)
+        if pulling is not None:
+          pulling.extend(positions)
+
+  def _note_missing(self, keys):
+    if self.negative_cache is not None and keys:
+      self.negative_cache.add(keys)
+
+  def _note_written(self, items):
+    # updates the negative cache and Bloom filters after writing `items`,
+    # (cache key, bucket, key) tuples, unless `_set_on_node`/`set_many` did
+    if self.negative_cache is not None:
+      self.negative_cache.discard([key for _, _, key in items])
+    if self.bloom_filter is None:
+      return
+    node_to_keys = defaultdict(list)
+    for cache_key, _, key in items:
+      node_to_keys[self.get_node(cache_key)].append(key)
+    for node, keys in node_to_keys.iteritems():
+      pipeline = node.pipeline(transaction=False)
+      self._add_to_bloom_filter(pipeline, node, keys)
+      self._execute(node, 'setbit', keys, pipeline.execute)
+
+  def _get_replicas(self, cache_key):
+    # returns all nodes which hold a copy of `cache_key`, primary first
+    expires_at = self.replicated_keys.get(cache_key, 0)
+    if expires_at is None or expires_at > time.time():
+      return [self.name_to_node[name] for name in
+              self.ring.get_nodes(cache_key, self.hot_key_replicas)]
+    if expires_at:
+      self.replicated_keys.pop(cache_key, None)
+    return [self.get_node(cache_key)]
+
+  def replicate_key(self, key, timeout=None):
+    """
+    Marks `key` as hot: from now on (or for `timeout` seconds) it's written
+    to `HOT_KEY_REPLICAS` nodes (found at successive positions on the ring)
+    and read from a random one of them. For tagged keys, the whole tag bucket
+    is replicated.
+
+    NOTE: Processes which don't replicate a key only write it to its primary,
+    leaving stale copies on its replicas. To bound how long those are read,
+    copies on replicas expire after at most `HOT_KEY_REPLICA_TIMEOUT` seconds
+    (60 by default, 0 means they're kept as long as the primary's).
+    """
+    self.replicated_keys[self.get_cache_key(key)] = (
+      None if timeout is None else time.time() + timeout)
+
+  def unreplicate_key(self, key):
+    """
+    Stops replicating `key`. Its copies on replicas are left to expire.
+    """
+    self.replicated_keys.pop(self.get_cache_key(key), None)
+
+  def _get_replica_timeout(self, ex):
+    # returns the TTL for a copy of a hot key on a replica, given the
+    # primary's (None for no expiry)
+    if not self.hot_key_replica_timeout:
+      return ex
+    return min(ex or self.hot_key_replica_timeout,
+               self.hot_key_replica_timeout)
+
+  def _write_replicas(self, nodes, bucket, key, value, ex, copy):
+    # Writes a hot key to its replicas other than the primary, once the
+    # primary is written. `copy` tells whether the primary now holds `value`;
+    # otherwise (INCRBY, a SET NX which failed) its value isn't known, so the
+    # replicas' copies are dropped instead.
+    for node in nodes:
+      if copy:
+        self._set_on_node(node, bucket, key, value, False,
+                          self._get_replica_timeout(ex), False)
+      else:
+        self._delete_from_node(node, {bucket: [key]})
+
+  def _replicate_published_hot_keys(self):
+    # Replicates keys which receive at least `HOT_KEY_AUTO_SHARE` of their
+    # node's reads, according to the cluster-wide published hot keys. Since
+    # all processes see the same data they converge on the same keys. Keys
+    # stay replicated until the second publish which doesn't list them.
+    now = time.time()
+    for cache_key, expires_at in self.replicated_keys.items():
+      if expires_at is not None and expires_at <= now:
+        self.replicated_keys.pop(cache_key, None)
+    if not self.hot_key_auto_share:
+      return
+    node_to_reads = defaultdict(list)
+    hot_keys = self.get_published_hot_keys(self.profiler.capacity)
+    for (name, command), keys in hot_keys.iteritems():
+      if command in RingClient.READ_COMMANDS:
+        node_to_reads[name].extend(keys)
+    for keys in node_to_reads.itervalues():
+      total = sum(count for _, count, _ in keys)
+      for key, count, _ in keys:
+        # Keys replicated for good (e.g. `HOT_KEYS`) stay that way.
+        if (count >= self.hot_key_auto_share * total and
+            self.replicated_keys.get(self.get_cache_key(key), 0) is not None):
+          self.replicate_key(
+            key, timeout=2 * self.profiler.publish_interval)
+
   def get_cache_key(self, key):
+    """
+    Returns the key which routes `key`: its tag bucket for tagged keys, its
+    pack bucket for untagged keys when `PACK_BUCKETS` is set, or else `key`.
+
+    With `PACK_BUCKETS` set to N, untagged keys are spread over N hash
+    buckets by the CRC32 of their name and stored as fields, reusing the tag
+    bucket commands. Redis stores small hashes as a compact listpack (up to
+    `hash-max-listpack-entries` fields of `hash-max-listpack-value` bytes),
+    which takes far less memory than a top-level key per value, so pick N
+    to keep buckets under that many keys.
+
+    Unlike tagged keys, which share their bucket's TTL, packed keys expire
+    on their own with HEXPIRE, so keys with a timeout can only be packed on
+    Redis 7.4 or later.
+    """
     if settings.DJREDIS_ENABLE_TAGGING:
       match = settings.DJREDIS_TAG_REGEX.match(key)
       if match:
         return '{%s}' % match.group(1)
+    if self.pack_buckets:
+      return '%s%d}' % (RingClient.PACK_BUCKET_PREFIX,
+                        (zlib.crc32(key) & 0xffffffff) % self.pack_buckets)
     return key
 
+  def _is_pack_bucket(self, name):
+    return name.startswith(RingClient.PACK_BUCKET_PREFIX)
+
+  def _expire_packed_keys(self, pipeline, node, bucket, keys, ex):
+    # Packed keys expire on their own, as fields of their bucket. Only checks
+    # that `node` supports it if `pipeline` is None.
+    if not self._supports_field_expiry(node):
+      raise ImproperlyConfigured('`PACK_BUCKETS` requires Redis 7.4 or later '
+                                 'for keys with a timeout.')
+    if pipeline is not None:
+      pipeline.execute_command('HEXPIRE', bucket, ex, 'FIELDS', len(keys),
+                               *keys)
+
+  def _get_version_key(self, tag_key):
+    return '%s:version' % tag_key
+
+  def _get_tag_versions(self, tag_keys):
+    """
+    Returns a dict mapping each tag key to its current version. Versions are
+    cached in-process for `DJREDIS_TAG_VERSION_TIMEOUT` seconds and the ones
+    missing from that cache are fetched with a single MGET per node.
+    """
+    now = time.time()
+    versions = {}
+    node_to_keys = defaultdict(list)
+    for tag_key in tag_keys:
+      version, expires_at = self._tag_versions.get(tag_key, (None, 0))
+      if expires_at > now:
+        versions[tag_key] = version
+      else:
+        node_to_keys[self.get_node(tag_key)].append(tag_key)
+    expires_at = now + settings.DJREDIS_TAG_VERSION_TIMEOUT
+    for node, _tag_keys in node_to_keys.iteritems():
+      version_keys = [self._get_version_key(tag_key) for tag_key in _tag_keys]
+      values = dict(self._mget_from_node(node, {None: version_keys}))
+      values = [values[version_key] for version_key in version_keys]
+      if self.previous_ring is not None and None in values:
+        migrated = self._migrate(
+          [(tag_key, None, version_key) for tag_key, version_key, value in
+           zip(_tag_keys, version_keys, values) if value is None])
+        values = [migrated.get(version_key, value)
+                  for version_key, value in zip(version_keys, values)]
+      if None in values:
+        started = self._start_tag_versions(
+          node, [version_key for version_key, value in
+                 zip(version_keys, values) if value is None])
+        values = [started.get(version_key, value)
+                  for version_key, value in zip(version_keys, values)]
+      for tag_key, version in zip(_tag_keys, values):
+        versions[tag_key] = int(version)
+        self._tag_versions[tag_key] = (versions[tag_key], expires_at)
+    return versions
+
+  def _start_tag_versions(self, node, version_keys):
+    # Starts the missing `version_keys` on `node` at an epoch, the current
+    # time in microseconds, and returns a dict mapping them to their versions
+    # (another process may have started them first). Since a version key may
+    # be evicted, starting it at 0 would bring back buckets which were
+    # already invalidated.
+    epoch = int(time.time() * 1000000)
+    pipeline = node.pipeline(transaction=False)
+    for version_key in version_keys:
+      pipeline.set(version_key, epoch, nx=True)
+      pipeline.get(version_key)
+    responses = self._execute(node, 'setnx', version_keys, pipeline.execute)
+    return dict(zip(version_keys, responses[1::2]))
+
+  def _incr_tag_versions(self, tag_keys):
+    if self.previous_ring is not None:
+      self._migrate([(tag_key, None, self._get_version_key(tag_key))
+                     for tag_key in tag_keys])
+    node_to_keys = defaultdict(list)
+    for tag_key in tag_keys:
+      node_to_keys[self.get_node(tag_key)].append(tag_key)
+    expires_at = time.time() + settings.DJREDIS_TAG_VERSION_TIMEOUT
+    for node, _tag_keys in node_to_keys.iteritems():
+      version_keys = [self._get_version_key(tag_key) for tag_key in _tag_keys]
+      # Missing versions are started like `_start_tag_versions` does.
+      epoch = int(time.time() * 1000000)
+      pipeline = node.pipeline(transaction=False)
+      for version_key in version_keys:
+        pipeline.set(version_key, epoch, nx=True)
+        pipeline.incr(version_key)
+      versions = self._execute(node, 'incr', version_keys,
+                               pipeline.execute)[1::2]
+      for tag_key, version in zip(_tag_keys, versions):
+        self._tag_versions[tag_key] = (version, expires_at)
+    return len(tag_keys)
+
+  def _get_buckets(self, tag_keys):
+    """
+    Returns a dict mapping each tag key to the name of the hash bucket that
+    currently holds its keys. Pack buckets aren't versioned.
+    """
+    if not settings.DJREDIS_ENABLE_TAG_VERSIONING:
+      return {tag_key: tag_key for tag_key in tag_keys}
+    buckets = {}
+    versioned = []
+    for tag_key in tag_keys:
+      if self._is_pack_bucket(tag_key):
+        buckets[tag_key] = tag_key
+      else:
+        versioned.append(tag_key)
+    # NOTE: Versions start at an epoch (see `_start_tag_versions`), so if a
+    # version key is evicted its tag moves on to a new bucket instead of
+    # going back to an invalidated one. Versions only collide if the tag was
+    # deleted more than once per microsecond on average since it started, or
+    # the clocks of our processes are further apart than that.
+    if versioned:
+      buckets.update((tag_key, '%s:%d' % (tag_key, version))
+                     for tag_key, version in
+                     self._get_tag_versions(versioned).iteritems())
+    return buckets
+
+  def _get_bucket(self, tag_key):
+    return self._get_buckets([tag_key])[tag_key]
+
   def _broadcast(self, attr, *args, **kwargs):
     response = {}
     # TODO(usmanm): Parallelize this?
     for name, node in self.name_to_node.iteritems():
-      response[name] = getattr(node, attr)(*args, **kwargs)
+      response[name] = self._execute(
+        node, attr, (), functools.partial(getattr(node, attr), *args,
+                                          **kwargs))
     return response
 
   def _route(self, attr, *args, **kwargs):
     assert len(args) > 0 or len(kwargs) > 0
-    return getattr(self.get_node(args[0]), attr)(*args, **kwargs)
+    node = self.get_node(args[0])
+    response = self._execute(
+      node, attr, args[:1], functools.partial(getattr(node, attr), *args,
+                                              **kwargs),
+      values=args[1:])
+    if attr == 'getset':
+      self._note_written([(args[0], None, args[0])])
+    return response
 
   def _tag_route(self, attr, *args, **kwargs):
     assert len(args) > 0 or len(kwargs) > 0
-    cache_key = self.get_cache_key(args[0])
-    if cache_key != args[0]:
-      attr = 'h%s' % attr # Call analagous hashes command.
-      args = list(args)
-      args.insert(0, cache_key)
-    return getattr(self.get_node(cache_key), attr)(*args, **kwargs)
+    key, values = args[0], args[1:]
+    cache_key = self.get_cache_key(key)
+    nodes = self._get_replicas(cache_key)
+    if attr in RingClient.REPLICA_READ_METHODS:
+      nodes = [choice(nodes)]
+    command, bucket = attr, None
+    if cache_key != key:
+      command = 'h%s' % attr # Call analagous hashes command.
+      bucket = self._get_bucket(cache_key)
+      args = [bucket] + list(args)
+    item = (cache_key, bucket, key)
+    if (attr in RingClient.REPLICA_READ_METHODS and
+        not self._may_exist(cache_key, key)):
+      return False if attr == 'exists' else None
+    if self.previous_ring is not None:
+      if attr in ('incrby', 'setnx'):
+        self._migrate([item])
+      elif attr == 'set':
+        self._forget_moved_keys([item])
+    # SET NX isn't idempotent, so it mustn't be retried like SET.
+    name = 'setnx' if command == 'set' and kwargs.get('nx') else command
+    response = self._execute(nodes[0], name, [key],
+                             functools.partial(getattr(nodes[0], command),
+                                               *args, **kwargs),
+                             values=values)
+    if len(nodes) > 1:
+      # Writes to hot keys go to all replicas, the primary's response wins.
+      copy = ((attr == 'set' and not kwargs.get('nx')) or
+              (attr in ('set', 'setnx') and bool(response)))
+      self._write_replicas(nodes[1:], bucket, key,
+                           values[0] if values else None,
+                           kwargs.get('ex'), copy)
+    if (self.previous_ring is not None and
+        attr in RingClient.REPLICA_READ_METHODS and not response):
+      migrated = self._migrate([item])
+      if key in migrated:
+        response = True if attr == 'exists' else migrated[key]
+    if attr in RingClient.REPLICA_READ_METHODS:
+      if not response:
+        self._note_missing([key])
+    else:
+      self._note_written([item])
+    return response
 
   def __getattr__(self, attr):
     if attr in RingClient.BROADCAST_METHODS:
@@ -121,26 +1194,48 @@ class RingClient(object):
     raise AttributeError("'%s' object has no attribute '%s'" %
                          (self.__class__.__name__, attr))
 
-  def _get_node_to_key_map(self, keys):
+  def _group_keys(self, keys):
+    # splits top-level keys into lists which a single multi-key command
+    # (MGET, DEL) may be sent for
+    return [keys]
+
+  def _get_node_to_key_map(self, keys, write=False):
+    # Maps keys to their node and hash bucket (or None). Hot keys are mapped
+    # to all their replicas when writing, and to a random one when reading.
     node_to_keys = defaultdict(lambda: defaultdict(list))
-    for key in keys:
-      cache_key = self.get_cache_key(key)
-      if cache_key != key:
-        node_to_keys[self.get_node(cache_key)][cache_key].append(key)
-      else:
-        node_to_keys[self.get_node(cache_key)][None].append(key)
+    cache_keys = [(self.get_cache_key(key), key) for key in keys]
+    buckets = self._get_buckets({cache_key for cache_key, key in cache_keys
+                                 if cache_key != key})
+    for cache_key, key in cache_keys:
+      nodes = self._get_replicas(cache_key)
+      for node in (nodes if write else [choice(nodes)]):
+        node_to_keys[node][buckets.get(cache_key)].append(key)
     return node_to_keys
 
-  def delete(self, *keys):
-    node_to_keys = self._get_node_to_key_map(keys)
-    count = 0
-    for node, key_map in node_to_keys.iteritems():
-      for bucket, keys in key_map.iteritems():
+  def _delete_from_node(self, node, key_map):
+    """
+    Deletes keys from `node` using a single pipeline. `key_map` maps a hash
+    bucket (or None for top-level keys) to the keys to delete from it. Large
+    argument lists are split into chunks of `DELETE_CHUNK_SIZE` keys.
+    """
+    command = 'UNLINK' if self._supports_unlink(node) else 'DEL'
+    pipeline = node.pipeline(transaction=False)
+    for bucket, keys in key_map.iteritems():
+      for chunk in _chunks(keys, self.delete_chunk_size):
         if bucket is None:
-          count += node.delete(*keys)
+          for group in self._group_keys(chunk):
+            pipeline.execute_command(command, *group)
         else:
-          count += node.hdel(bucket, *keys)
-    return count
+          pipeline.hdel(bucket, *chunk)
+    keys = list(itertools.chain(*key_map.itervalues()))
+    return sum(self._execute(node, 'delete', keys, pipeline.execute))
+
+  def delete(self, *keys):
+    node_to_keys = self._get_node_to_key_map(keys, write=True)
+    if self.previous_ring is not None:
+      self._forget_moved_keys(self._get_items(keys))
+    return sum(self._delete_from_node(node, key_map)
+               for node, key_map in node_to_keys.iteritems())
 
   def delete_tag(self, *tags):
     if not settings.DJREDIS_ENABLE_TAGGING:
@@ -150,43 +1245,487 @@ class RingClient(object):
       if settings.DJREDIS_TAG_REGEX.match(tag):
         raise errors.InvalidKey('%s: a tag cannot contain a tag.' % tag)
       keys_to_delete.append('{%s}' % tag)
+    if settings.DJREDIS_ENABLE_TAG_VERSIONING:
+      # Invalidate all keys in the tag by bumping its version, instead of
+      # deleting its (possibly huge) bucket.
+      return self._incr_tag_versions(keys_to_delete)
     node_to_keys = defaultdict(list)
     for key in keys_to_delete:
-      node_to_keys[self.get_node(key)].append(key)
-    num_deleted = 0
-    for node, keys in node_to_keys.iteritems():
-      num_deleted += node.delete(*keys)
-    return num_deleted
+      for node in self._get_replicas(key):
+        node_to_keys[node].append(key)
+    if self.previous_ring is not None:
+      self._forget_moved_keys([(key, None, key) for key in keys_to_delete])
+    return sum(self._delete_from_node(node, {None: keys})
+               for node, keys in node_to_keys.iteritems())
+
+  def _get_keys_to_fetch(self, keys):
+    # returns the keys which aren't known to be missing, see `_may_exist`
+    if self.negative_cache is None and self.bloom_filter is None:
+      return keys
+    return [key for key in keys if self._may_exist(self.get_cache_key(key),
+                                                   key)]
+
+  def _mget_from_node(self, node, key_map, chunk_size=None):
+    # yields (key, value) pairs for the keys in `key_map`, fetched from `node`
+    # with a MGET/HMGET per bucket, or per `chunk_size` keys of a bucket
+    for bucket, keys in key_map.iteritems():
+      for chunk in (_chunks(keys, chunk_size) if chunk_size else [keys]):
+        if bucket is None:
+          groups = self._group_keys(chunk)
+          if len(groups) == 1:
+            values = self._execute(node, 'mget', chunk,
+                                   functools.partial(node.mget, chunk))
+          else:
+            pipeline = node.pipeline(transaction=False)
+            for group in groups:
+              pipeline.mget(group)
+            chunk = list(itertools.chain(*groups))
+            values = list(itertools.chain(*self._execute(
+              node, 'mget', chunk, pipeline.execute)))
+        else:
+          values = self._execute(node, 'hmget', chunk,
+                                 functools.partial(node.hmget, bucket, chunk))
+        for item in zip(chunk, values):
+          yield item
 
   def mget(self, keys, *args):
     keys = _combine_into_list(keys, args)
-    node_to_keys = self._get_node_to_key_map(keys)
-    key_to_value = {}
+    key_to_value = dict.fromkeys(keys)
+    node_to_keys = self._get_node_to_key_map(self._get_keys_to_fetch(keys))
     for node, key_map in node_to_keys.iteritems():
+      key_to_value.update(self._mget_from_node(node, key_map))
+    if self.previous_ring is not None:
+      key_to_value.update(self._migrate(self._get_items(
+        [key for key in keys if key_to_value[key] is None])))
+    self._note_missing([key for key, value in key_to_value.iteritems()
+                        if value is None])
+    return [key_to_value[key] for key in keys]
+
+  def iter_mget(self, keys, chunk_size=None):
+    """
+    Like `mget`, but yields (key, value) pairs as each node responds instead
+    of returning a list once all nodes have. Nodes are queried in parallel,
+    and if `chunk_size` is set keys are fetched from each node `chunk_size`
+    at a time, which bounds the number of values held in memory. Missing
+    keys are yielded last, with None values.
+    """
+    keys = _combine_into_list(keys, [])
+    keys_to_fetch = self._get_keys_to_fetch(keys)
+    missing = list(set(keys) - set(keys_to_fetch))
+    node_to_keys = self._get_node_to_key_map(keys_to_fetch)
+    for key, value in self._imerge(
+        self._mget_from_node(node, key_map, chunk_size)
+        for node, key_map in node_to_keys.iteritems()):
+      if value is None:
+        missing.append(key)
+      else:
+        yield key, value
+    if self.previous_ring is not None and missing:
+      migrated = self._migrate(self._get_items(missing))
+      for key, value in migrated.iteritems():
+        yield key, value
+      missing = [key for key in missing if key not in migrated]
+    self._note_missing(missing)
+    for key in missing:
+      yield key, None
+
+  def mget_with_ttl(self, keys, *args):
+    """
+    Like `mget`, but returns a list of (value, ttl) pairs, where ttl is the
+    number of milliseconds the key has left to live (for tagged keys, their
+    bucket's), or None if it's missing or doesn't expire. Values and TTLs
+    are fetched with a single pipeline per node.
+    """
+    keys = _combine_into_list(keys, args)
+    key_to_value = dict.fromkeys(keys, (None, None))
+    node_to_keys = self._get_node_to_key_map(self._get_keys_to_fetch(keys))
+    for node, key_map in node_to_keys.iteritems():
+      pipeline = node.pipeline(transaction=False)
       for bucket, _keys in key_map.iteritems():
         if bucket is None:
-          key_to_value.update(dict(zip(_keys, node.mget(_keys))))
+          groups = self._group_keys(_keys)
+          for group in groups:
+            pipeline.mget(group)
+          for key in itertools.chain(*groups):
+            pipeline.pttl(key)
+        elif self._is_pack_bucket(bucket) and self._supports_field_expiry(node):
+          pipeline.hmget(bucket, _keys)
+          pipeline.execute_command('HPTTL', bucket, 'FIELDS', len(_keys),
+                                   *_keys)
         else:
-          key_to_value.update(dict(zip(_keys, node.hmget(bucket, _keys))))
-    return [key_to_value[key] for key in keys]
+          pipeline.hmget(bucket, _keys)
+          pipeline.pttl(bucket)
+      responses = iter(self._execute(
+        node, 'mget_with_ttl', list(itertools.chain(*key_map.itervalues())),
+        pipeline.execute))
+      for bucket, _keys in key_map.iteritems():
+        if bucket is None:
+          _keys = list(itertools.chain(*groups))
+          values = list(itertools.chain(*(next(responses) for _ in groups)))
+          ttls = [next(responses) for _ in _keys]
+        else:
+          values = next(responses)
+          ttls = next(responses)
+          if not isinstance(ttls, list): # The bucket's, see above.
+            ttls = [ttls] * len(_keys)
+        key_to_value.update(zip(_keys, zip(values, ttls)))
+    if self.previous_ring is not None:
+      key_to_value.update(self._migrate(self._get_items(
+        [key for key in keys if key_to_value[key][0] is None]), with_ttl=True))
+    self._note_missing([key for key, (value, _) in key_to_value.iteritems()
+                        if value is None])
+    # PTTL is -1 for keys without an expiry and -2 for missing ones.
+    return [(value, ttl if value is not None and ttl >= 0 else None)
+            for value, ttl in (key_to_value[key] for key in keys)]
+
+  def _set_on_node(self, node, bucket, key, value, nx, ex, primary):
+    bloom = self.bloom_filter is not None and primary
+    if bucket is None and not bloom:
+      return self._execute(node, 'setnx' if nx else 'set', [key],
+                           functools.partial(node.set, key, value, nx=nx,
+                                             ex=ex),
+                           values=[value])
+    pipeline = node.pipeline(transaction=False)
+    if bucket is None:
+      pipeline.set(key, value, nx=nx, ex=ex)
+    elif nx:
+      pipeline.hsetnx(bucket, key, value)
+    else:
+      pipeline.hset(bucket, key, value)
+    pack = bucket is not None and self._is_pack_bucket(bucket)
+    if ex and pack:
+      # A field which HSETNX didn't set must keep its TTL, so it's only
+      # expired below once it's set.
+      self._expire_packed_keys(None if nx else pipeline, node, bucket, [key],
+                               ex)
+    elif ex and bucket is not None:
+      pipeline.expire(bucket, ex)
+    if bloom:
+      self._add_to_bloom_filter(pipeline, node, [key])
+    if bucket is None:
+      command = 'setnx' if nx else 'set'
+    else:
+      command = 'hsetnx' if nx else 'hset'
+    response = self._execute(node, command, [key], pipeline.execute,
+                             values=[value])[0]
+    if ex and pack and nx and response:
+      pipeline = node.pipeline(transaction=False)
+      self._expire_packed_keys(pipeline, node, bucket, [key], ex)
+      self._execute(node, 'hexpire', [key], pipeline.execute)
+    return response
+
+  def set_many(self, mapping, ex=None):
+    """
+    Sets all keys in `mapping` to their values, with a single pipeline per
+    node. Keys expire after `ex` seconds (for tagged keys, their buckets).
+    """
+    items = self._get_items(mapping.keys())
+    if self.previous_ring is not None:
+      self._forget_moved_keys(items)
+    if self.negative_cache is not None:
+      self.negative_cache.discard(mapping.keys())
+    node_to_items = defaultdict(list)
+    for item in items:
+      # Hot keys are also written to their replicas, see `_write_replicas`.
+      for i, node in enumerate(self._get_replicas(item[0])):
+        node_to_items[node].append(item + (i == 0,))
+    for node, _items in node_to_items.iteritems():
+      pipeline = node.pipeline(transaction=False)
+      buckets = {}
+      for _, bucket, key, primary in _items:
+        timeout = ex if primary else self._get_replica_timeout(ex)
+        if bucket is None:
+          pipeline.set(key, mapping[key], ex=timeout)
+        else:
+          pipeline.hset(bucket, key, mapping[key])
+          buckets.setdefault(bucket, (timeout, []))[1].append(key)
+      for bucket, (timeout, keys) in buckets.iteritems():
+        if timeout and self._is_pack_bucket(bucket):
+          self._expire_packed_keys(pipeline, node, bucket, keys, timeout)
+        elif timeout:
+          pipeline.expire(bucket, timeout)
+      if self.bloom_filter is not None:
+        self._add_to_bloom_filter(pipeline, node,
+                                  [key for _, _, key, primary in _items
+                                   if primary])
+      self._execute(node, 'set_many', [key for _, _, key, _ in _items],
+                    pipeline.execute,
+                    values=[mapping[key] for _, _, key, _ in _items])
 
   def _set(self, key, value, nx=False, ex=False):
     cache_key = self.get_cache_key(key)
-    node = self.get_node(cache_key)
-    if cache_key == key:
-      return node.set(key, value, nx=nx, ex=ex)
-    if nx:
-      value = node.hsetnx(cache_key, key, value)
-    else:
-      value = node.hset(cache_key, key, value)
-    if ex:
-      node.expire(cache_key, ex)
-    return value
+    bucket = self._get_bucket(cache_key) if cache_key != key else None
+    if self.previous_ring is not None:
+      if nx:
+        self._migrate([(cache_key, bucket, key)])
+      else:
+        self._forget_moved_keys([(cache_key, bucket, key)])
+    if self.negative_cache is not None:
+      self.negative_cache.discard([key])
+    nodes = self._get_replicas(cache_key)
+    response = self._set_on_node(nodes[0], bucket, key, value, nx, ex, True)
+    # Hot keys are also written to their replicas, the primary's response
+    # wins.
+    self._write_replicas(nodes[1:], bucket, key, value, ex,
+                         not nx or bool(response))
+    return response
 
   def keys(self, pattern='*'):
-    return list(itertools.chain(*(node.keys(pattern) for node in
+    """
+    Returns all top-level keys (including hash buckets) matching `pattern`.
+    """
+    self._check_pid()
+    return list(itertools.chain(*(node.scan_iter(pattern) for node in
                                   self.name_to_node.itervalues())))
 
+  def _scan_node(self, node, pattern, count):
+    # yields (bucket, key) pairs, where bucket is None for top-level keys
+    self._check_pid()
+    tag_regex = settings.DJREDIS_TAG_REGEX
+    tagging = settings.DJREDIS_ENABLE_TAGGING
+    for key in node.scan_iter(match=pattern, count=count):
+      # Untagged keys never match the tag regex, so anything that does is a
+      # hash bucket or a tag version key.
+      if not (tagging and tag_regex.match(key) or self._is_pack_bucket(key)):
+        yield None, key
+    if tagging:
+      match = '{*}*'
+    elif self.pack_buckets:
+      match = '%s*' % RingClient.PACK_BUCKET_PREFIX
+    else:
+      return
+    for name in node.scan_iter(match=match, count=count):
+      tag_key = name[:name.rindex('}') + 1]
+      if name != self._get_bucket(tag_key):
+        continue # Tag version key or bucket for an older version.
+      for key, _ in node.hscan_iter(name, match=pattern, count=count):
+        yield name, key
+
+  def scan_iter(self, pattern='*', count=None):
+    """
+    Yields all keys matching `pattern`, including ones stored in tag buckets.
+    Nodes are scanned in parallel using SCAN/HSCAN and keys are yielded as
+    they arrive. `count` is passed to SCAN as a hint of the batch size.
+    """
+    return (key for _, key in
+            self._imerge(self._scan_node(node, pattern, count)
+                         for node in self.name_to_node.itervalues()))
+
+  def _delete_pattern_from_node(self, node, pattern, count):
+    # yields the number of keys deleted for each batch
+    keys = self._scan_node(node, pattern, count)
+    while True:
+      batch = list(itertools.islice(keys, self.delete_chunk_size))
+      if not batch:
+        return
+      key_map = defaultdict(list)
+      for bucket, key in batch:
+        key_map[bucket].append(key)
+      yield self._delete_from_node(node, key_map)
+
+  def delete_pattern(self, pattern='*', count=None):
+    """
+    Deletes all keys matching `pattern` and returns the number of keys
+    deleted. Each node is scanned in parallel and keys are deleted in batches
+    of `DELETE_CHUNK_SIZE` while scanning.
+    """
+    return sum(self._imerge(
+      self._delete_pattern_from_node(node, pattern, count)
+      for node in self.name_to_node.itervalues()))
+
+  def _get_routing_key(self, name):
+    # returns the key which routes the top-level key `name` to its node. Hash
+    # buckets and version keys (including the cache generation's, which
+    # exists with tagging off) are routed by their `{...}` key, like
+    # `get_cache_key` and `_get_tag_versions` route them. Tags may contain
+    # `}` (the tag regex is greedy) but their suffixes never do.
+    if name.startswith('{') and '}' in name:
+      return name[:name.rindex('}') + 1]
+    return name
+
+  def _merge_on_node(self, node, old_node, name):
+    # Resolves a RESTORE of `name` which collided with a newer copy on `node`.
+    # Buckets get the fields they're missing and tag versions keep the larger
+    # version, plain keys keep the newer value.
+    routing_key = self._get_routing_key(name)
+    if name == self._get_version_key(routing_key):
+      version = old_node.get(name)
+      if version is not None and int(version) > int(node.get(name) or 0):
+        node.set(name, version)
+    elif name != routing_key or self._is_pack_bucket(name):
+      expiring = (self._is_pack_bucket(name) and
+                  self._supports_field_expiry(old_node))
+      for key, value in old_node.hscan_iter(name):
+        if node.hsetnx(name, key, value) and expiring:
+          # Packed keys keep their own TTL.
+          ttl = old_node.execute_command('HPTTL', name, 'FIELDS', 1, key)[0]
+          if ttl > 0:
+            node.execute_command('HPEXPIRE', name, ttl, 'FIELDS', 1, key)
+
+  def _get_stored_keys(self, node, names):
+    # returns a dict mapping the top-level keys `names` on `node` to the keys
+    # stored in them: the fields of hash buckets, or else the key itself
+    name_to_keys = {name: [name] for name in names}
+    buckets = [name for name in names if name.startswith('{') and
+               name != self._get_version_key(self._get_routing_key(name))]
+    if not buckets:
+      return name_to_keys
+    pipeline = node.pipeline(transaction=False)
+    for name in buckets:
+      pipeline.hkeys(name)
+    responses = self._execute(
+      node, 'hkeys', buckets,
+      functools.partial(pipeline.execute, raise_on_error=False))
+    for name, keys in zip(buckets, responses):
+      if not isinstance(keys, ResponseError): # Not a hash after all.
+        name_to_keys[name] = keys
+    return name_to_keys
+
+  def _migrate_node(self, old_node, count, delete):
+    # yields the number of keys migrated from `old_node` for each batch
+    self._check_pid()
+    old_name = self.node_to_name[old_node]
+    # djredis' own keys (Bloom filters, hot keys) belong to their node.
+    names = (name for name in old_node.scan_iter(count=count)
+             if not name.startswith('djredis:') and
+             self.ring(self._get_routing_key(name)) != old_name)
+    while True:
+      batch = list(itertools.islice(names, self.delete_chunk_size))
+      if not batch:
+        return
+      pipeline = old_node.pipeline(transaction=False)
+      for name in batch:
+        pipeline.dump(name)
+        pipeline.pttl(name)
+      responses = self._execute(old_node, 'dump', batch, pipeline.execute)
+      node_to_dumps = defaultdict(list)
+      for name, dump, ttl in zip(batch, responses[::2], responses[1::2]):
+        if dump is not None: # Expired since we scanned it.
+          node_to_dumps[self.get_node(self._get_routing_key(name))].append(
+            (name, dump, ttl if ttl > 0 else 0))
+      if self.bloom_filter is not None:
+        name_to_keys = self._get_stored_keys(
+          old_node, [name for dumps in node_to_dumps.itervalues()
+                     for name, _, _ in dumps])
+      for node, dumps in node_to_dumps.iteritems():
+        pipeline = node.pipeline(transaction=False)
+        for name, dump, ttl in dumps:
+          pipeline.restore(name, ttl, dump)
+        if self.bloom_filter is not None:
+          # Their new node's Bloom filter must have them too. Its responses
+          # come after the RESTOREs'.
+          self._add_to_bloom_filter(
+            pipeline, node, list(itertools.chain(
+              *(name_to_keys[name] for name, _, _ in dumps))))
+        responses = self._execute(
+          node, 'restore', [name for name, _, _ in dumps],
+          functools.partial(pipeline.execute, raise_on_error=False),
+          values=[dump for _, dump, _ in dumps])
+        for (name, _, _), response in zip(dumps, responses):
+          if not isinstance(response, ResponseError):
+            continue
+          if not str(response).startswith('BUSYKEY'):
+            raise response
+          self._merge_on_node(node, old_node, name)
+      if delete:
+        self._delete_from_node(old_node, {None: batch})
+      yield len(batch)
+
+  def migrate(self, count=None, delete=True):
+    """
+    Moves all keys which changed owner since `PREVIOUS_LOCATION` to their new
+    node using SCAN and DUMP/RESTORE pipelines, deleting them from their
+    previous node if `delete` is set. Previous nodes are migrated in parallel
+    and `count` is passed to SCAN as a hint of the batch size. Returns the
+    number of keys migrated.
+
+    Once this is done, `PREVIOUS_LOCATION` can be removed.
+    """
+    if self.previous_ring is None:
+      raise ImproperlyConfigured('`PREVIOUS_LOCATION` must be set to migrate.')
+    return sum(self._imerge(
+      self._migrate_node(node, count, delete)
+      for node in self.previous_name_to_node.itervalues()))
+
+  def get_distribution(self):
+    """
+    Returns a dict mapping each node to its weight, the share of keys the
+    ring is expected to assign it and the number of keys and bytes of memory
+    it actually holds along with their shares. `capacity_share` is the node's
+    share of the total `maxmemory`, or None if some node has no limit.
+    """
+    expected_shares = self.ring.get_shares()
+    num_keys = self.dbsize()
+    memory = self.info('memory')
+    total_keys = sum(num_keys.itervalues())
+    total_memory = sum(info['used_memory'] for info in memory.itervalues())
+    total_capacity = sum(info.get('maxmemory', 0) for info in
+                         memory.itervalues())
+    limited = all(info.get('maxmemory') for info in memory.itervalues())
+    distribution = {}
+    for name in self.name_to_node:
+      info = memory[name]
+      distribution[name] = {
+        'weight': self.ring.weights[name],
+        'expected_share': expected_shares[name],
+        'keys': num_keys[name],
+        'key_share': (float(num_keys[name]) / total_keys
+                      if total_keys else None),
+        'used_memory': info['used_memory'],
+        'memory_share': (float(info['used_memory']) / total_memory
+                         if total_memory else None),
+        'maxmemory': info.get('maxmemory', 0),
+        'capacity_share': (float(info['maxmemory']) / total_capacity
+                           if limited else None)
+        }
+    return distribution
+
+  def get_concurrency_stats(self, percentiles=(50, 90, 99)):
+    """
+    Returns a dict mapping each node to the stats of its concurrency limiter
+    (see `ConcurrencyLimiter.get_stats`), or None if `MAX_IN_FLIGHT` isn't
+    set.
+    """
+    if self.limiters is None:
+      return None
+    return {self.node_to_name[node]: limiter.get_stats(percentiles)
+            for node, limiter in self.limiters.iteritems()}
+
+  def hot_keys(self, n=10):
+    """
+    Returns the `n` hottest keys seen by this process per (node, command),
+    as sampled by the profiler enabled with `HOT_KEY_SAMPLE_RATE`.
+    """
+    if self.profiler is None:
+      return {}
+    return self.profiler.top(n)
+
+  def get_published_hot_keys(self, n=10):
+    """
+    Returns the `n` hottest keys per (node, command) across all processes, as
+    published by their profilers, in the same format as `hot_keys`.
+    """
+    hot_keys = {}
+    for name, node in self.name_to_node.iteritems():
+      commands = self._execute(
+        node, 'smembers', [HotKeyProfiler.PUBLISH_KEY],
+        functools.partial(node.smembers, HotKeyProfiler.PUBLISH_KEY))
+      for command in commands:
+        counts_key = '%s:%s' % (HotKeyProfiler.PUBLISH_KEY, command)
+        bytes_key = '%s:bytes' % counts_key
+        counts = self._execute(
+          node, 'zrevrange', [counts_key],
+          functools.partial(node.zrevrange, counts_key, 0, n - 1,
+                            withscores=True))
+        pipeline = node.pipeline(transaction=False)
+        for key, _ in counts:
+          pipeline.zscore(bytes_key, key)
+        weights = self._execute(node, 'zscore', [bytes_key], pipeline.execute)
+        hot_keys[(name, command)] = [(key, count, weight or 0)
+                                     for (key, count), weight in
+                                     zip(counts, weights)]
+    return hot_keys
+
   def disconnect(self):
     for node in self.name_to_node.itervalues():
       try:
@@ -200,19 +1739,44 @@ class SentinelBackedRingClient(RingClient):
     sentinel_kwargs = self._get_sentinel_kwargs(options)
     node_kwargs = self._get_node_kwargs(options)
 
-    masters = None
-    # Try to fetch a list of all masters from any sentinel.
+    masters = snapshot_masters = None
+    discovered = False
     hosts = list(hosts)
-    shuffle(hosts) # Randomly sort sentinels before trying to bootstrap.
-    for host, port in hosts:
-      client = StrictRedis(host=host, port=port, **sentinel_kwargs)
+    snapshot_path = options.get('RING_SNAPSHOT')
+    if snapshot_path:
+      # The ring snapshot also records the masters we discovered, which saves
+      # querying Sentinel on startup until it's `RING_SNAPSHOT_MAX_AGE`
+      # seconds old (an hour by default), so added or removed masters are
+      # noticed by then.
       try:
-        masters = client.sentinel_masters().keys()
-        break
-      except RedisError:
-        pass
+        max_age = float(options.get('RING_SNAPSHOT_MAX_AGE', 3600))
+      except ValueError:
+        raise ImproperlyConfigured('`RING_SNAPSHOT_MAX_AGE` must be a valid '
+                                   'number.')
+      ring = self._load_ring_snapshot(snapshot_path)
+      if ring is not None:
+        snapshot_masters = list(ring.nodes)
+        try:
+          age = time.time() - os.path.getmtime(snapshot_path)
+        except OSError:
+          age = max_age
+        if age < max_age:
+          masters = snapshot_masters
+    if masters is None:
+      # Try to fetch a list of all masters from any sentinel.
+      shuffle(hosts) # Randomly sort sentinels before trying to bootstrap.
+      for host, port in hosts:
+        client = StrictRedis(host=host, port=port, **sentinel_kwargs)
+        try:
+          masters = client.sentinel_masters().keys()
+          discovered = True
+          break
+        except RedisError:
+          pass
+    if masters is None:
+      # No Sentinel responded successfully? Fall back to a stale snapshot.
+      masters = snapshot_masters
     if masters is None:
-      # No Sentinel responded successfully?
       raise errors.MastersListUnavailable
     if not len(masters):
       # The masters list was empty?
@@ -225,9 +1789,17 @@ class SentinelBackedRingClient(RingClient):
                                          len(hosts) / 2),
       })
     self.sentinel = Sentinel(hosts, **sentinel_kwargs)
-    masters = [self.sentinel.master_for(name, **node_kwargs)
+    node_kwargs['connection_class'] = SentinelManagedConnection
+    masters = [self.sentinel.master_for(name, redis_class=Node, **node_kwargs)
                for name in masters]
     super(SentinelBackedRingClient, self).__init__(masters, options)
+    if snapshot_path and discovered:
+      # The snapshot is only rewritten when the masters changed, so mark it
+      # as fresh.
+      try:
+        os.utime(snapshot_path, None)
+      except OSError:
+        pass
 
   def _get_sentinel_kwargs(self, options):
     password = options.get('SENTINEL_PASSWORD')
@@ -240,6 +1812,10 @@ class SentinelBackedRingClient(RingClient):
       'socket_timeout': socket_timeout
       }
 
+  def _get_connection_pools(self):
+    return (super(SentinelBackedRingClient, self)._get_connection_pools() +
+            [node.connection_pool for node in self.sentinel.sentinels])
+
   def disconnect(self):
     for node in self.sentinel.sentinels:
       try:
@@ -248,3 +1824,165 @@ class SentinelBackedRingClient(RingClient):
         # TODO(usmanm): Figure this shit out.
         pass
     super(SentinelBackedRingClient, self).disconnect()
+
+class ClusterClient(RingClient):
+  """
+  A client for Redis Cluster. `LOCATION` lists some of the cluster's nodes,
+  which the map of hash slots to masters is loaded from with CLUSTER SLOTS.
+  Keys are sent straight to the master serving their slot (the CRC16 of the
+  key, or of its `{hash tag}`), so tag buckets (`{tag}`) and their version
+  keys share their tag's slot, and so do pack buckets.
+
+  The slot map is cached. A MOVED redirect means it's stale, so it's
+  reloaded, at most every `SLOT_REFRESH_INTERVAL` seconds (the moved slot
+  is patched in between). ASK redirects, sent while a slot is migrating,
+  are followed without updating it. Keys of a multi-key command (MGET, DEL)
+  must share a slot, so they're split by slot into a pipeline per node.
+
+  NOTE: Cluster masters can't serve keys of slots they don't own, so hot
+  keys aren't replicated and the options which place keys on nodes freely
+  aren't supported (see `UNSUPPORTED_OPTIONS`).
+  """
+  UNSUPPORTED_OPTIONS = ('PREVIOUS_LOCATION', 'RING_SNAPSHOT', 'WEIGHTS',
+                         'BLOOM_FILTER', 'HOT_KEY_SAMPLE_RATE')
+  MAX_REDIRECTS = 5
+
+  def __init__(self, hosts, options):
+    for option in ClusterClient.UNSUPPORTED_OPTIONS:
+      if options.get(option):
+        raise ImproperlyConfigured('`%s` is not supported by ClusterClient.' %
+                                   option)
+    self._node_kwargs = self._get_node_kwargs(options)
+    if self._node_kwargs['db']:
+      raise ImproperlyConfigured('Redis Cluster only supports `DB` 0.')
+    try:
+      self.slot_refresh_interval = float(options.get('SLOT_REFRESH_INTERVAL',
+                                                     1))
+    except ValueError:
+      raise ImproperlyConfigured('`SLOT_REFRESH_INTERVAL` must be a valid '
+                                 'number.')
+    self._cluster_nodes = {}
+    self._nodes_lock = threading.Lock()
+    self._slots_lock = threading.Lock()
+    self._slots_loaded_at = 0
+    super(ClusterClient, self).__init__(hosts, options)
+
+  def _get_nodes(self, hosts, options):
+    # Nodes are the masters serving slots, according to the first of `hosts`
+    # that answers CLUSTER SLOTS.
+    self._startup_nodes = [self._get_cluster_node(host[:2]) for host in hosts]
+    self._slot_map = self._load_slot_map()
+    return [self._cluster_nodes[name] for name in self._slot_map.nodes]
+
+  def _get_ring(self, names, weights, snapshot_path=None):
+    return self._slot_map
+
+  def _get_cluster_node(self, address):
+    # returns the node at (host, port), creating it on first use
+    name = '%s:%s' % (address[0], int(address[1]))
+    node = self._cluster_nodes.get(name)
+    if node is None:
+      with self._nodes_lock:
+        node = self._cluster_nodes.get(name)
+        if node is None:
+          kwargs = dict(self._node_kwargs, host=address[0],
+                        port=int(address[1]))
+          node = ClusterNode(self._follow_redirect,
+                             connection_pool=ConnectionPool(
+                               connection_class=Connection, **kwargs))
+          self._cluster_nodes[name] = node
+    return node
+
+  def _load_slot_map(self):
+    # returns the slot map of the first node that answers CLUSTER SLOTS,
+    # trying known masters before `LOCATION`
+    nodes = list(getattr(self, 'name_to_node', {}).itervalues())
+    for node in nodes + self._startup_nodes:
+      try:
+        response = node.execute_command('CLUSTER', 'SLOTS')
+      except RedisError:
+        continue
+      slots = [None] * NUM_SLOTS
+      for entry in response:
+        start, end, master = entry[:3]
+        # Nodes which don't know their own address report an empty host.
+        host = master[0] or node.connection_pool.connection_kwargs['host']
+        name = get_node_name(self._get_cluster_node((host, master[1])))
+        slots[start:end + 1] = [name] * (end - start + 1)
+      self._slots_loaded_at = time.time()
+      return SlotMap(slots)
+    raise errors.ClusterError('No cluster node answered CLUSTER SLOTS.')
+
+  def _refresh_slots(self):
+    # reloads the slot map and switches to the masters serving it. Nodes
+    # which stopped serving slots keep their limiters and timeouts, for
+    # commands which were already routed to them.
+    slot_map = self._load_slot_map()
+    name_to_node = {name: self._cluster_nodes[name]
+                    for name in slot_map.nodes}
+    if self.limiters is not None:
+      limiters = self._get_limiters()
+      limiters.update(self.limiters)
+      self.limiters = limiters
+    if self.adaptive_timeouts is not None:
+      adaptive_timeouts = {node: AdaptiveTimeout(
+                             **self._adaptive_timeout_kwargs)
+                           for node in name_to_node.itervalues()}
+      adaptive_timeouts.update(self.adaptive_timeouts)
+      self.adaptive_timeouts = adaptive_timeouts
+    self.name_to_node = name_to_node
+    self.node_to_name = {node: name for name, node in name_to_node.iteritems()}
+    self.ring = slot_map
+
+  def _moved(self, slot, name):
+    # A slot usually moves along with many others while resharding, so the
+    # whole map is reloaded, unless that was done very recently.
+    with self._slots_lock:
+      if time.time() - self._slots_loaded_at >= self.slot_refresh_interval:
+        try:
+          self._refresh_slots()
+          return
+        except errors.ClusterError:
+          log.warning('Failed to reload the cluster slot map', exc_info=True)
+      if name in self.name_to_node:
+        self.ring.slots[slot] = name
+
+  def _follow_redirect(self, redirect, args, options):
+    # runs the command `args`, which was redirected with `redirect` (see
+    # `ClusterNode`), following up to `MAX_REDIRECTS` redirects
+    for _ in xrange(ClusterClient.MAX_REDIRECTS):
+      kind, slot, address = redirect
+      node = self._get_cluster_node(address)
+      try:
+        if kind == 'ASK':
+          return node.execute_asking(*args, **options)
+        self._moved(slot, get_node_name(node))
+        return Node.execute_command(node, *args, **options)
+      except ResponseError as e:
+        redirect = parse_redirect(e)
+        if redirect is None:
+          raise
+    raise errors.ClusterError('Too many redirects for %s.' % args[0])
+
+  def get_node(self, key):
+    # Nodes which stopped serving slots are kept, so a key routed with the
+    # previous slot map still finds its node.
+    return self._cluster_nodes[self.ring(key)]
+
+  def _group_keys(self, keys):
+    # Multi-key commands fail with CROSSSLOT unless all keys share a slot.
+    slot_to_keys = defaultdict(list)
+    for key in keys:
+      slot_to_keys[get_slot(key)].append(key)
+    return slot_to_keys.values()
+
+  def _get_limiters(self):
+    return {node: ConcurrencyLimiter(self.max_in_flight, self.priority_shares)
+            for node in self._cluster_nodes.itervalues()}
+
+  def _get_connection_pools(self):
+    return [node.connection_pool for node in self._cluster_nodes.itervalues()]
+
+  def disconnect(self):
+    for node in self._cluster_nodes.itervalues():
+      node.connection_pool.disconnect()
@@ -12,3 +12,8 @@ class DJRedisConf(AppConf):
 
   ENABLE_TAGGING = False
   TAG_REGEX = re.compile('.*\{(.*)\}.*', re.I)
+  # When enabled, each tag has a version counter which is embedded in the name
+  # of its hash bucket and `delete_tag` simply increments it.
+  ENABLE_TAG_VERSIONING = False
+  # Number of seconds each process caches tag versions for.
+  TAG_VERSION_TIMEOUT = 1
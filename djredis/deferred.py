@@ -0,0 +1,147 @@
+# coding: utf-8
+
+import functools
+import itertools
+import logging
+import threading
+
+from collections import OrderedDict
+
+from django.db import DEFAULT_DB_ALIAS
+from django.db import transaction
+
+from redis.exceptions import RedisError
+
+from djredis.errors import DJRedisError
+from djredis.writebehind import WriteBehindQueue
+
+log = logging.getLogger('djredis')
+
+
+class _Segment(object):
+  # Writes made at the same savepoint of a transaction, see `DeferredWrites`.
+  def __init__(self, savepoint_ids):
+    self.savepoint_ids = savepoint_ids
+    self.operations = OrderedDict()
+    self.callback = None
+
+
+class DeferredWrites(object):
+  """
+  Holds back the sets and deletes a cache makes inside a `transaction.atomic`
+  block of the `using` database until the transaction commits, and drops
+  them if it rolls back. `write(operations)` is called with the writes to
+  make once it commits, a dict mapping keys to (operation, value, timeout)
+  like `WriteBehindQueue` uses.
+
+  Writes are buffered per thread, in segments of consecutive writes made at
+  the same savepoint. Each segment is flushed by its own
+  `transaction.on_commit` callback, so Django drops exactly the writes made
+  in a savepoint that's rolled back, and repeated writes to a key within a
+  segment are coalesced into the last one. Most transactions have a single
+  segment, so they're written with a single flush.
+
+  NOTE: Django has no public hook for savepoint rollbacks, so this reads the
+  private `run_on_commit` and `savepoint_ids` of the connection, which
+  Django has had since 1.9 (see `is_supported`).
+  """
+  SET, DELETE = WriteBehindQueue.SET, WriteBehindQueue.DELETE
+
+  def __init__(self, write, using=DEFAULT_DB_ALIAS):
+    self.write = write
+    self.using = using
+    self._local = threading.local()
+
+  @staticmethod
+  def is_supported(using=DEFAULT_DB_ALIAS):
+    """
+    Returns whether Django has the transaction hooks this relies on.
+    """
+    if not hasattr(transaction, 'on_commit'):
+      return False
+    connection = transaction.get_connection(using)
+    return (hasattr(connection, 'run_on_commit') and
+            hasattr(connection, 'savepoint_ids'))
+
+  def is_deferring(self):
+    """
+    Returns whether writes made now are deferred, i.e. whether we're in an
+    atomic block.
+    """
+    return transaction.get_connection(self.using).in_atomic_block
+
+  def _get_segments(self):
+    # returns this thread's segments which are still waiting for a commit.
+    # Ones which were flushed, or whose savepoint or transaction was rolled
+    # back, no longer have a callback registered.
+    segments = getattr(self._local, 'segments', None)
+    if not segments:
+      return []
+    # Entries are (savepoint_ids, func), plus a `robust` flag since Django
+    # 4.2. Our segments hold their callbacks, so their ids can't be reused
+    # by other objects.
+    registered = {id(entry[1]) for entry in
+                  transaction.get_connection(self.using).run_on_commit}
+    self._local.segments = [segment for segment in segments
+                            if id(segment.callback) in registered]
+    return self._local.segments
+
+  def put(self, key, value, timeout):
+    """
+    Defers setting `key` to `value` for `timeout` seconds.
+    """
+    self._put(key, (DeferredWrites.SET, value, timeout))
+    return True
+
+  def delete(self, key):
+    """
+    Defers deleting `key`.
+    """
+    self._put(key, (DeferredWrites.DELETE, None, None))
+
+  def _put(self, key, operation):
+    segments = self._get_segments()
+    savepoint_ids = tuple(
+      transaction.get_connection(self.using).savepoint_ids)
+    if not segments or segments[-1].savepoint_ids != savepoint_ids:
+      segment = _Segment(savepoint_ids)
+      segment.callback = functools.partial(self._flush, segment)
+      transaction.on_commit(segment.callback, using=self.using)
+      segments.append(segment)
+      self._local.segments = segments
+    segments[-1].operations.pop(key, None) # Keep write order.
+    segments[-1].operations[key] = operation
+
+  def get(self, key):
+    """
+    Returns the last deferred (operation, value, timeout) write for `key`,
+    or None if there's none. This lets the cache read its own writes.
+    """
+    for segment in reversed(self._get_segments()):
+      operation = segment.operations.get(key)
+      if operation is not None:
+        return operation
+    return None
+
+  def keys(self):
+    """
+    Returns the keys this thread has deferred writes for.
+    """
+    return list(set(itertools.chain(*(segment.operations for segment in
+                                       self._get_segments()))))
+
+  def discard(self):
+    """
+    Drops all deferred writes.
+    """
+    for segment in self._get_segments():
+      segment.operations.clear()
+
+  def _flush(self, segment):
+    # The transaction is committed, so errors can only be logged.
+    if not segment.operations:
+      return
+    try:
+      self.write(segment.operations)
+    except (DJRedisError, RedisError):
+      log.error('Failed to write deferred cache writes', exc_info=True)
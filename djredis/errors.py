@@ -11,3 +11,15 @@ class MastersListUnavailable(DJRedisError):
 
 class NoMastersConfigured(DJRedisError):
   pass
+
+class InvalidRingSnapshot(DJRedisError):
+  pass
+
+class DeadlineExceeded(DJRedisError):
+  pass
+
+class NodeOverloaded(DJRedisError):
+  pass
+
+class ClusterError(DJRedisError):
+  pass
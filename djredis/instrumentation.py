@@ -0,0 +1,297 @@
+# coding: utf-8
+
+import logging
+import math
+import random
+import re
+import socket
+import threading
+import time
+
+from collections import defaultdict
+from redis.exceptions import RedisError
+
+from djredis import signals
+from djredis.errors import DJRedisError
+from djredis.utils.topk import SpaceSaving
+
+log = logging.getLogger('djredis')
+
+
+class Listener(object):
+  """
+  Base class for receivers of the `command_executed` signal. Subclasses
+  implement `handle`, which is called with the event's fields as keyword
+  arguments.
+  """
+  _connected = False
+
+  def connect(self, sender=None):
+    """
+    Starts receiving events, only from `sender` if given (a `RingClient` or
+    `RedisCache` instance).
+    """
+    self._sender = sender
+    self._connected = True
+    signals.command_executed.connect(self, sender=sender, weak=False,
+                                     dispatch_uid=id(self))
+    return self
+
+  def disconnect(self):
+    """
+    Stops receiving events. Does nothing if not connected.
+    """
+    if not self._connected:
+      return
+    self._connected = False
+    signals.command_executed.disconnect(sender=self._sender,
+                                        dispatch_uid=id(self))
+
+  def __call__(self, sender, signal=None, **event):
+    self.handle(**event)
+
+  def handle(self, command, node, keys, bytes_in, bytes_out, duration, hits,
+             misses, error):
+    raise NotImplementedError
+
+
+class StatsdListener(Listener):
+  """
+  Sends per-command timings and counters to a StatsD server over UDP.
+  Metric names look like `<prefix>.<command>.<metric>`, and the same
+  counters are also sent per node as `<prefix>.<node>.<command>.<metric>`.
+  """
+  _INVALID_CHARS = re.compile(r'[^A-Za-z0-9_-]')
+
+  def __init__(self, host='localhost', port=8125, prefix='djredis'):
+    self.address = (host, port)
+    self.prefix = prefix
+    self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+  def _get_metrics(self, command, duration, bytes_in, bytes_out, hits, misses,
+                   error):
+    metrics = ['%s.time:%.3f|ms' % (command, duration * 1000),
+               '%s.count:1|c' % command]
+    for name, value in (('bytes_in', bytes_in), ('bytes_out', bytes_out),
+                        ('hits', hits), ('misses', misses),
+                        ('errors', int(error is not None))):
+      if value:
+        metrics.append('%s.%s:%d|c' % (command, name, value))
+    return metrics
+
+  def handle(self, command, node, keys, bytes_in, bytes_out, duration, hits,
+             misses, error):
+    metrics = self._get_metrics(command, duration, bytes_in, bytes_out, hits,
+                                misses, error)
+    lines = ['%s.%s' % (self.prefix, metric) for metric in metrics]
+    if node is not None:
+      node = self._INVALID_CHARS.sub('_', node)
+      lines.extend('%s.%s.%s' % (self.prefix, node, metric)
+                   for metric in metrics)
+    try:
+      self._socket.sendto('\n'.join(lines), self.address)
+    except socket.error:
+      pass # Metrics are best effort.
+
+
+class Histogram(object):
+  """
+  A latency histogram with logarithmically sized buckets, so its memory use
+  is bounded no matter how many values it records. Percentiles are accurate
+  to within ~10%.
+  """
+  BASE = 1.1
+  MIN_VALUE = 1e-6
+
+  def __init__(self):
+    self.buckets = defaultdict(int)
+    self.count = 0
+    self.total = 0.0
+    self.max = 0.0
+
+  def add(self, value):
+    bucket = int(math.log(max(value, Histogram.MIN_VALUE) /
+                          Histogram.MIN_VALUE, Histogram.BASE))
+    self.buckets[bucket] += 1
+    self.count += 1
+    self.total += value
+    self.max = max(self.max, value)
+
+  def percentile(self, percentile):
+    """
+    Returns the upper bound of the bucket holding the `percentile`th value.
+    """
+    if not self.count:
+      return None
+    rank = math.ceil(self.count * percentile / 100.0)
+    seen = 0
+    for bucket in sorted(self.buckets):
+      seen += self.buckets[bucket]
+      if seen >= rank:
+        return min(Histogram.MIN_VALUE * Histogram.BASE ** (bucket + 1),
+                   self.max)
+    return self.max
+
+  @property
+  def mean(self):
+    return self.total / self.count if self.count else None
+
+
+class HistogramListener(Listener):
+  """
+  Keeps in-memory latency histograms and counters per command and per
+  (command, node).
+  """
+  COUNTERS = ('bytes_in', 'bytes_out', 'hits', 'misses', 'errors')
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self.reset()
+
+  def reset(self):
+    with self._lock:
+      self.histograms = defaultdict(Histogram)
+      self.counters = defaultdict(lambda: dict.fromkeys(
+        HistogramListener.COUNTERS, 0))
+
+  def handle(self, command, node, keys, bytes_in, bytes_out, duration, hits,
+             misses, error):
+    with self._lock:
+      for name in (command, (command, node)):
+        self.histograms[name].add(duration)
+        counters = self.counters[name]
+        counters['bytes_in'] += bytes_in
+        counters['bytes_out'] += bytes_out
+        counters['hits'] += hits
+        counters['misses'] += misses
+        counters['errors'] += int(error is not None)
+
+  def snapshot(self, percentiles=(50, 90, 99)):
+    """
+    Returns a dict mapping each command (and (command, node) pair) to its
+    count, mean/max latency, latency percentiles and counters.
+    """
+    with self._lock:
+      result = {}
+      for name, histogram in self.histograms.iteritems():
+        stats = dict(self.counters[name])
+        stats.update({
+          'count': histogram.count,
+          'mean': histogram.mean,
+          'max': histogram.max
+          })
+        for percentile in percentiles:
+          stats['p%s' % percentile] = histogram.percentile(percentile)
+        result[name] = stats
+      return result
+
+
+class HotKeyProfiler(Listener):
+  """
+  Samples the commands sent by a `RingClient` and tracks the approximate
+  top keys by request count and bytes transferred, per (node, command).
+
+  Every `publish_interval` seconds the sampled counts are also added to
+  sorted sets on each node (see `RingClient.get_published_hot_keys`), so
+  that other processes can see the hot keys of the whole cluster, and
+  `on_publish` is called. This happens in a background thread, off the
+  path of the command which ended the sampling window.
+  """
+  PUBLISH_KEY = 'djredis:hotkeys'
+  PUBLISH_TTL = 60 * 60
+
+  def __init__(self, client, sample_rate=0.01, capacity=100,
+               publish_interval=60, on_publish=None):
+    self.client = client
+    self.sample_rate = sample_rate
+    self.capacity = capacity
+    self.publish_interval = publish_interval
+    self.on_publish = on_publish
+    self._lock = threading.Lock()
+    self._last_published = time.time()
+    self._sketches = {}
+    self.reset()
+
+  def reset(self):
+    with self._lock:
+      self._take_sketches()
+
+  def _take_sketches(self):
+    # starts a new sampling window and returns the sketches of the last one.
+    # Must be called with `_lock` held.
+    sketches = self._sketches
+    self._sketches = defaultdict(lambda: SpaceSaving(self.capacity))
+    return sketches
+
+  def handle(self, command, node, keys, bytes_in, bytes_out, duration, hits,
+             misses, error):
+    if node is None or not keys or random.random() >= self.sample_rate:
+      return
+    weight = float(bytes_in + bytes_out) / len(keys)
+    sketches = None
+    with self._lock:
+      sketch = self._sketches[(node, command)]
+      for key in keys:
+        sketch.offer(key, weight=weight)
+      # Only the thread which ends the window publishes it.
+      now = time.time()
+      if (self.publish_interval and
+          now - self._last_published >= self.publish_interval):
+        self._last_published = now
+        sketches = self._take_sketches()
+    if sketches is not None:
+      thread = threading.Thread(target=self._publish, args=(sketches,),
+                                name='djredis-hot-keys')
+      thread.daemon = True
+      thread.start()
+
+  def _top(self, sketches, n):
+    return {name: [(key, count / self.sample_rate, weight / self.sample_rate)
+                   for key, count, weight, _ in sketch.top(n)]
+            for name, sketch in sketches.iteritems()}
+
+  def top(self, n=10):
+    """
+    Returns a dict mapping (node, command) pairs to a list of
+    (key, estimated count, estimated bytes) tuples for their `n` hottest keys.
+    """
+    with self._lock:
+      return self._top(self._sketches, n)
+
+  def publish(self):
+    """
+    Adds the sampled counts to the sorted sets on each node and starts a new
+    sampling window.
+    """
+    with self._lock:
+      self._last_published = time.time()
+      sketches = self._take_sketches()
+    self._publish(sketches)
+
+  def _publish(self, sketches):
+    hot_keys = self._top(sketches, self.capacity)
+    node_to_hot_keys = defaultdict(dict)
+    for (node, command), keys in hot_keys.iteritems():
+      node_to_hot_keys[node][command] = keys
+    for name, commands in node_to_hot_keys.iteritems():
+      # Talk to the node directly, we don't want to instrument ourselves.
+      pipeline = self.client.name_to_node[name].pipeline(transaction=False)
+      for command, keys in commands.iteritems():
+        counts_key = '%s:%s' % (HotKeyProfiler.PUBLISH_KEY, command)
+        bytes_key = '%s:bytes' % counts_key
+        pipeline.sadd(HotKeyProfiler.PUBLISH_KEY, command)
+        for key, count, weight in keys:
+          pipeline.zincrby(counts_key, key, count)
+          pipeline.zincrby(bytes_key, key, weight)
+        for key in (counts_key, bytes_key):
+          pipeline.expire(key, HotKeyProfiler.PUBLISH_TTL)
+      pipeline.expire(HotKeyProfiler.PUBLISH_KEY, HotKeyProfiler.PUBLISH_TTL)
+      try:
+        pipeline.execute()
+      except RedisError:
+        log.warning('Failed to publish hot keys to %s' % name, exc_info=True)
+    if self.on_publish is not None:
+      try:
+        self.on_publish()
+      except (DJRedisError, RedisError):
+        log.warning('Failed to process published hot keys', exc_info=True)
@@ -0,0 +1,17 @@
+# coding: utf-8
+
+from django.core.management.base import CommandError
+
+from djredis.cache import RedisCache
+
+
+def get_redis_cache(alias):
+  try:
+    from django.core.cache import caches
+    cache = caches[alias]
+  except ImportError:
+    from django.core.cache import get_cache
+    cache = get_cache(alias)
+  if not isinstance(cache, RedisCache):
+    raise CommandError('Cache `%s` is not a djredis cache.' % alias)
+  return cache
@@ -0,0 +1,35 @@
+# coding: utf-8
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from djredis.management import get_redis_cache
+
+
+def _format_share(share):
+  return '-' if share is None else '%.1f%%' % (share * 100)
+
+
+class Command(BaseCommand):
+  help = ('Prints the expected share of keys of each node, given its weight, '
+          'next to its actual share of keys and memory. Use this to tune '
+          'node weights.')
+  option_list = BaseCommand.option_list + (
+    make_option('--cache', default='default',
+                help='Alias of the cache to inspect.'),
+    )
+
+  def handle(self, *args, **options):
+    cache = get_redis_cache(options['cache'])
+    distribution = cache.client.get_distribution()
+    self.stdout.write('%-24s %8s %9s %12s %9s %14s %9s %9s' % (
+      'node', 'weight', 'expected', 'keys', 'share', 'memory', 'share',
+      'capacity'))
+    for name in sorted(distribution):
+      stats = distribution[name]
+      self.stdout.write('%-24s %8.2f %9s %12d %9s %14d %9s %9s' % (
+        name, stats['weight'], _format_share(stats['expected_share']),
+        stats['keys'], _format_share(stats['key_share']),
+        stats['used_memory'], _format_share(stats['memory_share']),
+        _format_share(stats['capacity_share'])))
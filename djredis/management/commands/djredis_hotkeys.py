@@ -0,0 +1,30 @@
+# coding: utf-8
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from djredis.management import get_redis_cache
+
+
+class Command(BaseCommand):
+  help = ('Prints the hottest keys per node and command, as published by the '
+          'hot key profilers of all processes using the cache.')
+  option_list = BaseCommand.option_list + (
+    make_option('--cache', default='default',
+                help='Alias of the cache to inspect.'),
+    make_option('--limit', default=10, type='int',
+                help='Number of keys to print per node and command.'),
+    )
+
+  def handle(self, *args, **options):
+    cache = get_redis_cache(options['cache'])
+    hot_keys = cache.client.get_published_hot_keys(options['limit'])
+    if not hot_keys:
+      self.stdout.write('No hot keys published. Is `HOT_KEY_SAMPLE_RATE` '
+                        'set?')
+      return
+    for node, command in sorted(hot_keys):
+      self.stdout.write('%s %s' % (node, command))
+      for key, count, weight in hot_keys[(node, command)]:
+        self.stdout.write('  %12d %12d B  %s' % (count, weight, key))
@@ -0,0 +1,31 @@
+# coding: utf-8
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from djredis.management import get_redis_cache
+
+
+class Command(BaseCommand):
+  help = ('Moves the keys whose node changed since the ring in the '
+          '`PREVIOUS_LOCATION` option to their new node.')
+  option_list = BaseCommand.option_list + (
+    make_option('--cache', default='default',
+                help='Alias of the cache to migrate.'),
+    make_option('--count', default=1000, type='int',
+                help='Number of keys to SCAN per call.'),
+    make_option('--keep', action='store_true', default=False,
+                help="Don't delete migrated keys from their previous node."),
+    )
+
+  def handle(self, *args, **options):
+    cache = get_redis_cache(options['cache'])
+    if getattr(cache.client, 'previous_ring', None) is None:
+      raise CommandError('The `PREVIOUS_LOCATION` option of cache `%s` is '
+                         'not set.' % options['cache'])
+    migrated = cache.client.migrate(count=options['count'],
+                                    delete=not options['keep'])
+    self.stdout.write('Migrated %d keys. `PREVIOUS_LOCATION` can now be '
+                      'removed.' % migrated)
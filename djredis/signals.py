@@ -1,2 +1,17 @@
 # coding: utf-8
 
+from django.dispatch import Signal
+
+# Sent by `RingClient` after every command it runs against a Redis node, and
+# by `RedisCache` after every value it (de)serializes, in which case `command`
+# is `dumps` or `loads` and `node` is None. `error` is the exception raised by
+# the command, if any.
+command_executed = Signal(providing_args=['command', 'node', 'keys',
+                                          'bytes_in', 'bytes_out', 'duration',
+                                          'hits', 'misses', 'error'])
+
+# Sent by `RingClient` before retrying a command which failed with `error`.
+# `attempt` is the number of the retry and `delay` the number of seconds it
+# waits for before it.
+command_retried = Signal(providing_args=['command', 'node', 'attempt',
+                                         'delay', 'error'])
@@ -4,10 +4,16 @@ import pickle
 import time
 
 from functools import wraps
+from unittest import skipUnless
 
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
 from django.test import TestCase
+from django.test import TransactionTestCase
+from django.test.utils import override_settings
 
 from djredis.cache import RedisCache
+from djredis.deferred import DeferredWrites
 from djredis.tests.runner import RedisRingRunner
 
 
@@ -96,6 +102,26 @@ class RedisCacheTestCase(TestCase):
     self.assertEqual(self.cache.get_many(['a', 'b', 'e']),
                      {'a': 'a', 'b': 'b'})
 
+  def test_iter_many(self):
+    # Multiple cache keys can be streamed using iter_many
+    self.cache.set_many({'key%s' % i: i for i in xrange(50)})
+    keys = ['key%s' % i for i in xrange(60)]
+    self.assertEqual(dict(self.cache.iter_many(keys, chunk_size=7)),
+                     {'key%s' % i: i for i in xrange(50)})
+    self.assertEqual(list(self.cache.iter_many(['e', 'f'])), [])
+
+  def test_get_many_with_ttl(self):
+    # Multiple cache keys can be returned along with their TTLs
+    self.cache.set('a', 'a', 10)
+    self.cache.set('b', 'b')
+    self.cache.set('c', 'c', None)
+    values = self.cache.get_many_with_ttl(['a', 'b', 'c', 'd'])
+    self.assertEqual(sorted(values), ['a', 'b', 'c'])
+    self.assertEqual(values['a'][0], 'a')
+    self.assertTrue(9 < values['a'][1] <= 10)
+    self.assertTrue(0 < values['b'][1] <= self.cache.default_timeout)
+    self.assertEqual(values['c'], ('c', None))
+
   def test_delete(self):
     # Cache keys can be deleted
     self.cache.set('key1', 'spam')
@@ -241,6 +267,18 @@ class RedisCacheTestCase(TestCase):
     self.assertEqual(self.cache.get('key2'), None)
     self.assertEqual(self.cache.get('key3'), 'ham')
 
+  def test_delete_pattern(self):
+    # Keys matching a pattern can be deleted using delete_pattern
+    self.cache.set('foo-1', 'spam')
+    self.cache.set('foo-2', 'eggs')
+    self.cache.set('bar-1', 'ham')
+    self.cache.set('foo-1', 'spam', version=2)
+    self.assertEqual(self.cache.delete_pattern('foo-*'), 2)
+    self.assertEqual(self.cache.get('foo-1'), None)
+    self.assertEqual(self.cache.get('foo-2'), None)
+    self.assertEqual(self.cache.get('bar-1'), 'ham')
+    self.assertEqual(self.cache.get('foo-1', version=2), 'spam')
+
   def test_clear(self):
     # The cache can be emptied using clear
     self.cache.set('key1', 'spam')
@@ -443,3 +481,213 @@ class RedisCacheCustomOptionsTestCase(TestCase):
     self.cache.set('key', 'value2')
     self.assertEqual(self.cache.get('key'), 'value2')
     self.assertEqual(self.cache.get('key', default='default'), 'value2')
+
+  @override_settings(DJREDIS_ENABLE_TAGGING=True)
+  def test_max_key_length(self):
+    cache = RedisCache(
+      'localhost:9500; localhost:9501; localhost:9502',
+      {'KEY_PREFIX': 'prefix',
+       'OPTIONS': {'CLIENT_CLASS': 'djredis.client.RingClient',
+                   'MAX_KEY_LENGTH': 64}})
+    long_key = '/some/long/url/%s' % ('x' * 100)
+    self.assertEqual(cache.make_key('key'), 'prefix:1:key')
+    made_key = cache.make_key(long_key)
+    self.assertEqual(len(made_key), 64)
+    self.assertTrue(made_key.startswith('prefix:1:/some/long/url/'))
+    self.assertEqual(cache.make_key(long_key), made_key)
+    self.assertNotEqual(cache.make_key(long_key, version=2), made_key)
+    made_key = cache.make_key('{mytag}-%s' % long_key)
+    self.assertTrue(made_key.startswith('prefix:1:{mytag}:'))
+    self.assertEqual(cache.client.get_cache_key(made_key), '{mytag}')
+
+    cache.set(long_key, 'value1')
+    cache.set_many({'{mytag}-%s' % long_key: 'value2', 'key': 'value3'})
+    self.assertEqual(cache.get(long_key), 'value1')
+    self.assertEqual(cache.get_many([long_key, '{mytag}-%s' % long_key]),
+                     {long_key: 'value1', '{mytag}-%s' % long_key: 'value2'})
+    self.assertEqual(cache.delete_pattern('/some/*'), 1)
+    self.assertEqual(cache.get(long_key), None)
+    self.assertEqual(cache.client.delete_tag('mytag'), 1)
+    self.assertEqual(cache.get('key'), 'value3')
+
+
+class RedisCacheClearTestCase(TestCase):
+  def setUp(self):
+    self.runner = RedisRingRunner()
+    self.runner.start()
+
+  def tearDown(self):
+    self.runner.stop()
+
+  def _get_cache(self, clear_mode, key_prefix):
+    return RedisCache(
+      'localhost:9500; localhost:9501; localhost:9502',
+      {'KEY_PREFIX': key_prefix,
+       'OPTIONS': {'CLIENT_CLASS': 'djredis.client.RingClient',
+                   'CLEAR': clear_mode}})
+
+  def _test_clear_is_scoped_to_prefix(self, clear_mode):
+    cache1 = self._get_cache(clear_mode, 'cache1')
+    cache2 = self._get_cache(clear_mode, 'cache2')
+    cache1.set('key1', 'spam')
+    cache1.set('key2', 'eggs', version=2)
+    cache2.set('key1', 'ham')
+    cache1.clear()
+    self.assertEqual(cache1.get('key1'), None)
+    self.assertEqual(cache1.get('key2', version=2), None)
+    self.assertEqual(cache2.get('key1'), 'ham')
+    cache1.set('key1', 'spam')
+    self.assertEqual(cache1.get('key1'), 'spam')
+
+  def test_clear_scan(self):
+    self._test_clear_is_scoped_to_prefix('scan')
+
+  def test_clear_generation(self):
+    self._test_clear_is_scoped_to_prefix('generation')
+
+  def test_invalid_clear_mode(self):
+    self.assertRaises(ImproperlyConfigured, self._get_cache, 'lolcat', '')
+
+
+class RedisCacheWriteBehindTestCase(TestCase):
+  def setUp(self):
+    self.runner = RedisRingRunner()
+    self.runner.start()
+    self.cache = self._get_cache()
+    self.sync_cache = RedisCache(
+      'localhost:9500; localhost:9501; localhost:9502',
+      {'OPTIONS': {'CLIENT_CLASS': 'djredis.client.RingClient'}})
+
+  def tearDown(self):
+    self.cache.write_behind.close()
+    self.runner.stop()
+
+  def _get_cache(self, **options):
+    options.update({'CLIENT_CLASS': 'djredis.client.RingClient',
+                    'WRITE_BEHIND': True})
+    return RedisCache('localhost:9500; localhost:9501; localhost:9502',
+                      {'OPTIONS': options})
+
+  def test_writes_are_flushed(self):
+    self.sync_cache.set('key1', 'spam')
+    self.cache.set('key2', 'eggs')
+    self.cache.set('key2', 'ham')
+    self.cache.set_many({'key3': 'spam', 'key4': 'eggs'})
+    self.cache.delete('key1')
+    # Pending writes are visible to the cache which queued them.
+    self.assertEqual(self.cache.get('key1'), None)
+    self.assertEqual(self.cache.get_many(['key2', 'key3']),
+                     {'key2': 'ham', 'key3': 'spam'})
+    self.cache.write_behind.flush()
+    self.assertEqual(self.sync_cache.get('key1'), None)
+    self.assertEqual(self.sync_cache.get_many(['key2', 'key3', 'key4']),
+                     {'key2': 'ham', 'key3': 'spam', 'key4': 'eggs'})
+
+  def test_flush_thread(self):
+    self.cache.set('key', 'value')
+    time.sleep(0.2)
+    self.assertEqual(self.sync_cache.get('key'), 'value')
+
+  def test_incr(self):
+    self.cache.set('answer', 41)
+    self.assertEqual(self.cache.incr('answer'), 42)
+    self.assertEqual(self.sync_cache.get('answer'), 42)
+
+  def test_overflow(self):
+    self.cache.write_behind.close()
+    self.cache = self._get_cache(WRITE_BEHIND_MAX_SIZE=2,
+                                 WRITE_BEHIND_FLUSH_INTERVAL=60,
+                                 WRITE_BEHIND_OVERFLOW='drop')
+    for i in xrange(4):
+      self.cache.set('key%d' % i, i)
+    self.assertEqual(self.cache.write_behind.dropped, 2)
+    self.cache.write_behind.close()
+    self.assertEqual(self.sync_cache.get_many(['key%d' % i
+                                               for i in xrange(4)]),
+                     {'key0': 0, 'key1': 1})
+    self.assertRaises(ImproperlyConfigured, self._get_cache,
+                      WRITE_BEHIND_OVERFLOW='lolcat')
+
+
+@skipUnless(DeferredWrites.is_supported(),
+            '`DEFER_WRITES` needs Django 1.9+ `transaction.on_commit`.')
+class RedisCacheDeferWritesTestCase(TransactionTestCase):
+  def setUp(self):
+    self.runner = RedisRingRunner()
+    self.runner.start()
+    self.cache = RedisCache(
+      'localhost:9500; localhost:9501; localhost:9502',
+      {'OPTIONS': {'CLIENT_CLASS': 'djredis.client.RingClient',
+                   'DEFER_WRITES': True}})
+    self.sync_cache = RedisCache(
+      'localhost:9500; localhost:9501; localhost:9502',
+      {'OPTIONS': {'CLIENT_CLASS': 'djredis.client.RingClient'}})
+
+  def tearDown(self):
+    self.runner.stop()
+
+  def test_commit(self):
+    self.cache.set('key1', 'spam')
+    with transaction.atomic():
+      self.cache.set('key2', 'eggs')
+      self.cache.set('key2', 'ham')
+      self.cache.set_many({'key3': 'spam'})
+      self.cache.delete('key1')
+      # Deferred writes are visible to the cache which made them.
+      self.assertEqual(self.cache.get_many(['key1', 'key2', 'key3']),
+                       {'key2': 'ham', 'key3': 'spam'})
+      self.assertEqual(self.sync_cache.get_many(['key1', 'key2', 'key3']),
+                       {'key1': 'spam'})
+    self.assertEqual(self.sync_cache.get_many(['key1', 'key2', 'key3']),
+                     {'key2': 'ham', 'key3': 'spam'})
+
+  def test_rollback(self):
+    self.cache.set('key1', 'spam')
+    with transaction.atomic():
+      self.cache.set('key1', 'eggs')
+      try:
+        with transaction.atomic():
+          self.cache.set('key2', 'ham')
+          self.cache.delete('key1')
+          raise ValueError
+      except ValueError:
+        pass
+      # Writes in the rolled back savepoint are dropped, others are kept.
+      self.assertEqual(self.cache.get_many(['key1', 'key2']),
+                       {'key1': 'eggs'})
+    self.assertEqual(self.sync_cache.get_many(['key1', 'key2']),
+                     {'key1': 'eggs'})
+    try:
+      with transaction.atomic():
+        self.cache.delete('key1')
+        raise ValueError
+    except ValueError:
+      pass
+    self.assertEqual(self.sync_cache.get('key1'), 'eggs')
+
+  def test_pending_reads(self):
+    self.cache.set('key2', 1)
+    with transaction.atomic():
+      self.cache.set('key1', 'spam', timeout=60)
+      self.cache.set('key2', 10)
+      self.assertEqual(self.cache.get_many_with_ttl(['key1', 'key3']),
+                       {'key1': ('spam', 60)})
+      self.assertEqual(self.cache.incr('key2'), 11)
+      self.assertRaises(ValueError, self.cache.incr, 'key3')
+      # Neither published the transaction's writes.
+      self.assertEqual(self.sync_cache.get_many(['key1', 'key2']),
+                       {'key2': 1})
+    self.assertEqual(self.sync_cache.get_many(['key1', 'key2']),
+                     {'key1': 'spam', 'key2': 11})
+
+  def test_delete_pattern(self):
+    self.cache.set('key1', 'spam')
+    with transaction.atomic():
+      self.cache.set('key2', 'eggs')
+      self.cache.set('other', 'ham')
+      self.assertEqual(self.cache.delete_pattern('key*'), 1)
+      self.assertEqual(self.cache.get_many(['key1', 'key2', 'other']),
+                       {'other': 'ham'})
+      self.assertEqual(self.sync_cache.get('key2'), None)
+    self.assertEqual(self.sync_cache.get_many(['key1', 'key2', 'other']),
+                     {'other': 'ham'})
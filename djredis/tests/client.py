@@ -1,13 +1,28 @@
 # coding: utf-8
 
+import itertools
+import os
+import re
+import tempfile
+import threading
 import time
 
 from django.test import TestCase
+from django.test.utils import override_settings
+from redis import StrictRedis
+from redis.exceptions import ConnectionError
 
+from djredis import signals
 from djredis.cache import RedisCache
 from djredis.conf import settings
+from djredis.errors import DeadlineExceeded
+from djredis.errors import NodeOverloaded
+from djredis.instrumentation import HistogramListener
+from djredis.tests.runner import RedisClusterRunner
 from djredis.tests.runner import RedisRingRunner
 from djredis.utils import pickle
+from djredis.utils.cluster import get_slot
+from djredis.utils.hashring import HashRing
 
 
 class RingClientTestCase(TestCase):
@@ -66,6 +81,544 @@ class RingClientTestCase(TestCase):
     self.assertEqual(self.cache.client.delete_tag('mytag1', 'mytag2'), 2)
     self.assertEqual(self.cache.client.keys(), [])
 
+  @override_settings(DJREDIS_ENABLE_TAGGING=True,
+                     DJREDIS_ENABLE_TAG_VERSIONING=True)
+  def test_tag_versioning(self):
+    self.cache.set('{mytag}-key1', 'helloworld1')
+    self.cache.set('{mytag}-key2', 'helloworld2')
+    self.assertEqual(self.cache.get_many(['{mytag}-key1', '{mytag}-key2']),
+                     {'{mytag}-key1': 'helloworld1',
+                      '{mytag}-key2': 'helloworld2'})
+    # Buckets are named after their tag's version, which starts at an epoch.
+    node = self.cache.client.get_node('{mytag}')
+    version = int(node.get('{mytag}:version'))
+    self.assertTrue(version > 0)
+    self.assertEqual(set(self.cache.client.keys()),
+                     set(['{mytag}:%d' % version, '{mytag}:version']))
+
+    # Deleting a tag only bumps its version; the old bucket is left alone.
+    self.assertEqual(self.cache.client.delete_tag('mytag'), 1)
+    self.assertEqual(self.cache.get('{mytag}-key1'), None)
+    self.assertEqual(self.cache.get_many(['{mytag}-key1', '{mytag}-key2']), {})
+    self.assertEqual(set(self.cache.client.keys()),
+                     set(['{mytag}:%d' % version, '{mytag}:version']))
+
+    self.cache.set('{mytag}-key1', 'helloworld3')
+    self.assertEqual(self.cache.get('{mytag}-key1'), 'helloworld3')
+    self.assertEqual(node.hlen('{mytag}:%d' % (version + 1)), 1)
+
+    # An evicted version key starts again at a new epoch, instead of going
+    # back to an invalidated bucket.
+    node.delete('{mytag}:version')
+    self.cache.client._tag_versions.clear()
+    self.assertEqual(self.cache.get('{mytag}-key2'), None)
+    self.assertTrue(int(node.get('{mytag}:version')) > version + 1)
+
+  @override_settings(DJREDIS_ENABLE_TAGGING=True,
+                     DJREDIS_ENABLE_TAG_VERSIONING=True)
+  def test_scan_iter(self):
+    self.cache.set('key1', 'helloworld1')
+    self.cache.set('{mytag}-key1', 'helloworld2')
+    self.cache.set('{mytag}-key2', 'helloworld3')
+    self.cache.set('{oldtag}-key1', 'helloworld4')
+    self.cache.client.delete_tag('oldtag')
+    self.assertEqual(set(self.cache.client.scan_iter()),
+                     set([self.cache.make_key('key1'),
+                          self.cache.make_key('{mytag}-key1'),
+                          self.cache.make_key('{mytag}-key2')]))
+    self.assertEqual(list(self.cache.client.scan_iter('*key2', count=1)),
+                     [self.cache.make_key('{mytag}-key2')])
+
+  @override_settings(DJREDIS_ENABLE_TAGGING=True,
+                     DJREDIS_ENABLE_TAG_VERSIONING=True)
+  def test_pack_buckets(self):
+    cache = RedisCache(
+      'localhost:9500; localhost:9501; localhost:9502',
+      {'OPTIONS': {'CLIENT_CLASS': 'djredis.client.RingClient',
+                   'PACK_BUCKETS': 4}})
+    keys = ['key%s' % i for i in xrange(20)]
+    cache.set_many({key: i for i, key in enumerate(keys)}, timeout=None)
+    cache.set('{mytag}-key1', 'value')
+    buckets = set(cache.client.keys()) - {'{mytag}:version'}
+    self.assertEqual(len(buckets), 5)
+    self.assertEqual(set(cache.client.keys('{djredis-pack:*}')),
+                     set('{djredis-pack:%d}' % i for i in xrange(4)))
+    tag_bucket = cache.client._get_bucket('{mytag}')
+    self.assertEqual(cache.get_many_with_ttl(keys[:2]),
+                     {'key0': (0, None), 'key1': (1, None)})
+    self.assertEqual(cache.get_many(keys),
+                     {key: i for i, key in enumerate(keys)})
+    self.assertEqual(cache.get('key1'), 1)
+    self.assertEqual(cache.incr('key1', 10), 11)
+    self.assertTrue(cache.has_key('key2'))
+    self.assertEqual(cache.delete_many(keys[:10]), 10)
+    self.assertFalse(cache.has_key('key2'))
+    self.assertEqual(set(cache.client.scan_iter()),
+                     set(cache.make_key(key) for key in
+                         keys[10:] + ['{mytag}-key1']))
+    self.assertEqual(cache.client.delete_pattern(cache.make_key('key*')), 10)
+    self.assertEqual(set(cache.client.keys()),
+                     {tag_bucket, '{mytag}:version'})
+
+  def test_pack_bucket_expiry(self):
+    cache = RedisCache(
+      'localhost:9500',
+      {'OPTIONS': {'CLIENT_CLASS': 'djredis.client.RingClient',
+                   'PACK_BUCKETS': 1}})
+    node = cache.client.get_node('{djredis-pack:0}')
+    if not cache.client._supports_field_expiry(node):
+      self.skipTest('Packed keys with a timeout need Redis 7.4.')
+    cache.set('key1', 'value', timeout=1)
+    cache.set_many({'key2': 'value', 'key3': 'value'}, timeout=60)
+    cache.set('key4', 'value', timeout=None)
+    self.assertFalse(cache.add('key1', 'value', timeout=60))
+    ttls = cache.get_many_with_ttl(['key1', 'key2', 'key3', 'key4'])
+    self.assertTrue(0 < ttls['key1'][1] <= 1)
+    self.assertTrue(1 < ttls['key2'][1] <= 60)
+    self.assertEqual(ttls['key4'], ('value', None))
+    time.sleep(2)
+    # key1 expired on its own, although its bucket was written after it.
+    self.assertEqual(cache.get_many(['key1', 'key2', 'key3', 'key4']),
+                     {'key2': 'value', 'key3': 'value', 'key4': 'value'})
+    self.assertTrue(cache.add('key1', 'value', timeout=1))
+    self.assertTrue(0 < cache.get_many_with_ttl(['key1'])['key1'][1] <= 1)
+    cache.set('key2', 'value', timeout=None)
+    self.assertEqual(cache.get_many_with_ttl(['key2']),
+                     {'key2': ('value', None)})
+
+  @override_settings(DJREDIS_ENABLE_TAGGING=True)
+  def test_chunked_delete(self):
+    cache = RedisCache(
+      'localhost:9500; localhost:9501; localhost:9502',
+      {'OPTIONS': {'CLIENT_CLASS': 'djredis.client.RingClient',
+                   'DELETE_CHUNK_SIZE': 2}})
+    keys = ['key%s' % i for i in xrange(7)]
+    tagged_keys = ['{mytag}-key%s' % i for i in xrange(5)]
+    cache.set_many({key: 'value' for key in keys + tagged_keys})
+    self.assertEqual(cache.delete_many(keys + tagged_keys[:3]), 10)
+    self.assertEqual(cache.get_many(keys + tagged_keys),
+                     {key: 'value' for key in tagged_keys[3:]})
+    self.assertEqual(cache.client.delete_tag('mytag'), 1)
+    self.assertEqual(cache.client.keys(), [])
+
+  def test_instrumentation(self):
+    HistogramListener().disconnect() # Not connected, does nothing.
+    listener = HistogramListener().connect(sender=self.cache.client)
+    try:
+      self.cache.set('key1', 'helloworld')
+      self.cache.get('key1')
+      self.cache.get_many(['key1', 'key2'])
+    finally:
+      listener.disconnect()
+      listener.disconnect()
+    self.cache.get('key1') # Not recorded.
+    snapshot = listener.snapshot()
+    self.assertEqual(snapshot['set']['count'], 1)
+    self.assertTrue(snapshot['set']['bytes_out'] > len('helloworld'))
+    self.assertEqual(snapshot['get']['count'], 1)
+    self.assertEqual(snapshot['get']['hits'], 1)
+    self.assertEqual(snapshot['mget']['hits'], 1)
+    self.assertEqual(snapshot['mget']['misses'], 1)
+    node = self.cache.client.ring(self.cache.make_key('key1'))
+    self.assertEqual(snapshot[('get', node)]['count'], 1)
+    self.assertTrue(snapshot['get']['p99'] > 0)
+
+  def test_negative_cache_and_bloom_filter(self):
+    cache = RedisCache(
+      'localhost:9500; localhost:9501; localhost:9502',
+      {'OPTIONS': {'CLIENT_CLASS': 'djredis.client.RingClient',
+                   'NEGATIVE_CACHE_TIMEOUT': 60,
+                   'BLOOM_FILTER': True,
+                   'BLOOM_FILTER_REFRESH_INTERVAL': 0}})
+    cache.set_many({'key%d' % i: i for i in xrange(30)})
+    listener = HistogramListener().connect(sender=cache.client)
+    try:
+      self.assertEqual(cache.get_many(['key%d' % i for i in xrange(30)]),
+                       {'key%d' % i: i for i in xrange(30)})
+      for _ in xrange(2):
+        for i in xrange(100):
+          self.assertEqual(cache.get('missing%d' % i), None)
+    finally:
+      listener.disconnect()
+    snapshot = listener.snapshot()
+    # Misses are answered by the Bloom filters or the negative cache.
+    self.assertTrue(snapshot.get('get', {}).get('count', 0) < 10)
+    self.assertEqual(snapshot['mget']['hits'], 30)
+    # Keys we write are found again.
+    cache.set('missing0', 'value')
+    self.assertEqual(cache.get('missing0'), 'value')
+
+  def test_bloom_filter_rebuild(self):
+    options = {'CLIENT_CLASS': 'djredis.client.RingClient',
+               'BLOOM_FILTER': True, 'BLOOM_FILTER_REFRESH_INTERVAL': 0}
+    cache = RedisCache('localhost:9500; localhost:9501; localhost:9502',
+                       {'OPTIONS': options})
+    values = {'key%d' % i: i for i in xrange(30)}
+    cache.set_many(values)
+    # Keys created by GETSET are added too.
+    cache.client.getset('getset', 'value')
+    self.assertEqual(cache.client.get('getset'), 'value')
+    # A filter recreated by SETBIT after being evicted lacks older keys, so
+    # it's ignored until it's rebuilt.
+    for node in cache.client.name_to_node.itervalues():
+      node.delete(cache.client.BLOOM_FILTER_KEY)
+    cache.set('new', 1)
+    cache = RedisCache('localhost:9500; localhost:9501; localhost:9502',
+                       {'OPTIONS': options})
+    self.assertEqual(cache.get_many(values.keys()), values)
+    self.assertEqual(cache.get('new'), 1)
+    self.assertEqual([bitmap for bitmap, _ in
+                      cache.client._bloom_bitmaps.itervalues()],
+                     [None, None, None])
+    self.assertEqual(cache.client.rebuild_bloom_filters(), 32)
+    self.assertEqual(cache.get_many(values.keys()), values)
+    self.assertEqual(cache.get('new'), 1)
+    self.assertFalse(None in [bitmap for bitmap, _ in
+                              cache.client._bloom_bitmaps.itervalues()])
+
+  def test_hot_keys(self):
+    cache = RedisCache(
+      'localhost:9500; localhost:9501; localhost:9502',
+      {'OPTIONS': {'CLIENT_CLASS': 'djredis.client.RingClient',
+                   'HOT_KEY_SAMPLE_RATE': 1,
+                   'HOT_KEY_PUBLISH_INTERVAL': 0}})
+    cache.set('hot', 'value')
+    for x in xrange(100):
+      cache.get('hot')
+      cache.get('cold-%s' % (x % 20))
+    key = cache.make_key('hot')
+    node = cache.client.ring(key)
+    # GET sends the key and receives the pickled value.
+    weight = 100 * (len(key) + len(pickle.dumps('value')))
+    self.assertEqual(cache.client.hot_keys(1)[(node, 'get')],
+                     [(key, 100, weight)])
+    self.assertEqual(cache.client.get_published_hot_keys(), {})
+    cache.client.profiler.publish()
+    self.assertEqual(cache.client.hot_keys(), {})
+    self.assertEqual(cache.client.get_published_hot_keys(1)[(node, 'get')],
+                     [(key, 100, weight)])
+    cache.client.profiler.disconnect()
+
+  @override_settings(DJREDIS_ENABLE_TAGGING=True)
+  def test_hot_key_replication(self):
+    cache = RedisCache(
+      'localhost:9500; localhost:9501; localhost:9502',
+      {'OPTIONS': {'CLIENT_CLASS': 'djredis.client.RingClient',
+                   'HOT_KEYS': ['hot', '{hottag}-key'],
+                   'HOT_KEY_REPLICAS': 2}})
+    cache.set('hot', 'value1')
+    cache.set('{hottag}-key', 'value2')
+    cache.set('cold', 'value3')
+    for cache_key, num_replicas in ((cache.make_key('hot'), 2),
+                                    ('{hottag}', 2),
+                                    (cache.make_key('cold'), 1)):
+      nodes = set(name for name, node in cache.client.name_to_node.iteritems()
+                  if node.exists(cache_key))
+      self.assertEqual(nodes,
+                       set(cache.client.ring.get_nodes(cache_key,
+                                                       num_replicas)))
+    for _ in xrange(10):
+      self.assertEqual(cache.get('hot'), 'value1')
+      self.assertEqual(cache.get_many(['hot', '{hottag}-key', 'cold']),
+                       {'hot': 'value1', '{hottag}-key': 'value2',
+                        'cold': 'value3'})
+    cache.delete_many(['hot', '{hottag}-key'])
+    self.assertEqual(cache.client.keys(), [cache.make_key('cold')])
+
+  def test_hot_key_replica_timeout(self):
+    cache = RedisCache(
+      'localhost:9500; localhost:9501; localhost:9502',
+      {'OPTIONS': {'CLIENT_CLASS': 'djredis.client.RingClient',
+                   'HOT_KEYS': ['hot'], 'HOT_KEY_REPLICAS': 3,
+                   'HOT_KEY_REPLICA_TIMEOUT': 10}})
+    cache_key = cache.make_key('hot')
+    nodes = [cache.client.name_to_node[name] for name in
+             cache.client.ring.get_nodes(cache_key, 3)]
+    # Copies on replicas expire sooner than the primary's.
+    cache.set('hot', 1, timeout=100)
+    self.assertTrue(10 < nodes[0].ttl(cache_key) <= 100)
+    self.assertTrue(all(0 < node.ttl(cache_key) <= 10 for node in nodes[1:]))
+    # INCR and failed adds drop them, since the primary's value isn't known.
+    cache.set('hot', 1)
+    self.assertEqual(cache.incr('hot'), 2)
+    self.assertEqual([node.get(cache_key) for node in nodes],
+                     ['2', None, None])
+    self.assertFalse(cache.add('hot', 3))
+    self.assertEqual([node.get(cache_key) for node in nodes],
+                     ['2', None, None])
+    cache.set('hot', 4)
+    self.assertEqual([node.get(cache_key) for node in nodes],
+                     ['4', '4', '4'])
+    # Keys replicated for a while stop being replicated.
+    cache.client.replicate_key('key', timeout=0.1)
+    cache_key = cache.client.get_cache_key('key')
+    self.assertEqual(len(cache.client._get_replicas(cache_key)), 3)
+    time.sleep(0.2)
+    self.assertEqual(len(cache.client._get_replicas(cache_key)), 1)
+    self.assertFalse(cache_key in cache.client.replicated_keys)
+
+  # With this tag regex, tags may contain `}`.
+  @override_settings(DJREDIS_ENABLE_TAGGING=True,
+                     DJREDIS_TAG_REGEX=re.compile(r'[^{]*\{(.*)\}.*'))
+  def test_resharding(self):
+    old_cache = RedisCache(
+      'localhost:9500; localhost:9501',
+      {'OPTIONS': {'CLIENT_CLASS': 'djredis.client.RingClient'}})
+    keys = (['key%d' % i for i in xrange(100)] +
+            ['{tag%d}-key' % i for i in xrange(20)] +
+            ['{tag%d}-{other}-key' % i for i in xrange(20)])
+    for key in keys:
+      old_cache.set(key, key, timeout=100)
+    cache = RedisCache(
+      'localhost:9500; localhost:9501; localhost:9502',
+      {'OPTIONS': {'CLIENT_CLASS': 'djredis.client.RingClient',
+                   'PREVIOUS_LOCATION': 'localhost:9500; localhost:9501'}})
+    moved = [key for key in keys if cache.client._get_previous_node(
+      cache.client.get_cache_key(cache.make_key(key)))]
+    self.assertTrue(moved)
+    # Moved keys are read from their previous node and copied with their TTL.
+    new_node = cache.client.name_to_node['localhost:9502']
+    self.assertEqual(cache.get(moved[0]), moved[0])
+    self.assertTrue(0 < new_node.ttl(cache.client.get_cache_key(
+      cache.make_key(moved[0]))) <= 100)
+    self.assertEqual(cache.get_many(keys), {key: key for key in keys})
+    # Writes remove the stale copy from the previous node.
+    cache.set(moved[1], 'new')
+    cache.delete(moved[2])
+    self.assertEqual(old_cache.get(moved[1]), None)
+    self.assertEqual(old_cache.get(moved[2]), None)
+    self.assertEqual(cache.client.migrate(), len(moved) - 2)
+    cache = RedisCache(
+      'localhost:9500; localhost:9501; localhost:9502',
+      {'OPTIONS': {'CLIENT_CLASS': 'djredis.client.RingClient'}})
+    expected = {key: key for key in keys if key != moved[2]}
+    expected[moved[1]] = 'new'
+    self.assertEqual(cache.get_many(keys), expected)
+
+  @override_settings(DJREDIS_ENABLE_TAGGING=True)
+  def test_migrate_bloom_filter(self):
+    options = {'CLIENT_CLASS': 'djredis.client.RingClient',
+               'BLOOM_FILTER': True, 'BLOOM_FILTER_REFRESH_INTERVAL': 0}
+    old_cache = RedisCache('localhost:9500; localhost:9501',
+                           {'OPTIONS': options})
+    keys = ['key%d' % i for i in xrange(40)] + ['{tag%d}-key' % i
+                                                for i in xrange(10)]
+    for key in keys:
+      old_cache.set(key, key)
+    cache = RedisCache(
+      'localhost:9500; localhost:9501; localhost:9502',
+      {'OPTIONS': dict(options,
+                       PREVIOUS_LOCATION='localhost:9500; localhost:9501')})
+    # Every node has a Bloom filter, which moved keys must be added to.
+    cache.set_many({'other%d' % i: i for i in xrange(20)})
+    self.assertEqual(cache.get_many(keys[:5]), {key: key for key in keys[:5]})
+    self.assertTrue(cache.client.migrate() > 0)
+    cache = RedisCache('localhost:9500; localhost:9501; localhost:9502',
+                       {'OPTIONS': options})
+    self.assertEqual(cache.get_many(keys), {key: key for key in keys})
+
+  def test_migrate_generation(self):
+    options = {'CLIENT_CLASS': 'djredis.client.RingClient',
+               'CLEAR': 'generation'}
+    client = RedisCache(
+      'localhost:9500; localhost:9501; localhost:9502',
+      {'OPTIONS': dict(options,
+                       PREVIOUS_LOCATION='localhost:9500; localhost:9501')}
+    ).client
+    # Find a prefix whose generation moves, and whose version key would land
+    # on another node if it was routed by its own name.
+    for i in itertools.count():
+      namespace = '{djredis:namespace:cache%d}' % i
+      if (client._get_previous_node(namespace) and
+          client.ring(namespace) != client.ring(
+            client._get_version_key(namespace))):
+        break
+    key_prefix = 'cache%d' % i
+    old_cache = RedisCache('localhost:9500; localhost:9501',
+                           {'KEY_PREFIX': key_prefix, 'OPTIONS': options})
+    old_cache.set('key', 'value')
+    old_cache.clear()
+    cache = RedisCache(
+      'localhost:9500; localhost:9501; localhost:9502',
+      {'KEY_PREFIX': key_prefix,
+       'OPTIONS': dict(options,
+                       PREVIOUS_LOCATION='localhost:9500; localhost:9501')})
+    self.assertTrue(cache.client.migrate() > 0)
+    cache = RedisCache('localhost:9500; localhost:9501; localhost:9502',
+                       {'KEY_PREFIX': key_prefix, 'OPTIONS': options})
+    self.assertEqual(cache.get('key'), None)
+
+  def test_weights(self):
+    cache = RedisCache(
+      'localhost:9500:2; localhost:9501; localhost:9502',
+      {'OPTIONS': {'CLIENT_CLASS': 'djredis.client.RingClient',
+                   'WEIGHTS': {'localhost:9501': 0.5}}})
+    self.assertEqual(cache.client.ring.weights,
+                     {'localhost:9500': 2, 'localhost:9501': 0.5,
+                      'localhost:9502': 1})
+    for i in xrange(1000):
+      cache.set('key%d' % i, i)
+    distribution = cache.client.get_distribution()
+    self.assertEqual(sum(stats['keys'] for stats in
+                         distribution.itervalues()), 1000)
+    for stats in distribution.itervalues():
+      self.assertTrue(abs(stats['key_share'] - stats['expected_share']) < 0.05)
+    self.assertTrue(distribution['localhost:9500']['keys'] >
+                    distribution['localhost:9502']['keys'] >
+                    distribution['localhost:9501']['keys'])
+
+  def test_fork_safety(self):
+    self.cache.warmup()
+    self.cache.set('key', 'value')
+    pid = os.fork()
+    if pid == 0:
+      # The child reuses the connections created by its parent.
+      status = 1
+      try:
+        if self.cache.get('key') == 'value':
+          status = 0
+      finally:
+        os._exit(status)
+    _, status = os.waitpid(pid, 0)
+    self.assertEqual(status, 0)
+    # The child mustn't have closed the parent's connections.
+    self.assertEqual(self.cache.get('key'), 'value')
+
+  def test_warmup(self):
+    sha1 = self.cache.client.register_script('return 1')
+    report = self.cache.warmup(connections=2)
+    self.assertEqual(set(report), {'localhost:9500', 'localhost:9501',
+                                   'localhost:9502'})
+    for name, node in self.cache.client.name_to_node.iteritems():
+      self.assertEqual(report[name]['error'], None)
+      self.assertEqual(len(report[name]['connect_times']), 2)
+      self.assertEqual(report[name]['scripts'], 1)
+      self.assertEqual(len(node.connection_pool._available_connections), 2)
+      self.assertEqual(node.script_exists(sha1), [True])
+
+  def test_close_connections(self):
+    cache = RedisCache(
+      'localhost:9500; localhost:9501; localhost:9502',
+      {'OPTIONS': {'CLIENT_CLASS': 'djredis.client.RingClient',
+                   'CLOSE_CONNECTIONS': True}})
+    cache.warmup()
+    pools = cache.client._get_connection_pools()
+    self.assertEqual([len(pool._available_connections) for pool in pools],
+                     [1, 1, 1])
+    cache.close()
+    self.assertEqual([len(pool._available_connections) for pool in pools],
+                     [0, 0, 0])
+    cache.set('key', 'value')
+    self.assertEqual(cache.get('key'), 'value')
+
+  def test_deadline(self):
+    cache = RedisCache(
+      'localhost:9500; localhost:9501; localhost:9502',
+      {'OPTIONS': {'CLIENT_CLASS': 'djredis.client.RingClient',
+                   'DEADLINE': 0.5,
+                   'ADAPTIVE_TIMEOUT': True,
+                   'ADAPTIVE_TIMEOUT_WINDOW': 10}})
+    cache.set_many({'key%s' % i: i for i in xrange(10)})
+    self.assertEqual(cache.get('key1'), 1)
+    with cache.deadline(0.01):
+      time.sleep(0.02)
+      self.assertRaises(DeadlineExceeded, cache.get, 'key1')
+    self.assertEqual(cache.get('key1'), 1)
+    items = cache.iter_many(['key1', 'key2'])
+    self.assertEqual(len([next(items)]), 1)
+    # The deadline only applies while the generator runs.
+    self.assertEqual(getattr(cache.client._local, 'deadline', None), None)
+    self.assertEqual(len(list(items)), 1)
+    for i in xrange(10):
+      cache.get('key%s' % i)
+    timeouts = [timeout.timeout for timeout in
+                cache.client.adaptive_timeouts.itervalues()]
+    self.assertTrue(all(timeout is None or 0.01 <= timeout < 0.2
+                        for timeout in timeouts))
+    self.assertTrue(any(timeouts))
+    # Generators and bulk methods are bounded too.
+    cache = RedisCache(
+      'localhost:9500; localhost:9501; localhost:9502',
+      {'OPTIONS': {'CLIENT_CLASS': 'djredis.client.RingClient',
+                   'DEADLINE': 0.000001}})
+    self.assertRaises(DeadlineExceeded, list, cache.iter_many(['key1']))
+    self.assertRaises(DeadlineExceeded, cache.delete_pattern, 'key*')
+
+  def test_load_shedding(self):
+    cache = RedisCache(
+      'localhost:9500',
+      {'OPTIONS': {'CLIENT_CLASS': 'djredis.client.RingClient',
+                   'MAX_IN_FLIGHT': 1}})
+    cache.set('key', 'value')
+    limiter = cache.client.limiters.values()[0]
+    self.assertTrue(limiter.acquire('critical'))
+    self.assertRaises(NodeOverloaded, cache.get, 'key')
+    self.assertRaises(NodeOverloaded, cache.get_many, ['key'])
+    # Writes and deletes wait for a slot instead.
+    threading.Timer(0.1, limiter.release).start()
+    cache.set('key', 'value2')
+    self.assertEqual(cache.get('key'), 'value2')
+    self.assertTrue(limiter.acquire('critical'))
+    threading.Timer(0.1, limiter.release).start()
+    cache.delete('key')
+    self.assertEqual(cache.get('key'), None)
+    self.assertEqual(cache.client.get_concurrency_stats()['localhost:9500'][
+      'shed'], {'low': 0, 'normal': 2, 'critical': 0})
+
+  def test_retries(self):
+    cache = RedisCache(
+      'localhost:9500; localhost:9501; localhost:9502',
+      {'OPTIONS': {'CLIENT_CLASS': 'djredis.client.RingClient',
+                   'RETRIES': 5,
+                   'RETRY_BACKOFF': 0.2,
+                   'RETRY_BACKOFF_MAX': 0.5}})
+    retried = []
+    def receiver(sender, command, **kwargs):
+      retried.append(command)
+    signals.command_retried.connect(receiver, sender=cache.client)
+    try:
+      cache.set('key', 10)
+      key = cache.make_key('key')
+      index = int(cache.client.ring(key).split(':')[1]) - 9500
+      self.runner.stop_master(index)
+      timer = threading.Timer(0.1, self.runner.start_master, [index])
+      timer.start()
+      # The node comes back empty.
+      self.assertEqual(cache.get('key'), None)
+      timer.join()
+      self.assertTrue(retried)
+      self.assertEqual(set(retried), {'get'})
+      cache.set('key', 10)
+      self.runner.stop_master(index)
+      del retried[:]
+      self.assertRaises(ConnectionError, cache.client.incrby, key, 1)
+      self.assertEqual(retried, [])
+      self.runner.start_master(index)
+    finally:
+      signals.command_retried.disconnect(receiver, sender=cache.client)
+
+  def test_no_resend(self):
+    key = self.cache.make_key('key')
+    self.cache.set('key', 10)
+    pool = self.cache.client.get_node(key).connection_pool
+    def fail_after_send():
+      # The next command sent is applied, but its connection fails before
+      # its response is read.
+      connection = pool.get_connection('INCRBY')
+      read_response = connection.read_response
+      def fail():
+        del connection.read_response
+        read_response()
+        raise ConnectionError('Injected failure.')
+      connection.read_response = fail
+      pool.release(connection)
+    fail_after_send()
+    self.assertRaises(ConnectionError, self.cache.client.incrby, key, 1)
+    self.assertEqual(self.cache.get('key'), 11)
+    # Idempotent commands are retried.
+    fail_after_send()
+    self.assertEqual(self.cache.get('key'), 11)
+
 
 class SentinelBackedRingClientTestCase(TestCase):
   def setUp(self):
@@ -82,12 +635,13 @@ class SentinelBackedRingClientTestCase(TestCase):
     """ Wait long enough for everything to come back to consistent state. """
     time.sleep(8)
 
-  def recreate_cache(self):
+  def recreate_cache(self, options=None):
     if hasattr(self, 'cache'):
       self.cache.close()
     self.cache = RedisCache(
       'localhost:9700; localhost:9701; localhost:9702',
-      {'OPTIONS': {'CLIENT_CLASS': 'djredis.client.SentinelBackedRingClient'}})
+      {'OPTIONS': options or
+       {'CLIENT_CLASS': 'djredis.client.SentinelBackedRingClient'}})
 
   def test_dead_sentinel(self):
     ping = self.cache.client.ping()
@@ -101,6 +655,27 @@ class SentinelBackedRingClientTestCase(TestCase):
     self.assertTrue(all(value for value in ping.itervalues()))
     self.runner.start_sentinel(0)
 
+  def test_ring_snapshot_max_age(self):
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    try:
+      # A snapshot missing a master is used until it's too old.
+      HashRing(['mymaster0', 'mymaster1']).dump(path)
+      options = {'CLIENT_CLASS': 'djredis.client.SentinelBackedRingClient',
+                 'RING_SNAPSHOT': path, 'RING_SNAPSHOT_MAX_AGE': 60}
+      self.recreate_cache(options)
+      self.assertEqual(set(self.cache.client.ring.nodes),
+                       {'mymaster0', 'mymaster1'})
+      os.utime(path, (time.time() - 120, time.time() - 120))
+      self.recreate_cache(options)
+      self.assertEqual(set(self.cache.client.ring.nodes),
+                       {'mymaster0', 'mymaster1', 'mymaster2'})
+      self.assertEqual(set(HashRing.load(path).nodes),
+                       {'mymaster0', 'mymaster1', 'mymaster2'})
+      self.assertTrue(time.time() - os.path.getmtime(path) < 60)
+    finally:
+      os.remove(path)
+
   def test_master_failure(self):
     self.cache.client.set('lol', 'cat')
     node = self.cache.client.ring('lol')
@@ -169,3 +744,66 @@ class SentinelBackedRingClientTestCase(TestCase):
                      [('127.0.0.1', 9500 + master_index)])
     # Just being pedantic, no reason this value should have changed.
     self.assertTrue(self.cache.client.get('lol'), 'cat')
+
+
+class ClusterClientTestCase(TestCase):
+  def setUp(self):
+    self.runner = RedisClusterRunner(num_nodes=3)
+    self.runner.start()
+    self.cache = RedisCache(
+      'localhost:9800',
+      {'OPTIONS': {'CLIENT_CLASS': 'djredis.client.ClusterClient'}})
+
+  def tearDown(self):
+    self.cache.close()
+    self.runner.stop()
+
+  def test_slots(self):
+    client = self.cache.client
+    self.assertEqual(len(client.name_to_node), 3)
+    values = {'key%s' % i: i for i in xrange(100)}
+    self.cache.set_many(values)
+    # Keys spread over many slots, but MGET and DEL only work within one.
+    self.assertEqual(self.cache.get_many(values.keys()), values)
+    for key in values:
+      key = self.cache.make_key(key)
+      node = client.get_node(key)
+      self.assertEqual(node.execute_command('CLUSTER', 'KEYSLOT', key),
+                       get_slot(key))
+      self.assertTrue(node.exists(key))
+    self.cache.delete_many(values.keys())
+    self.assertEqual(self.cache.get_many(values.keys()), {})
+
+  @override_settings(DJREDIS_ENABLE_TAGGING=True,
+                     DJREDIS_ENABLE_TAG_VERSIONING=True)
+  def test_tags(self):
+    self.cache.set('{mytag}-key1', 'helloworld1')
+    self.cache.set('{mytag}-key2', 'helloworld2')
+    self.cache.set('{othertag}-key1', 'helloworld3')
+    node = self.cache.client.get_node('{mytag}')
+    version = int(node.get('{mytag}:version'))
+    self.assertEqual(node.hlen('{mytag}:%d' % version), 2)
+    self.assertEqual(self.cache.client.delete_tag('mytag'), 1)
+    # The version key is in the tag's slot.
+    self.assertEqual(int(node.get('{mytag}:version')), version + 1)
+    self.assertEqual(self.cache.get_many(['{mytag}-key1', '{mytag}-key2',
+                                          '{othertag}-key1']),
+                     {'{othertag}-key1': 'helloworld3'})
+
+  def test_moved(self):
+    client = self.cache.client
+    key = self.cache.make_key('lol')
+    slot = get_slot(key)
+    old_name = client.ring(key)
+    index = [i for i in xrange(3)
+             if old_name != '127.0.0.1:%s' % (RedisClusterRunner.PORT + i)][0]
+    for i in xrange(3):
+      node = StrictRedis(port=RedisClusterRunner.PORT + i)
+      node.execute_command('CLUSTER', 'SETSLOT', slot, 'NODE',
+                           self.runner.get_node_id(index))
+    # The cached slot map is stale, so the node we send it to redirects us.
+    self.cache.set('lol', 'cat')
+    self.assertEqual(client.ring(key),
+                     '127.0.0.1:%s' % (RedisClusterRunner.PORT + index))
+    self.assertEqual(self.cache.get('lol'), 'cat')
+    self.assertEqual(self.cache.get_many(['lol']), {'lol': 'cat'})
@@ -195,3 +195,52 @@ class RedisRingRunner(Runner):
   def stop_sentinel(self, i):
     assert 0 <= i < len(self._sentinels)
     self._sentinels[i].stop()
+
+
+class RedisClusterRunner(Runner):
+  PORT = 9800
+
+  def __init__(self, redis_server_path='redis-server', num_nodes=3):
+    num_nodes = min(num_nodes, 15) # Don't allow more than 15 nodes
+    self._tmp_dir = tempfile.mkdtemp()
+    self._nodes = []
+    for i in xrange(num_nodes):
+      port = RedisClusterRunner.PORT + i
+      runner = RedisRunner(port, redis_server_path=redis_server_path)
+      runner.args.extend([
+        '--cluster-enabled', 'yes',
+        '--cluster-config-file',
+        os.path.join(self._tmp_dir, 'nodes-%s.conf' % port),
+        '--cluster-node-timeout', '2000',
+        '--dir', self._tmp_dir])
+      self._nodes.append(runner)
+
+  def start(self):
+    for node in self._nodes:
+      node.start()
+    clients = [redis.StrictRedis(port=node.port) for node in self._nodes]
+    # Split the hash slots evenly between the nodes and introduce them.
+    num_slots = 16384
+    for i, client in enumerate(clients):
+      client.execute_command('CLUSTER', 'RESET', 'HARD')
+      client.execute_command(
+        'CLUSTER', 'ADDSLOTS',
+        *xrange(i * num_slots // len(clients),
+                (i + 1) * num_slots // len(clients)))
+    for node in self._nodes[1:]:
+      clients[0].execute_command('CLUSTER', 'MEET', '127.0.0.1', node.port)
+    for _ in xrange(200):
+      if all('cluster_state:ok' in client.execute_command('CLUSTER', 'INFO')
+             for client in clients):
+        return
+      time.sleep(0.05)
+    raise RunnerError('RedisClusterRunner failed to form a cluster.')
+
+  def stop(self):
+    for node in self._nodes:
+      node.stop()
+
+  def get_node_id(self, i):
+    assert 0 <= i < len(self._nodes)
+    return redis.StrictRedis(port=self._nodes[i].port).execute_command(
+      'CLUSTER', 'MYID')
@@ -1,13 +1,31 @@
 # coding: utf-8
 
+import os
+import tempfile
+import threading
+import time
+
 from collections import defaultdict
 
 from django.core.exceptions import ImproperlyConfigured
 from django.test import TestCase
 
+from djredis.errors import InvalidRingSnapshot
+from djredis.instrumentation import Histogram
 from djredis.utils import pickle
+from djredis.utils.cluster import NUM_SLOTS
+from djredis.utils.cluster import SlotMap
+from djredis.utils.cluster import crc16
+from djredis.utils.cluster import get_slot
+from djredis.utils.cluster import parse_redirect
+from djredis.utils.connection import AdaptiveTimeout
+from djredis.utils.connection import ConcurrencyLimiter
+from djredis.utils.connection import PRIORITY_SHARES
+from djredis.utils.filters import BloomFilter
+from djredis.utils.filters import NegativeCache
 from djredis.utils.hashring import HashRing
 from djredis.utils.imports import import_by_path
+from djredis.utils.topk import SpaceSaving
 
 
 class HashRingTestCase(TestCase):
@@ -73,6 +91,81 @@ class HashRingTestCase(TestCase):
     self.assertTrue(
       sorted(ring._sorted_virtual_nodes) == ring._sorted_virtual_nodes)
 
+  def test_weights(self):
+    weights = {0: 1, 1: 2, 2: 0.5}
+    ring = HashRing(range(3), 100, weights=weights)
+    self.assertEqual(len(ring._sorted_virtual_nodes), 350)
+    shares = ring.get_shares()
+    self.assertAlmostEqual(sum(shares.itervalues()), 1)
+    bins = defaultdict(int)
+    num_keys = 10000
+    for x in xrange(num_keys):
+      bins[ring('lolcat-%s' % x)] += 1
+    for node, weight in weights.iteritems():
+      expected_share = weight / 3.5
+      self.assertTrue(0.8 * expected_share <= shares[node] <=
+                      1.2 * expected_share)
+      self.assertTrue(0.8 * shares[node] <= bins[node] / float(num_keys) <=
+                      1.2 * shares[node])
+    ring.remove_node(1)
+    self.assertEqual(len(ring._sorted_virtual_nodes), 150)
+
+  def test_snapshot(self):
+    nodes = ['10.0.0.%s:6379' % i for i in xrange(10)]
+    ring = HashRing(nodes, 100, weights={nodes[0]: 2})
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    try:
+      ring.dump(path)
+      loaded = HashRing.load(path)
+      self.assertEqual(loaded.nodes, ring.nodes)
+      self.assertEqual(loaded.weights, ring.weights)
+      self.assertEqual(loaded._sorted_virtual_nodes,
+                       ring._sorted_virtual_nodes)
+      for x in xrange(1000):
+        self.assertEqual(loaded('lolcat-%s' % x), ring('lolcat-%s' % x))
+      with open(path, 'r+b') as f:
+        f.seek(-1, os.SEEK_END)
+        f.write('x')
+      self.assertRaises(InvalidRingSnapshot, HashRing.load, path)
+      open(path, 'w').close()
+      self.assertRaises(InvalidRingSnapshot, HashRing.load, path)
+    finally:
+      os.remove(path)
+
+  def test_get_nodes(self):
+    ring = HashRing(range(10), 100)
+    for x in xrange(1000):
+      key = 'lolcat-%s' % x
+      nodes = ring.get_nodes(key, 3)
+      self.assertEqual(len(set(nodes)), 3)
+      self.assertEqual(nodes[0], ring.get_node(key))
+      self.assertEqual(ring.get_nodes(key, 5)[:3], nodes)
+    self.assertEqual(sorted(ring.get_nodes('lolcat', 20)), range(10))
+
+
+class ClusterTestCase(TestCase):
+  def test_get_slot(self):
+    self.assertEqual(crc16('123456789'), 0x31c3)
+    self.assertEqual(get_slot('foo'), 12182)
+    # Only the hash tag is hashed, if there's a non-empty one.
+    self.assertEqual(get_slot('{user1000}.following'), get_slot('user1000'))
+    self.assertEqual(get_slot('{user1000}:version'), get_slot('{user1000}'))
+    self.assertEqual(get_slot('foo{}{bar}'), crc16('foo{}{bar}') % NUM_SLOTS)
+    self.assertEqual(get_slot('foo{{bar}}zap'), crc16('{bar') % NUM_SLOTS)
+
+  def test_slot_map(self):
+    slot_map = SlotMap(['a'] * (NUM_SLOTS // 4) +
+                       ['b'] * (NUM_SLOTS - NUM_SLOTS // 4))
+    self.assertEqual(slot_map.get_shares(), {'a': 0.25, 'b': 0.75})
+    self.assertEqual(slot_map('foo'), 'b')
+    self.assertEqual(slot_map.get_nodes('foo', 3), ['b'])
+    self.assertEqual(parse_redirect('MOVED 3999 127.0.0.1:6381'),
+                     ('MOVED', 3999, ('127.0.0.1', 6381)))
+    self.assertEqual(parse_redirect('ASK 3999 127.0.0.1:6381'),
+                     ('ASK', 3999, ('127.0.0.1', 6381)))
+    self.assertEqual(parse_redirect('ERR unknown command'), None)
+
 
 class ImportsTestCase(TestCase):
   def test_import_by_path(self):
@@ -96,3 +189,125 @@ class PickleTestCase(TestCase):
   def test_compress(self):
     self.assertTrue(len(pickle.dumps('lolcat'*10)) >
                     len(pickle.dumps('lolcat'*10, compress=True)))
+
+
+class HistogramTestCase(TestCase):
+  def test_percentiles(self):
+    histogram = Histogram()
+    self.assertEqual(histogram.percentile(50), None)
+    for x in xrange(1, 1001):
+      histogram.add(x / 1000.0)
+    self.assertEqual(histogram.count, 1000)
+    self.assertAlmostEqual(histogram.mean, 0.5005)
+    self.assertEqual(histogram.max, 1.0)
+    for percentile in (10, 50, 90, 99):
+      self.assertTrue(percentile / 100.0 <= histogram.percentile(percentile) <=
+                      1.1 * percentile / 100.0)
+    self.assertEqual(histogram.percentile(100), 1.0)
+
+
+class SpaceSavingTestCase(TestCase):
+  def test_top_items(self):
+    sketch = SpaceSaving(capacity=10)
+    for x in xrange(1000):
+      sketch.offer('hot-%s' % (x % 3), weight=2)
+      sketch.offer('cold-%s' % x)
+    self.assertEqual(len(sketch), 10)
+    top = sketch.top(3)
+    self.assertEqual(set(item for item, _, _, _ in top),
+                     set(['hot-0', 'hot-1', 'hot-2']))
+    for item, count, weight, error in top:
+      true_count = 334 if item == 'hot-0' else 333
+      self.assertTrue(count - error <= true_count <= count)
+      self.assertEqual(weight, 2 * true_count)
+
+
+class FiltersTestCase(TestCase):
+  def test_negative_cache(self):
+    cache = NegativeCache(timeout=0.1, max_size=2)
+    cache.add(['key1', 'key2', 'key3'])
+    self.assertEqual(len(cache), 2)
+    self.assertFalse('key1' in cache)
+    self.assertTrue('key3' in cache)
+    cache.discard(['key3'])
+    self.assertFalse('key3' in cache)
+    time.sleep(0.1)
+    self.assertFalse('key2' in cache)
+
+  def test_bloom_filter(self):
+    bloom = BloomFilter(num_bits=2 ** 16, num_hashes=4)
+    bitmap = bytearray()
+    for x in xrange(1000):
+      BloomFilter.set_bits(bitmap, bloom.get_positions('lolcat-%s' % x))
+    for x in xrange(1000):
+      self.assertTrue(bloom.contains(bitmap, 'lolcat-%s' % x))
+    false_positives = sum(bloom.contains(bitmap, 'dogcat-%s' % x)
+                          for x in xrange(10000))
+    self.assertTrue(false_positives < 100)
+    # Bits are laid out like Redis bitmaps: bit 0 is the MSB of byte 0.
+    bitmap = bytearray()
+    BloomFilter.set_bits(bitmap, [0, 9])
+    self.assertEqual(bitmap, bytearray('\x80\x40'))
+    # The marker is the bit right after the filter's.
+    self.assertFalse(bloom.is_marked(bitmap))
+    bloom.mark(bitmap)
+    self.assertTrue(bloom.is_marked(bitmap))
+    self.assertEqual(len(bitmap), 2 ** 13 + 1)
+
+
+class AdaptiveTimeoutTestCase(TestCase):
+  def test_timeout(self):
+    timeout = AdaptiveTimeout(window=100, percentile=90, multiplier=2,
+                              min_timeout=0.01)
+    for i in xrange(9):
+      timeout.add(0.1)
+    self.assertEqual(timeout.timeout, None)
+    timeout.add(0.1)
+    self.assertAlmostEqual(timeout.timeout, 0.2)
+    for i in xrange(100):
+      timeout.add(0.001 * (i % 10))
+    self.assertAlmostEqual(timeout.timeout, 0.018)
+    for i in xrange(100):
+      timeout.add(0.001)
+    self.assertEqual(timeout.timeout, 0.01)
+
+
+class ConcurrencyLimiterTestCase(TestCase):
+  def test_priorities(self):
+    limiter = ConcurrencyLimiter(4, PRIORITY_SHARES)
+    self.assertEqual(limiter.limits, {'low': 2, 'normal': 3, 'critical': 4})
+    self.assertTrue(limiter.acquire('low'))
+    self.assertTrue(limiter.acquire('low'))
+    self.assertFalse(limiter.acquire('low'))
+    self.assertTrue(limiter.acquire('normal'))
+    self.assertFalse(limiter.acquire('normal'))
+    self.assertTrue(limiter.acquire('critical'))
+    self.assertFalse(limiter.acquire('critical'))
+    stats = limiter.get_stats()
+    self.assertEqual(stats['in_flight'], 4)
+    self.assertEqual(stats['shed'], {'low': 1, 'normal': 1, 'critical': 1})
+
+  def test_queueing(self):
+    limiter = ConcurrencyLimiter(1, PRIORITY_SHARES)
+    self.assertTrue(limiter.acquire('critical'))
+    threading.Timer(0.1, limiter.release).start()
+    self.assertTrue(limiter.acquire('critical', timeout=1))
+    self.assertFalse(limiter.acquire('critical', timeout=0.05))
+    self.assertTrue(limiter.get_stats()['queue_time']['p99'] >= 0.05)
+    # Without a timeout, it waits for as long as it takes.
+    threading.Timer(0.1, limiter.release).start()
+    self.assertTrue(limiter.acquire('critical', timeout=None))
+    self.assertEqual(limiter.get_stats()['shed']['critical'], 1)
+
+  def test_queue_time_window(self):
+    limiter = ConcurrencyLimiter(1, PRIORITY_SHARES, window=10)
+    self.assertEqual(limiter.get_stats()['queue_time']['p50'], None)
+    self.assertTrue(limiter.acquire('critical'))
+    threading.Timer(0.1, limiter.release).start()
+    self.assertTrue(limiter.acquire('critical', timeout=1))
+    self.assertTrue(limiter.get_stats()['queue_time']['p99'] >= 0.1)
+    for i in xrange(10):
+      limiter.release()
+      self.assertTrue(limiter.acquire('critical'))
+    # The slow acquire left the window.
+    self.assertEqual(limiter.get_stats()['queue_time']['p99'], 0)
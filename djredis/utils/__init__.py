@@ -1,3 +1,6 @@
+import types
+
+from django.core.exceptions import ImproperlyConfigured
 from redis.sentinel import SentinelConnectionPool
 
 
@@ -6,3 +9,23 @@ def get_node_name(node):
     return node.connection_pool.service_name
   return '%s:%s' % (node.connection_pool.connection_kwargs['host'],
                     node.connection_pool.connection_kwargs['port'])
+
+
+def parse_hosts(locations, setting='LOCATION'):
+  """
+  Parses a `LOCATION` style list of hosts (either a `;` separated string or
+  a list of `host:port` strings or (host, port) tuples) into a tuple of
+  (host, port) tuples. Hosts may be given a weight as `host:port:weight`,
+  in which case they're parsed into (host, port, weight) tuples.
+  """
+  if isinstance(locations, types.StringTypes):
+    locations = locations.split(';')
+  hosts = []
+  for host in locations:
+    if isinstance(host, types.StringTypes):
+      host = host.strip().split(':')
+    hosts.append(tuple(host))
+  if not hosts:
+    raise ImproperlyConfigured('`%s` must provide at least one host.' %
+                               setting)
+  return tuple(hosts)
@@ -0,0 +1,162 @@
+# coding: utf-8
+
+from collections import Counter
+from redis.exceptions import ConnectionError
+from redis.exceptions import ResponseError
+from redis.exceptions import TimeoutError
+
+from djredis.errors import ClusterError
+from djredis.utils.connection import Node
+from djredis.utils.connection import NodePipeline
+
+NUM_SLOTS = 16384
+
+
+def _make_crc16_table():
+  # CRC16-CCITT (XMODEM), polynomial 0x1021, as used by Redis Cluster
+  table = []
+  for byte in xrange(256):
+    crc = byte << 8
+    for _ in xrange(8):
+      crc = ((crc << 1) ^ 0x1021) if crc & 0x8000 else crc << 1
+    table.append(crc & 0xffff)
+  return table
+
+_CRC16_TABLE = _make_crc16_table()
+
+
+def crc16(data):
+  crc = 0
+  for char in data:
+    crc = ((crc << 8) & 0xffff) ^ _CRC16_TABLE[((crc >> 8) ^ ord(char)) & 0xff]
+  return crc
+
+
+def get_slot(key):
+  """
+  Returns the Redis Cluster hash slot of `key`. Like Redis, only the part
+  between the first `{` and the following `}` is hashed if it's non-empty,
+  so tag buckets (`{tag}`, `{tag}:version`, `{tag}:N`) share their tag's
+  slot.
+  """
+  if isinstance(key, unicode):
+    key = key.encode('utf-8')
+  else:
+    key = str(key)
+  start = key.find('{')
+  if start != -1:
+    end = key.find('}', start + 1)
+    if end > start + 1:
+      key = key[start + 1:end]
+  return crc16(key) % NUM_SLOTS
+
+
+class SlotMap(object):
+  """
+  Maps keys to the names of the cluster nodes serving their hash slot. It
+  stands in for the `HashRing` of other clients: a slot is served by a
+  single master, so keys can't be replicated to other nodes.
+  """
+  def __init__(self, slots):
+    # `slots` holds the name of each slot's node, or None if it's unassigned.
+    assert len(slots) == NUM_SLOTS
+    self.slots = slots
+    self.nodes = set(slots) - {None}
+    self.weights = dict.fromkeys(self.nodes, 1)
+
+  def get_node(self, key):
+    slot = get_slot(key)
+    name = self.slots[slot]
+    if name is None:
+      raise ClusterError('Slot %d is not served by any node.' % slot)
+    return name
+
+  def get_nodes(self, key, count):
+    return [self.get_node(key)]
+
+  def get_shares(self):
+    counts = Counter(name for name in self.slots if name is not None)
+    return {name: float(counts[name]) / NUM_SLOTS for name in self.nodes}
+
+  def __call__(self, key):
+    return self.get_node(key)
+
+
+def parse_redirect(error):
+  """
+  Returns the (kind, slot, (host, port)) of a `MOVED` or `ASK` error, or
+  None if `error` isn't a redirect.
+  """
+  parts = str(error).split()
+  if len(parts) != 3 or parts[0] not in ('MOVED', 'ASK'):
+    return None
+  host, _, port = parts[2].rpartition(':')
+  return parts[0], int(parts[1]), (host, int(port))
+
+
+class ClusterNode(Node):
+  """
+  A cluster master. Commands it redirects with a MOVED or ASK error, either
+  directly or within a pipeline, are passed to `follow_redirect(redirect,
+  args, options)`, which returns their response.
+  """
+  def __init__(self, follow_redirect, **kwargs):
+    super(ClusterNode, self).__init__(**kwargs)
+    self.follow_redirect = follow_redirect
+
+  def execute_command(self, *args, **options):
+    try:
+      return super(ClusterNode, self).execute_command(*args, **options)
+    except ResponseError as e:
+      redirect = parse_redirect(e)
+      if redirect is None:
+        raise
+      return self.follow_redirect(redirect, args, options)
+
+  def execute_asking(self, *args, **options):
+    # sends a command for a slot this node is importing, preceded by ASKING
+    # in the same round trip
+    pool = self.connection_pool
+    connection = pool.get_connection(args[0], **options)
+    try:
+      connection.send_packed_command(connection.pack_commands([('ASKING',),
+                                                               args]))
+      try:
+        connection.read_response()
+      except ResponseError:
+        connection.disconnect() # The command's response is still unread.
+        raise
+      return self.parse_response(connection, args[0], **options)
+    except (ConnectionError, TimeoutError):
+      connection.disconnect()
+      raise
+    finally:
+      pool.release(connection)
+
+  def pipeline(self, transaction=True, shard_hint=None):
+    return ClusterPipeline(self, self.connection_pool, self.response_callbacks,
+                           transaction, shard_hint)
+
+
+class ClusterPipeline(NodePipeline):
+  # Commands which were redirected are resent one by one to their new node.
+  def __init__(self, node, *args):
+    super(ClusterPipeline, self).__init__(*args)
+    self.node = node
+
+  def _execute_pipeline(self, connection, commands, raise_on_error):
+    response = super(ClusterPipeline, self)._execute_pipeline(
+      connection, commands, False)
+    for i, (args, options) in enumerate(commands):
+      if not isinstance(response[i], ResponseError):
+        continue
+      redirect = parse_redirect(response[i])
+      if redirect is None:
+        continue
+      try:
+        response[i] = self.node.follow_redirect(redirect, args, options)
+      except ResponseError as e:
+        response[i] = e
+    if raise_on_error:
+      self.raise_first_error(commands, response)
+    return response
@@ -0,0 +1,212 @@
+# coding: utf-8
+
+import threading
+import time
+
+from collections import deque
+from contextlib import contextmanager
+from redis import StrictRedis
+from redis import connection
+from redis import sentinel
+from redis.client import StrictPipeline
+from redis.exceptions import ConnectionError
+from redis.exceptions import TimeoutError
+
+# Priorities of commands, lowest first, and the share of a node's
+# `MAX_IN_FLIGHT` commands each one may use by default.
+PRIORITIES = ('low', 'normal', 'critical')
+PRIORITY_SHARES = {'low': 0.5, 'normal': 0.8, 'critical': 1.0}
+
+_local = threading.local()
+
+
+@contextmanager
+def command_timeout(timeout):
+  """
+  Lowers the socket timeout of the commands sent by this thread in the
+  block to `timeout` seconds, if it's lower than their connection's
+  `socket_timeout`. Does nothing if `timeout` is None.
+  """
+  previous = getattr(_local, 'timeout', None)
+  _local.timeout = timeout
+  try:
+    yield
+  finally:
+    _local.timeout = previous
+
+
+class _CommandTimeoutMixin(object):
+  # Applies the timeout set with `command_timeout` to the socket before
+  # sending a command. Its response is read with the same timeout.
+  def send_packed_command(self, command):
+    if not self._sock:
+      self.connect()
+    timeout = getattr(_local, 'timeout', None)
+    if timeout is None or (self.socket_timeout is not None and
+                           timeout > self.socket_timeout):
+      timeout = self.socket_timeout
+    if self._sock.gettimeout() != timeout:
+      self._sock.settimeout(timeout)
+    super(_CommandTimeoutMixin, self).send_packed_command(command)
+
+
+class Connection(_CommandTimeoutMixin, connection.Connection):
+  pass
+
+
+class SentinelManagedConnection(_CommandTimeoutMixin,
+                                sentinel.SentinelManagedConnection):
+  pass
+
+
+class Node(StrictRedis):
+  """
+  A Redis node which, unlike StrictRedis, doesn't send a command or pipeline
+  again when its connection fails: non-idempotent commands like INCRBY may
+  have been applied already. `RingClient` retries idempotent commands
+  itself.
+  """
+  def execute_command(self, *args, **options):
+    pool = self.connection_pool
+    command_name = args[0]
+    connection = pool.get_connection(command_name, **options)
+    try:
+      connection.send_command(*args)
+      return self.parse_response(connection, command_name, **options)
+    except (ConnectionError, TimeoutError):
+      connection.disconnect()
+      raise
+    finally:
+      pool.release(connection)
+
+  def pipeline(self, transaction=True, shard_hint=None):
+    return NodePipeline(self.connection_pool, self.response_callbacks,
+                        transaction, shard_hint)
+
+
+class NodePipeline(StrictPipeline):
+  # Like `Node`, isn't sent again when its connection fails.
+  def execute(self, raise_on_error=True):
+    stack = self.command_stack
+    if not stack:
+      return []
+    if self.scripts:
+      self.load_scripts()
+    if self.transaction or self.explicit_transaction:
+      execute = self._execute_transaction
+    else:
+      execute = self._execute_pipeline
+    if not self.connection:
+      # `reset` releases it.
+      self.connection = self.connection_pool.get_connection('MULTI',
+                                                            self.shard_hint)
+    try:
+      return execute(self.connection, stack, raise_on_error)
+    except (ConnectionError, TimeoutError):
+      self.connection.disconnect()
+      raise
+    finally:
+      self.reset()
+
+
+class AdaptiveTimeout(object):
+  """
+  Derives a socket timeout for a node from the latencies of the last
+  `window` commands sent to it: `multiplier` times their `percentile`th
+  percentile, but at least `min_timeout` seconds. It's recomputed every
+  `window / 10` commands and is None until then.
+  """
+  def __init__(self, window=1000, percentile=99, multiplier=3,
+               min_timeout=0.01):
+    self.percentile = percentile
+    self.multiplier = multiplier
+    self.min_timeout = min_timeout
+    self.timeout = None
+    self._lock = threading.Lock()
+    self._latencies = deque(maxlen=window)
+    self._update_every = max(1, window // 10)
+    self._added = 0
+
+  def add(self, latency):
+    with self._lock:
+      self._latencies.append(latency)
+      self._added += 1
+      if self._added < self._update_every:
+        return
+      self._added = 0
+      latencies = sorted(self._latencies)
+    index = min(int(len(latencies) * self.percentile / 100.0),
+                len(latencies) - 1)
+    self.timeout = max(latencies[index] * self.multiplier, self.min_timeout)
+
+
+class ConcurrencyLimiter(object):
+  """
+  Limits the number of commands in flight to a node to `limit`. Each
+  priority may only use its share of the limit (see `PRIORITY_SHARES`), so
+  as a node slows down and commands pile up, lower priorities are shed
+  first. Commands wait for a slot for up to `timeout` seconds, see
+  `acquire`. The queue times of the last `window` commands let through and
+  the number of shed commands are recorded.
+  """
+  def __init__(self, limit, shares, window=1000):
+    self.limit = limit
+    self.limits = {priority: max(1, int(round(limit * share)))
+                   for priority, share in shares.iteritems()}
+    self.in_flight = 0
+    self.shed = dict.fromkeys(shares, 0)
+    self.queue_times = deque(maxlen=window)
+    self._condition = threading.Condition(threading.Lock())
+
+  def acquire(self, priority, timeout=0):
+    """
+    Takes a slot for a command of `priority`, waiting for up to `timeout`
+    seconds (or for as long as it takes if it's None) for one to free up.
+    Returns False if none did.
+    """
+    limit = self.limits[priority]
+    with self._condition:
+      if self.in_flight < limit:
+        self.in_flight += 1
+        self.queue_times.append(0)
+        return True
+      start = time.time()
+      while self.in_flight >= limit:
+        if timeout is None:
+          self._condition.wait()
+          continue
+        left = start + timeout - time.time()
+        if left <= 0:
+          self.shed[priority] += 1
+          return False
+        self._condition.wait(left)
+      self.in_flight += 1
+      self.queue_times.append(time.time() - start)
+      return True
+
+  def release(self):
+    with self._condition:
+      self.in_flight -= 1
+      # Waiters of different priorities wait for different limits.
+      self._condition.notify_all()
+
+  def get_stats(self, percentiles=(50, 90, 99)):
+    """
+    Returns the number of commands `in_flight`, the `limit`, the number of
+    commands `shed` per priority and `queue_time` percentiles (in seconds)
+    of the last `window` commands let through, or None if there were none.
+    """
+    with self._condition:
+      stats = {
+        'in_flight': self.in_flight,
+        'limit': self.limit,
+        'shed': dict(self.shed),
+        'queue_time': {},
+        }
+      queue_times = sorted(self.queue_times)
+    for percentile in percentiles:
+      index = min(int(len(queue_times) * percentile / 100.0),
+                  len(queue_times) - 1)
+      stats['queue_time']['p%s' % percentile] = (
+        queue_times[index] if queue_times else None)
+    return stats
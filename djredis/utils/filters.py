@@ -0,0 +1,106 @@
+# coding: utf-8
+
+import hashlib
+import struct
+import threading
+import time
+
+from collections import OrderedDict
+
+
+class NegativeCache(object):
+  """
+  A bounded set of keys known to be missing, each remembered for `timeout`
+  seconds. The oldest keys are forgotten first once it holds `max_size`.
+  """
+  def __init__(self, timeout, max_size=10000):
+    self.timeout = timeout
+    self.max_size = max_size
+    self._lock = threading.Lock()
+    self._expires_at = OrderedDict()
+
+  def __contains__(self, key):
+    with self._lock:
+      expires_at = self._expires_at.get(key)
+      if expires_at is None:
+        return False
+      if expires_at > time.time():
+        return True
+      del self._expires_at[key]
+      return False
+
+  def __len__(self):
+    return len(self._expires_at)
+
+  def add(self, keys):
+    expires_at = time.time() + self.timeout
+    with self._lock:
+      for key in keys:
+        self._expires_at.pop(key, None)
+        self._expires_at[key] = expires_at
+      while len(self._expires_at) > self.max_size:
+        self._expires_at.popitem(last=False)
+
+  def discard(self, keys):
+    with self._lock:
+      for key in keys:
+        self._expires_at.pop(key, None)
+
+
+class BloomFilter(object):
+  """
+  A Bloom filter of `num_bits` bits using `num_hashes` hash functions, laid
+  out like a Redis bitmap (see SETBIT), i.e. bit 0 is the most significant
+  bit of the first byte. The bitmap itself is stored elsewhere, this only
+  maps keys to bits and tests them.
+
+  The false positive rate for n keys is about (1 - e^(-kn/m))^k, e.g. ~2%
+  for 1M keys in 8M bits with 4 hashes.
+  """
+  def __init__(self, num_bits, num_hashes):
+    assert 0 < num_bits <= 2 ** 32 # Redis bitmaps are at most 512MB.
+    assert 0 < num_hashes
+    self.num_bits = num_bits
+    self.num_hashes = num_hashes
+
+  def get_positions(self, key):
+    # Double hashing: the i-th hash is h1 + i * h2.
+    h1, h2 = struct.unpack('!QQ', hashlib.md5(str(key)).digest())
+    return [(h1 + i * h2) % self.num_bits for i in xrange(self.num_hashes)]
+
+  @staticmethod
+  def set_bits(bitmap, positions):
+    """
+    Sets bits in `bitmap` (a bytearray), growing it as needed.
+    """
+    for position in positions:
+      index = position >> 3
+      if index >= len(bitmap):
+        bitmap.extend('\x00' * (index + 1 - len(bitmap)))
+      bitmap[index] |= 0x80 >> (position & 7)
+
+  def mark(self, bitmap):
+    """
+    Sets the marker bit of `bitmap`, the bit right after the filter's.
+    """
+    BloomFilter.set_bits(bitmap, [self.num_bits])
+
+  def is_marked(self, bitmap):
+    """
+    Returns whether the marker bit of `bitmap` is set. Only bitmaps known to
+    hold every key are marked, so one that was recreated by SETBIT after
+    being evicted isn't.
+    """
+    index = self.num_bits >> 3
+    return (index < len(bitmap) and
+            bool(bitmap[index] & (0x80 >> (self.num_bits & 7))))
+
+  def contains(self, bitmap, key):
+    """
+    Returns False if `key` was definitely never added to `bitmap`.
+    """
+    for position in self.get_positions(key):
+      index = position >> 3
+      if index >= len(bitmap) or not bitmap[index] & (0x80 >> (position & 7)):
+        return False
+    return True
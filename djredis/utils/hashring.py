@@ -1,7 +1,21 @@
 # coding: utf-8
 
-import hashlib
 import bisect
+import hashlib
+import mmap
+import os
+import struct
+
+from djredis.errors import InvalidRingSnapshot
+
+DEFAULT_NUM_VIRTUAL_NODES = 100
+# Snapshot layout: the header, then the nodes (each a length prefixed name and
+# its weight), then the sorted virtual node hashes (16 bytes each) and lastly
+# the index of each virtual node's node (4 bytes each). The checksum is the
+# md5 of everything after the header. All integers are big-endian.
+SNAPSHOT_MAGIC = 'DJRING01'
+SNAPSHOT_HEADER = struct.Struct('!8s16sIII')
+SNAPSHOT_NODE = struct.Struct('!Hd')
 
 
 class HashRing(object):
@@ -11,40 +25,67 @@ class HashRing(object):
   See the original paper:
   http://thor.cs.ucsb.edu/~ravenben/papers/coreos/KLL+97.pdf
   """
-  def __init__(self, nodes, num_virtual_nodes=100):
+  def __init__(self, nodes, num_virtual_nodes=DEFAULT_NUM_VIRTUAL_NODES,
+               weights=None):
     assert len(nodes) > 0
 
     self.nodes = set()
     self.num_virtual_nodes = num_virtual_nodes
+    self.weights = {}
     self._hash_to_node = {}
     self._sorted_virtual_nodes = []
 
+    weights = weights or {}
     for node in nodes:
-      self.add_node(node)
+      if node in self.nodes:
+        continue
+      self.nodes.add(node)
+      self.weights[node] = weights.get(node, 1)
+      assert self.weights[node] > 0
+      self._sorted_virtual_nodes.extend(self._add_virtual_nodes(node))
+    # Sorting once is much cheaper than an insort per virtual node.
+    self._sorted_virtual_nodes.sort()
 
   @staticmethod
   def _generate_hash(key):
-    return hashlib.md5(str(key)).hexdigest()
+    # Raw digests sort in the same order as hex digests, but are half the
+    # size and cheaper to compute.
+    return hashlib.md5(str(key)).digest()
+
+  def _get_num_virtual_nodes(self, node):
+    # Nodes get virtual nodes in proportion to their weight, so a node with
+    # weight 2 is assigned twice as many keys as one with weight 1.
+    return max(1, int(round(self.num_virtual_nodes * self.weights[node])))
 
-  def add_node(self, node):
+  def _add_virtual_nodes(self, node):
+    # returns the hashes of the virtual nodes of `node`
+    keys = []
+    for virtual_node in xrange(self._get_num_virtual_nodes(node)):
+      key = HashRing._generate_hash('%s:%s' % (str(node), virtual_node))
+      self._hash_to_node[key] = node
+      keys.append(key)
+    return keys
+
+  def add_node(self, node, weight=1):
     if node in self.nodes:
       return
+    assert weight > 0
     self.nodes.add(node)
-    for virtual_node in xrange(self.num_virtual_nodes):
-      key = HashRing._generate_hash('%s:%s' % (str(node), virtual_node))
-      self._hash_to_node[key] = node
+    self.weights[node] = weight
+    for key in self._add_virtual_nodes(node):
       bisect.insort(self._sorted_virtual_nodes, key)
 
   def remove_node(self, node):
     if not node in self.nodes:
       return
-    self.nodes.remove(node)
-    for virtual_node in xrange(self.num_virtual_nodes):
+    for virtual_node in xrange(self._get_num_virtual_nodes(node)):
       key = HashRing._generate_hash('%s:%s' % (str(node), virtual_node))
       del self._hash_to_node[key]
       idx = bisect.bisect_left(self._sorted_virtual_nodes, key)
       assert self._sorted_virtual_nodes[idx] == key
       del self._sorted_virtual_nodes[idx]
+    self.nodes.remove(node)
+    del self.weights[node]
 
   def get_node(self, key):
     if not self.nodes:
@@ -55,5 +96,109 @@ class HashRing(object):
                                           len(self._sorted_virtual_nodes)]
     return self._hash_to_node[node_key]
 
+  def get_nodes(self, key, count):
+    """
+    Returns up to `count` distinct nodes for `key`, found by walking the ring
+    clockwise from its position. The first one is always `get_node(key)`.
+    """
+    count = min(count, len(self.nodes))
+    idx = bisect.bisect(self._sorted_virtual_nodes,
+                        HashRing._generate_hash(key))
+    nodes = []
+    num_virtual_nodes = len(self._sorted_virtual_nodes)
+    for i in xrange(idx, idx + num_virtual_nodes):
+      node = self._hash_to_node[self._sorted_virtual_nodes[i %
+                                                           num_virtual_nodes]]
+      if node not in nodes:
+        nodes.append(node)
+        if len(nodes) == count:
+          break
+    return nodes
+
+  def get_shares(self):
+    """
+    Returns a dict mapping each node to the fraction of the hash space it
+    owns, i.e. the expected fraction of keys it's assigned.
+    """
+    size = 2 ** 128 # md5 digests are 128 bits.
+    shares = dict.fromkeys(self.nodes, 0.0)
+    previous = int(self._sorted_virtual_nodes[-1].encode('hex'), 16) - size
+    for key in self._sorted_virtual_nodes:
+      position = int(key.encode('hex'), 16)
+      # Each virtual node owns the arc ending at its position.
+      shares[self._hash_to_node[key]] += float(position - previous) / size
+      previous = position
+    return shares
+
+  def dump(self, path):
+    """
+    Writes a binary snapshot of the ring to `path`, which `load` can read
+    back much faster than the ring can be rebuilt. Node names must be
+    strings. The file is replaced atomically.
+    """
+    names = sorted(self.nodes)
+    node_to_index = {node: i for i, node in enumerate(names)}
+    parts = []
+    for node in names:
+      parts.append(SNAPSHOT_NODE.pack(len(node), self.weights[node]))
+      parts.append(node)
+    parts.extend(self._sorted_virtual_nodes)
+    parts.append(struct.pack('!%dI' % len(self._sorted_virtual_nodes),
+                             *(node_to_index[self._hash_to_node[key]]
+                               for key in self._sorted_virtual_nodes)))
+    body = ''.join(parts)
+    header = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, hashlib.md5(body).digest(),
+                                  self.num_virtual_nodes, len(names),
+                                  len(self._sorted_virtual_nodes))
+    tmp_path = '%s.%s.tmp' % (path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+      f.write(header)
+      f.write(body)
+    os.rename(tmp_path, path)
+
+  @classmethod
+  def load(cls, path):
+    """
+    Loads a ring written by `dump`. Raises `InvalidRingSnapshot` if the file
+    is truncated, corrupt or was written by an incompatible version.
+    """
+    with open(path, 'rb') as f:
+      try:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+      except (ValueError, mmap.error): # Empty file.
+        raise InvalidRingSnapshot(path)
+    try:
+      if len(data) < SNAPSHOT_HEADER.size:
+        raise InvalidRingSnapshot(path)
+      (magic, checksum, num_virtual_nodes, num_nodes,
+       num_points) = SNAPSHOT_HEADER.unpack_from(data)
+      if (magic != SNAPSHOT_MAGIC or
+          hashlib.md5(data[SNAPSHOT_HEADER.size:]).digest() != checksum):
+        raise InvalidRingSnapshot(path)
+      ring = cls.__new__(cls)
+      ring.num_virtual_nodes = num_virtual_nodes
+      ring.weights = {}
+      names = []
+      offset = SNAPSHOT_HEADER.size
+      for _ in xrange(num_nodes):
+        length, weight = SNAPSHOT_NODE.unpack_from(data, offset)
+        offset += SNAPSHOT_NODE.size
+        names.append(data[offset:offset + length])
+        ring.weights[names[-1]] = weight
+        offset += length
+      end = offset + num_points * 16
+      ring._sorted_virtual_nodes = [data[i:i + 16]
+                                    for i in xrange(offset, end, 16)]
+      indexes = struct.unpack('!%dI' % num_points,
+                              data[end:end + num_points * 4])
+    except struct.error:
+      raise InvalidRingSnapshot(path)
+    finally:
+      data.close()
+    ring.nodes = set(names)
+    ring._hash_to_node = {key: names[index] for key, index in
+                          zip(ring._sorted_virtual_nodes, indexes)}
+    return ring
+
   def __call__(self, key):
     return self.get_node(key)
@@ -0,0 +1,66 @@
+# coding: utf-8
+
+import sys
+import threading
+
+from Queue import Full
+from Queue import Queue
+
+_ITEM, _ERROR, _DONE = range(3)
+
+
+def imerge(iterables, maxsize=1000):
+  """
+  Consumes each iterable in a separate thread and yields their items in the
+  order in which they arrive. At most `maxsize` items are buffered, so slow
+  consumers apply backpressure on the threads. Exceptions raised by any of
+  the iterables are re-raised in the consumer.
+  """
+  iterables = list(iterables)
+  if len(iterables) == 1:
+    # No point in spinning up a thread.
+    for item in iterables[0]:
+      yield item
+    return
+
+  queue = Queue(maxsize)
+  stop = threading.Event()
+
+  def put(message):
+    # Gives up once the consumer has gone away.
+    while not stop.is_set():
+      try:
+        queue.put(message, timeout=0.1)
+        return True
+      except Full:
+        pass
+    return False
+
+  def consume(iterable):
+    try:
+      for item in iterable:
+        if not put((_ITEM, item)):
+          return
+    except Exception:
+      put((_ERROR, sys.exc_info()))
+    finally:
+      put((_DONE, None))
+
+  for iterable in iterables:
+    thread = threading.Thread(target=consume, args=(iterable, ))
+    thread.daemon = True
+    thread.start()
+
+  num_running = len(iterables)
+  try:
+    while num_running:
+      kind, payload = queue.get()
+      if kind == _ITEM:
+        yield payload
+      elif kind == _ERROR:
+        raise payload[0], payload[1], payload[2]
+      else:
+        num_running -= 1
+  finally:
+    # Tell threads to stop in case we're exiting early.
+    stop.set()
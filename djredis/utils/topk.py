@@ -0,0 +1,50 @@
+# coding: utf-8
+
+
+class SpaceSaving(object):
+  """
+  Tracks the approximate top-K most frequent items of a stream using a fixed
+  amount of memory.
+
+  See the original paper:
+  http://www.cs.ucsb.edu/research/tech_reports/reports/2005-23.pdf
+  """
+  def __init__(self, capacity=100):
+    assert capacity > 0
+    self.capacity = capacity
+    self._counts = {}
+    self._errors = {}
+    self._weights = {}
+
+  def __len__(self):
+    return len(self._counts)
+
+  def offer(self, item, count=1, weight=0):
+    """
+    Records `count` occurrences of `item`. `weight` is an additional
+    quantity (e.g. bytes) accumulated per item.
+    """
+    if item not in self._counts:
+      if len(self._counts) < self.capacity:
+        self._counts[item] = self._errors[item] = self._weights[item] = 0
+      else:
+        # Replace the least frequent item, inheriting its count as the new
+        # item's maximum overestimation.
+        victim = min(self._counts, key=self._counts.get)
+        self._errors[item] = self._counts.pop(victim)
+        self._counts[item] = self._errors[item]
+        self._weights[item] = 0
+        del self._errors[victim]
+        del self._weights[victim]
+    self._counts[item] += count
+    self._weights[item] += weight
+
+  def top(self, n=None):
+    """
+    Returns a list of (item, count, weight, error) tuples for the `n` most
+    frequent items, most frequent first. The true count of an item lies
+    between `count - error` and `count`.
+    """
+    items = sorted(self._counts, key=self._counts.get, reverse=True)[:n]
+    return [(item, self._counts[item], self._weights[item], self._errors[item])
+            for item in items]
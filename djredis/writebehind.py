@@ -0,0 +1,206 @@
+# coding: utf-8
+
+import atexit
+import logging
+import os
+import threading
+
+from collections import defaultdict
+from collections import OrderedDict
+from redis.exceptions import RedisError
+
+from djredis.errors import DJRedisError
+
+OVERFLOW_POLICIES = ('block', 'drop', 'sync')
+log = logging.getLogger('djredis')
+
+
+def write_operations(client, operations):
+  """
+  Writes `operations`, a dict mapping keys to (operation, value, timeout)
+  writes, with a pipeline per node for the deletes and for the sets of each
+  timeout.
+  """
+  timeout_to_sets = defaultdict(dict)
+  deletes = []
+  for key, (operation, value, timeout) in operations.iteritems():
+    if operation == WriteBehindQueue.SET:
+      timeout_to_sets[timeout][key] = value
+    else:
+      deletes.append(key)
+  if deletes:
+    client.delete(*deletes)
+  for timeout, mapping in timeout_to_sets.iteritems():
+    client.set_many(mapping, ex=timeout)
+
+
+class WriteBehindQueue(object):
+  """
+  Buffers sets and deletes for a `RingClient` and writes them from a
+  background thread, taking them off the caller's critical path.
+
+  Writes are keyed by cache key, so repeated writes to a key before it's
+  flushed are coalesced into the last one. The queue is flushed with a
+  pipeline per node once it holds `flush_size` keys or `flush_interval`
+  seconds after the last flush, and when the process exits.
+
+  When the queue already holds `max_size` keys, `overflow` decides what
+  happens to new ones:
+  - `sync` writes them synchronously.
+  - `block` waits until the queue has been flushed.
+  - `drop` drops sets. Deletes are still written synchronously, since
+    dropping them would leave stale values behind.
+  """
+  SET, DELETE = 'set', 'delete'
+
+  def __init__(self, client, max_size=10000, flush_size=100,
+               flush_interval=0.05, overflow='sync'):
+    assert overflow in OVERFLOW_POLICIES
+    self.client = client
+    self.max_size = max_size
+    self.flush_size = flush_size
+    self.flush_interval = flush_interval
+    self.overflow = overflow
+    self.dropped = 0
+    self._pid = None
+    self._closed = False
+    atexit.register(self.close)
+
+  def _start(self):
+    # (Re)initializes our state in a new process. Writes queued by a parent
+    # process are its to flush, and the flush thread doesn't survive forks.
+    self._lock = threading.Lock()
+    self._not_empty = threading.Condition(self._lock)
+    self._not_full = threading.Condition(self._lock)
+    # Held while writing, so that writes to Redis happen in queue order.
+    self._write_lock = threading.Lock()
+    self._pending = OrderedDict()
+    self._flushing = {}
+    self._thread = threading.Thread(target=self._run,
+                                    name='djredis-write-behind')
+    self._thread.daemon = True
+    self._thread.start()
+    self._pid = os.getpid()
+
+  def put(self, key, value, timeout):
+    """
+    Queues setting `key` to `value` for `timeout` seconds. Returns False if
+    the write was dropped.
+    """
+    return self._put(key, (WriteBehindQueue.SET, value, timeout))
+
+  def delete(self, key):
+    """
+    Queues deleting `key`.
+    """
+    self._put(key, (WriteBehindQueue.DELETE, None, None))
+
+  def _put(self, key, operation):
+    if self._pid != os.getpid():
+      self._start()
+    with self._lock:
+      if self.overflow == 'block':
+        while (key not in self._pending and not self._closed and
+               len(self._pending) >= self.max_size):
+          self._not_empty.notify()
+          self._not_full.wait()
+      full = key not in self._pending and len(self._pending) >= self.max_size
+      if not (full or self._closed):
+        self._pending.pop(key, None) # Coalesce, and keep FIFO order.
+        self._pending[key] = operation
+        if len(self._pending) >= self.flush_size:
+          self._not_empty.notify()
+        return True
+      if (full and self.overflow == 'drop' and
+          operation[0] == WriteBehindQueue.SET):
+        self.dropped += 1
+        return False
+    with self._write_lock:
+      self._write({key: operation})
+    return True
+
+  def get(self, key):
+    """
+    Returns the pending (operation, value, timeout) write for `key`, or None
+    if there's none. This lets the cache read its own writes.
+    """
+    if self._pid != os.getpid():
+      return None
+    with self._lock:
+      return self._pending.get(key) or self._flushing.get(key)
+
+  def pop(self, keys):
+    """
+    Writes the pending writes for `keys` synchronously, e.g. before running
+    a command which depends on their values.
+    """
+    if self._pid != os.getpid():
+      return
+    with self._write_lock:
+      with self._lock:
+        operations = {key: self._pending.pop(key) for key in keys
+                      if key in self._pending}
+        self._not_full.notify_all()
+      if operations:
+        self._write(operations)
+
+  def discard(self):
+    """
+    Drops all pending writes, waiting for any flush in progress.
+    """
+    if self._pid != os.getpid():
+      return
+    with self._write_lock:
+      with self._lock:
+        self._pending.clear()
+        self._not_full.notify_all()
+
+  def _write(self, operations):
+    write_operations(self.client, operations)
+
+  def flush(self):
+    """
+    Writes all pending writes.
+    """
+    if self._pid != os.getpid():
+      return
+    with self._write_lock:
+      with self._lock:
+        operations, self._pending = self._pending, OrderedDict()
+        self._flushing = operations # Visible to `get` until written.
+        self._not_full.notify_all()
+      try:
+        if operations:
+          self._write(operations)
+      finally:
+        with self._lock:
+          self._flushing = {}
+
+  def _run(self):
+    while True:
+      with self._lock:
+        if len(self._pending) < self.flush_size and not self._closed:
+          self._not_empty.wait(self.flush_interval)
+        if self._closed:
+          return
+      try:
+        self.flush()
+      except (DJRedisError, RedisError):
+        log.error('Failed to flush write-behind queue', exc_info=True)
+
+  def close(self):
+    """
+    Flushes all pending writes and stops the flush thread. Writes queued
+    after this are written synchronously.
+    """
+    if self._pid != os.getpid() or self._closed:
+      return
+    with self._lock:
+      self._closed = True
+      self._not_empty.notify()
+      self._not_full.notify_all()
+    self._thread.join()
+    try:
+      self.flush()
+    except (DJRedisError, RedisError):
+      log.error('Failed to flush write-behind queue', exc_info=True)
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# coding: utf-8
+import json
+import subprocess
+import sys
+import time
+
+from argparse import ArgumentParser
+from os.path import abspath
+from os.path import dirname
+from os.path import join
+
+# Modify the `PATH` so that our djredis app is in it.
+parent_dir = dirname(abspath(__file__))
+sys.path.insert(0, parent_dir)
+
+# Load Django-related settings; necessary for Django imports to work.
+import local_settings; local_settings
+
+from djredis.benchmarks import check
+from djredis.benchmarks import compare
+
+BASELINES_DIR = join(parent_dir, 'djredis', 'benchmarks', 'baselines')
+
+
+def _get_commit():
+  try:
+    return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                   cwd=parent_dir).strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def _parse_list(value, type=int):
+  return [type(x) for x in value.split(',')]
+
+
+def _load_results(path):
+  with open(path) as f:
+    return json.load(f)['results']
+
+
+def runbenchmarks(args):
+  if args.suite == 'ring':
+    from djredis.benchmarks import ring
+    results = ring.run(iterations=args.iterations)
+  elif args.suite == 'memory':
+    from djredis.benchmarks import memory
+    results = memory.run(value_sizes=args.value_sizes,
+                         redis_server_path=args.redis_server_path)
+  else:
+    from djredis.benchmarks import cache
+    results = cache.run(num_nodes=args.nodes,
+                        value_sizes=args.value_sizes,
+                        iterations=args.iterations,
+                        redis_server_path=args.redis_server_path)
+  output = {
+    'commit': _get_commit(),
+    'suite': args.suite,
+    'timestamp': int(time.time()),
+    'results': results
+    }
+  baseline_path = args.baseline or join(BASELINES_DIR, '%s.json' % args.suite)
+  if args.update_baseline:
+    with open(baseline_path, 'w') as f:
+      json.dump(output, f, indent=2, sort_keys=True)
+      f.write('\n')
+  json.dump(output, args.output, indent=2, sort_keys=True)
+  args.output.write('\n')
+
+  if args.compare:
+    for name, old, new, change in compare(_load_results(args.compare),
+                                          results, args.metric):
+      sys.stderr.write('%-70s %10.3f %10.3f %+7.1f%%\n' %
+                       (name, old, new, change * 100))
+
+  if args.check:
+    regressions = check(_load_results(baseline_path), results, args.threshold)
+    for name, old, new, change in regressions:
+      sys.stderr.write('REGRESSION %-59s %10.3f %10.3f %+7.1f%%\n' %
+                       (name, old, new, change * 100))
+    sys.exit(bool(regressions))
+
+if __name__ == '__main__':
+  parser = ArgumentParser()
+  parser.add_argument('--suite', default='cache',
+                      choices=('cache', 'memory', 'ring'),
+                      help='`cache` and `memory` need redis-server, `ring` '
+                      'runs offline.')
+  parser.add_argument('--nodes', default=[1, 3], type=_parse_list,
+                      help='Comma separated list of cluster sizes.')
+  parser.add_argument('--value-sizes', default=[100, 10000],
+                      type=_parse_list,
+                      help='Comma separated list of value sizes in bytes.')
+  parser.add_argument('--iterations', default=1000, type=int)
+  parser.add_argument('--redis-server-path', default='redis-server')
+  parser.add_argument('--output', default=sys.stdout,
+                      type=lambda path: open(path, 'w'),
+                      help='File to write the JSON results to.')
+  parser.add_argument('--compare', default=None,
+                      help='JSON results of an earlier run to compare with.')
+  parser.add_argument('--metric', default='p99_ms',
+                      help='Metric to compare results on.')
+  parser.add_argument('--baseline', default=None,
+                      help='Baseline results for --check and '
+                      '--update-baseline. Defaults to the stored baseline of '
+                      'the suite.')
+  parser.add_argument('--check', action='store_true', default=False,
+                      help='Exit with an error if any result regressed by '
+                      'more than --threshold from the baseline.')
+  parser.add_argument('--threshold', default=1.0, type=float,
+                      help='Maximum allowed slowdown, 1.0 means 2x slower.')
+  parser.add_argument('--update-baseline', action='store_true', default=False)
+
+  runbenchmarks(parser.parse_args())